@@ -8,7 +8,6 @@
 
 import logging
 from abc import abstractmethod
-from collections import defaultdict
 
 import climetlab
 from climetlab.core.order import build_remapping
@@ -137,14 +136,26 @@ class Base(metaclass=MetaBase):
     def get_metadata(self, i):
         return self[i].metadata()
 
-    def unique_values(self, *coords, remapping=None, patches=None, progress_bar=False):
+    def metadata_table(self, *keys, remapping=None, patches=None, as_pandas=False, progress_bar=False):
         """
-        Given a list of metadata attributes, such as date, param, levels,
-        returns the list of unique values for each attributes
+        Returns the values of the metadata attributes `keys` for all elements, in one pass,
+        as a dictionary of NumPy arrays indexed by key (or a pandas DataFrame if `as_pandas` is True).
+        A key can be suffixed with ':int', ':float' or ':str' to select the type of its column,
+        otherwise values are returned as they are, in an object array.
         """
 
-        assert len(coords)
-        assert all(isinstance(k, str) for k in coords), coords
+        import numpy as np
+
+        assert all(isinstance(k, str) for k in keys), keys
+
+        names = []
+        kinds = []
+        for k in keys:
+            name, kind = k.split(":") if ":" in k else (k, None)
+            if kind not in (None, "int", "float", "str"):
+                raise ValueError(f"Unsupported kind '{kind}'")
+            names.append(name)
+            kinds.append(kind)
 
         remapping = build_remapping(remapping, patches)
         iterable = self
@@ -152,19 +163,64 @@ class Base(metaclass=MetaBase):
         if progress_bar:
             iterable = climetlab.utils.progress_bar(
                 iterable=self,
-                desc=f"Finding coords in dataset for {coords}",
+                desc=f"Extracting metadata for {keys}",
             )
 
-        dic = defaultdict(dict)
+        columns = self._metadata_columns(iterable, names, kinds, remapping)
+
+        table = {}
+        for k, kind, column in zip(keys, kinds, columns):
+            array = None
+            if kind in ("int", "float") and None not in column:
+                try:
+                    array = np.array(column, dtype=dict(int=np.int64, float=np.float64)[kind])
+                except (TypeError, ValueError):
+                    pass
+            if array is None:
+                array = np.empty(len(column), dtype=object)
+                array[:] = column
+            table[k] = array
+
+        if as_pandas:
+            import pandas as pd
+
+            return pd.DataFrame(table)
+
+        return table
+
+    def _metadata_columns(self, iterable, names, kinds, remapping):
+        casts = [dict(int=int, float=float, str=str).get(kind) for kind in kinds]
+        columns = [[] for _ in names]
+        appends = [c.append for c in columns]
+
         for f in iterable:
             metadata = remapping(f.metadata)
-            for k in coords:
-                v = metadata(k)
-                dic[k][v] = True
+            for name, cast, append in zip(names, casts, appends):
+                v = metadata(name)
+                if cast is not None and v is not None:
+                    v = cast(v)
+                append(v)
+
+        return columns
+
+    def unique_values(self, *coords, remapping=None, patches=None, progress_bar=False):
+        """
+        Given a list of metadata attributes, such as date, param, levels,
+        returns the list of unique values for each attributes
+        """
+
+        assert len(coords)
+        assert all(isinstance(k, str) for k in coords), coords
 
-        dic = {k: tuple(values.keys()) for k, values in dic.items()}
+        table = self.metadata_table(
+            *coords,
+            remapping=remapping,
+            patches=patches,
+            progress_bar=progress_bar,
+        )
 
-        return dic
+        # dict.fromkeys() keeps the order in which the values are found
+        return {k: tuple(dict.fromkeys(table[k].tolist())) for k in coords}
 
     def combinations(self, *coords, progress_bar=False):
         assert all(isinstance(k, str) for k in coords), coords
@@ -17,21 +17,30 @@ decide to read it or create it.
 
 """
 
+import atexit
 import ctypes
 import datetime
+import errno
 import functools
 import hashlib
 import json
 import logging
 import os
+import pathlib
 import platform
 import shutil
 import sqlite3
+import stat
 import threading
 import time
+from collections import Counter
+from collections import defaultdict
 
 from filelock import FileLock
+from lru import LRU
 
+from climetlab.core.eviction import Usage
+from climetlab.core.eviction import eviction_policy
 from climetlab.core.settings import SETTINGS
 from climetlab.utils import humanize
 from climetlab.utils.html import css
@@ -45,6 +54,33 @@ LOG = logging.getLogger(__name__)
 CONNECTION = None
 CACHE = None
 
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def _create_cache_table(connection):
+    # If you change the schema, change VERSION above
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cache (
+                path          TEXT PRIMARY KEY,
+                owner         TEXT NOT NULL,
+                args          TEXT NOT NULL,
+                creation_date TEXT NOT NULL,
+                flags         INTEGER DEFAULT 0,
+                owner_data    TEXT,
+                last_access   TEXT NOT NULL,
+                type          TEXT,
+                parent        TEXT,
+                replaced      TEXT,
+                extra         TEXT,
+                expires       INTEGER,
+                accesses      INTEGER,
+                size          INTEGER);"""
+    )
+    # Clocks of the eviction policies, see GDSF
+    connection.execute("CREATE TABLE IF NOT EXISTS eviction (policy TEXT PRIMARY KEY, clock REAL);")
+
 
 class DiskUsage:
     def __init__(self, path):
@@ -124,41 +160,290 @@ class Future:
         self._condition = threading.Condition()
         self._ready = False
         self._result = None
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.finished = None
 
     def execute(self):
+        self.started = time.monotonic()
         try:
             self._result = self.func(*self.args, **self.kwargs)
         except Exception as e:
             LOG.error(e)
             self._result = e
+        self.finished = time.monotonic()
         with self._condition:
             self._ready = True
             self._condition.notify_all()
 
-    def result(self):
+    def result(self, timeout=None):
         with self._condition:
-            while not self._ready:
-                self._condition.wait()
+            if not self._condition.wait_for(lambda: self._ready, timeout):
+                raise TimeoutError(f"{self.func.__name__} did not complete in {timeout} seconds")
         if isinstance(self._result, Exception):
             raise self._result
         return self._result
 
 
+class CacheMetrics:
+    """Statistics on the requests processed by the cache thread, and on
+    the batched writes of the in-memory table to the database."""
+
+    def __init__(self):
+        self.requests = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_time = 0.0
+        self.housekeeping_steps = 0
+        self.housekeeping_runs = 0
+        self.housekeeping_time = 0.0
+
+    def request(self, future):
+        wait = future.started - future.enqueued
+        run = future.finished - future.started
+        self.requests += 1
+        self.wait_time += wait
+        self.max_wait_time = max(self.max_wait_time, wait)
+        self.run_time += run
+        self.max_run_time = max(self.max_run_time, run)
+
+    def flush(self, rows, elapsed):
+        self.flushes += 1
+        self.flushed_rows += rows
+        self.flush_time += elapsed
+
+    def housekeeping(self, elapsed, finished):
+        self.housekeeping_steps += 1
+        self.housekeeping_runs += finished
+        self.housekeeping_time += elapsed
+
+    def as_dict(self):
+        result = dict(vars(self))
+        result["average_wait_time"] = self.wait_time / self.requests if self.requests else 0.0
+        result["average_run_time"] = self.run_time / self.requests if self.requests else 0.0
+        return result
+
+
 class Cache(threading.Thread):
+    # Flush the pending changes early when there are that many of them
+    MAXIMUM_PENDING_CHANGES = 10_000
+    # Number of files processed by the housekeeping between checks of its time budget
+    HOUSEKEEPING_STEP = 100
+
     def __init__(self):
         super().__init__(daemon=True)
         self._connection = None
         self._queue = []
         self._condition = threading.Condition()
 
+        # The cache table is kept in memory, as {path: [size, owner_data, owner]}, so that
+        # cache_file() does not have to wait for the cache thread. Changes are
+        # written to the database in batches by _flush(), either periodically
+        # or before any request that reads the database is processed.
+        self._lock = threading.RLock()
+        self._table = None
+        self._total_size = 0
+        self._owner_sizes = defaultdict(int)
+        # Version of the database when the running totals were last read from it, see _resync_sizes()
+        self._data_version = None
+        self._inserts = {}
+        self._accesses = {}
+        self._updates = {}
+        self._first_change = None
+        self._metrics = CacheMetrics()
+        # Clocks of the eviction policies, recorded with each access, see GDSF
+        self._clocks = {}
+
+        # Sizes of the directories in the cache, see _entry_size()
+        self._directory_sizes = {}
+        # Background housekeeping, see _background_housekeeping()
+        self._housekeeper = None
+        self._last_housekeeping = time.monotonic()
+
     def run(self):
         while True:
             with self._condition:
                 while len(self._queue) == 0:
-                    self._condition.wait()
-                s = self._queue.pop(0)
+                    delays = [d for d in (self._flush_delay(), self._housekeeping_delay()) if d is not None]
+                    delay = min(delays) if delays else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                s = self._queue.pop(0) if self._queue else None
                 self._condition.notify_all()
-            s.execute()
+
+            try:
+                self._flush()
+            except Exception:
+                LOG.exception("Cannot update the cache database")
+
+            if s is not None:
+                s.execute()
+                with self._lock:
+                    self._metrics.request(s)
+                continue
+
+            try:
+                self._background_housekeeping()
+            except Exception:
+                LOG.exception("Cache housekeeping failed")
+                self._housekeeper = None
+                self._last_housekeeping = time.monotonic()
+
+    def _pending_changes(self):
+        return len(self._inserts) + len(self._accesses) + len(self._updates)
+
+    def _flush_delay(self):
+        """Time to wait before the pending changes must be written, or None if there are none."""
+        first = self._first_change
+        if first is None:
+            return None
+        if self._pending_changes() >= self.MAXIMUM_PENDING_CHANGES:
+            return 0
+        return first + SETTINGS.get("cache-flush-interval") - time.monotonic()
+
+    def _changed(self):
+        # Called with self._lock held, returns True if the cache thread must be woken up
+        if self._first_change is None:
+            self._first_change = time.monotonic()
+            return True
+        return self._pending_changes() >= self.MAXIMUM_PENDING_CHANGES
+
+    def _wake_up(self):
+        # Must not be called with self._lock held
+        with self._condition:
+            self._condition.notify_all()
+
+    def _flush(self):
+        """Write the pending changes of the in-memory table to the database,
+        in a single transaction."""
+        with self._lock:
+            inserts, self._inserts = self._inserts, {}
+            accesses, self._accesses = self._accesses, {}
+            updates, self._updates = self._updates, {}
+            self._first_change = None
+
+        if not (inserts or accesses or updates):
+            return
+
+        start = time.monotonic()
+        try:
+            self._write_changes(inserts, accesses, updates)
+        except Exception:
+            self._restore_changes(inserts, accesses, updates)
+            raise
+
+        with self._lock:
+            self._metrics.flush(len(inserts) + len(accesses) + len(updates), time.monotonic() - start)
+
+    def _restore_changes(self, inserts, accesses, updates):
+        # The write failed (e.g. the database is locked by another process), merge the
+        # changes back with those made since, so they are written by the next flush
+        with self._lock:
+            for path, insert in inserts.items():
+                self._inserts.setdefault(path, insert)
+            for path, (count, date, clock) in accesses.items():
+                if path in self._accesses:
+                    newer_count, newer_date, newer_clock = self._accesses[path]
+                    self._accesses[path] = (count + newer_count, max(date, newer_date), max(clock, newer_clock))
+                else:
+                    self._accesses[path] = (count, date, clock)
+            for path, update in updates.items():
+                self._updates.setdefault(path, update)
+            if self._first_change is None:
+                # Retry after cache-flush-interval, rather than straight away
+                self._first_change = time.monotonic()
+
+    def _write_changes(self, inserts, accesses, updates):
+        with self.connection as db:
+            db.executemany(
+                """
+                INSERT OR IGNORE INTO cache(
+                                path,
+                                owner,
+                                args,
+                                creation_date,
+                                last_access,
+                                accesses,
+                                parent)
+                VALUES(?,?,?,?,?,0,?)""",
+                [(path, owner, args, date, date, parent) for path, (owner, args, date, parent) in inserts.items()],
+            )
+            db.executemany(
+                """
+                UPDATE cache
+                SET accesses    = IFNULL(accesses, 0) + ?,
+                    last_access = ?,
+                    extra       = json_set(IFNULL(extra, '{}'), '$.clock', ?)
+                WHERE path=?""",
+                [(count, date, clock, path) for path, (count, date, clock) in accesses.items()],
+            )
+            db.executemany(
+                """
+                UPDATE cache
+                SET size=?, type=?, owner_data=?, extra=json_patch(IFNULL(extra, '{}'), IFNULL(?, '{}'))
+                WHERE path=?""",
+                [(size, kind, owner_data, extra, path) for path, (size, kind, owner_data, extra) in updates.items()],
+            )
+
+    def _ensure_table(self):
+        if self._table is not None:
+            return
+        if threading.current_thread() is self:
+            self._load_table()
+        else:
+            self.enqueue(self._load_table).result()
+
+    def _load_table(self):
+        if self._table is not None:
+            return
+
+        table = {}
+        with self.connection as db:
+            for path, size, owner_data, owner in db.execute("SELECT path, size, owner_data, owner FROM cache"):
+                table[path] = [size, owner_data, owner]
+            clocks = dict(db.execute("SELECT policy, clock FROM eviction").fetchall())
+
+        with self._lock:
+            self._table = table
+            self._clocks = clocks
+            self._total_size = 0
+            self._owner_sizes = defaultdict(int)
+            for entry in table.values():
+                self._resize(entry, entry[0])
+
+    def _resize(self, entry, size):
+        # Called with self._lock held
+        delta = (size or 0) - (entry[0] or 0)
+        self._total_size += delta
+        self._owner_sizes[entry[2]] += delta
+        entry[0] = size
+
+    def _forget(self, path):
+        with self._lock:
+            for pending in (self._inserts, self._accesses, self._updates):
+                pending.pop(path, None)
+            if self._table is not None and path in self._table:
+                self._resize(self._table.pop(path), None)
+        self._directory_sizes.pop(path, None)
+
+    def metrics(self):
+        """Returns statistics on the cache: the number of requests processed by the cache thread,
+        the time they spent in the queue and running, the current length of the queue, and the
+        number and duration of the batched writes to the database."""
+        with self._condition:
+            queue = len(self._queue)
+        with self._lock:
+            result = self._metrics.as_dict()
+            result["queue_length"] = queue
+            result["pending_changes"] = self._pending_changes()
+            result["entries"] = len(self._table) if self._table is not None else None
+            result["total_size"] = self._total_size
+        return result
 
     @property
     def connection(self):
@@ -176,26 +461,11 @@ class Cache(threading.Thread):
         connection = sqlite3.connect(cache_db)
         # So we can use rows as dictionaries
         connection.row_factory = sqlite3.Row
-
-        # If you change the schema, change VERSION above
-        connection.execute(
-            """
-            CREATE TABLE IF NOT EXISTS cache (
-                    path          TEXT PRIMARY KEY,
-                    owner         TEXT NOT NULL,
-                    args          TEXT NOT NULL,
-                    creation_date TEXT NOT NULL,
-                    flags         INTEGER DEFAULT 0,
-                    owner_data    TEXT,
-                    last_access   TEXT NOT NULL,
-                    type          TEXT,
-                    parent        TEXT,
-                    replaced      TEXT,
-                    extra         TEXT,
-                    expires       INTEGER,
-                    accesses      INTEGER,
-                    size          INTEGER);"""
-        )
+        # Readers (other processes) are not blocked by the batched writes.
+        # Only the last transactions can be lost on power failure in WAL mode.
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _create_cache_table(connection)
         return connection
 
     def enqueue(self, func, *args, **kwargs):
@@ -218,7 +488,17 @@ class Cache(threading.Thread):
 
     def _settings_changed(self):
         LOG.debug("Settings changed")
-        self._connection = None  # The user may have changed the cache directory
+        # The user may have changed the cache directory
+        self._flush()
+        self._housekeeper = None
+        self._directory_sizes = {}
+        with self._lock:
+            self._connection = None
+            self._table = None
+            self._clocks = {}
+            self._total_size = 0
+            self._owner_sizes = defaultdict(int)
+            self._data_version = None
         self._check_cache_size()
 
     def _latest_date(self):
@@ -259,101 +539,207 @@ class Cache(threading.Thread):
                     result.append(n)
         return result
 
-    def _update_entry(self, path, owner_data=None):
+    def _update_entry(self, path, owner_data=None, creation_time=None):
+        # Can be called from any thread, see _flush()
         self._ensure_in_cache(path)
 
-        if os.path.isdir(path):
-            kind = "directory"
-            size = 0
-            for root, _, files in os.walk(path):
-                for f in files:
-                    size += os.path.getsize(os.path.join(root, f))
+        kind, size = self._entry_size(path)
+
+        owner_data = json.dumps(owner_data, default=default_serialiser)
+        # Used by the cost-aware eviction policy
+        extra = None if creation_time is None else json.dumps(dict(creation_time=creation_time))
+
+        self._ensure_table()
+        with self._lock:
+            self._updates[path] = (size, kind, owner_data, extra)
+            entry = self._table.get(path) if self._table is not None else None
+            if entry is not None:
+                self._resize(entry, size)
+                entry[1] = owner_data
+            wake_up = self._changed()
+
+        if wake_up:
+            self._wake_up()
+
+    def _entry_size(self, path):
+        """Returns the kind and size of a cache entry. For each directory, the total size of the
+        files it directly contains is remembered with its modification time, so only the
+        directories that have changed are scanned again, although all of them are checked.
+        Files are not expected to change once they are in the cache."""
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            return "file", st.st_size
+        return "directory", self._directory_size(path, st, self._directory_sizes.setdefault(path, {}))
+
+    def _directory_size(self, path, st, sizes):
+        # The modification time of a directory only changes with its own entries,
+        # so the sub-directories are always checked
+        known = sizes.get(path)
+        if known is not None and known[0] == st.st_mtime_ns:
+            _, size, directories = known
         else:
-            kind = "file"
-            size = os.path.getsize(path)
+            size = 0
+            directories = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    else:
+                        size += entry.stat().st_size
+            sizes[path] = (st.st_mtime_ns, size, directories)
 
-        with self.connection as db:
-            db.execute(
-                "UPDATE cache SET size=?, type=?, owner_data=? WHERE path=?",
-                (
-                    size,
-                    kind,
-                    json.dumps(owner_data, default=default_serialiser),
-                    path,
-                ),
-            )
+        for directory in directories:
+            size += self._directory_size(directory, os.stat(directory, follow_symlinks=False), sizes)
+
+        return size
 
     def _update_cache(self, clean=False):
         """Update cache size and size of each file in the database ."""
+        for _ in self._update_cache_steps(clean):
+            pass
+
+    def _update_cache_steps(self, clean=False):
+        self._flush()
+        self._ensure_table()
         with self.connection as db:
-            update = []
-            commit = False
-            for n in db.execute("SELECT path FROM cache WHERE size IS NULL"):
-                try:
-                    path = n[0]
-                    if os.path.isdir(path):
-                        kind = "directory"
-                        size = 0
-                        for root, _, files in os.walk(path):
-                            for f in files:
-                                size += os.path.getsize(os.path.join(root, f))
-                    else:
-                        kind = "file"
-                        size = os.path.getsize(path)
-                    update.append((size, kind, path))
-                except Exception:
-                    if clean:
-                        db.execute("DELETE from cache WHERE path=?", (path,))
-                        commit = True
+            missing = db.execute("SELECT path FROM cache WHERE size IS NULL").fetchall()
+
+        update = []
+        delete = []
+        for i, (path,) in enumerate(missing):
+            try:
+                kind, size = self._entry_size(path)
+                update.append((size, kind, path))
+            except Exception:
+                if clean:
+                    delete.append((path,))
+
+            if i % self.HOUSEKEEPING_STEP == 0:
+                yield
 
-            if update:
-                db.executemany("UPDATE cache SET size=?, type=? WHERE path=?", update)
+        if not (update or delete):
+            return
+
+        # Entries may have been deleted while this was interrupted, so only the rows
+        # that still exist are updated
+        with self.connection as db:
+            db.executemany("UPDATE cache SET size=?, type=? WHERE path=?", update)
+            db.executemany("DELETE from cache WHERE path=?", delete)
 
-            if update or commit:
-                db.commit()
+        with self._lock:
+            for size, _, path in update:
+                entry = self._table.get(path) if self._table is not None else None
+                if entry is not None:
+                    self._resize(entry, size)
+
+        for (path,) in delete:
+            self._forget(path)
 
     def _housekeeping(self, clean=False):
+        # Interrupt the background housekeeping, if any, and start again from scratch
+        self._housekeeper = None
+        for _ in self._housekeeping_steps(clean):
+            pass
+        self._last_housekeeping = time.monotonic()
+
+    def _housekeeping_steps(self, clean=False):
+        """Register the files of the cache directory that are not in the database as orphans,
+        and update the sizes of the entries. This is a generator that yields regularly, so
+        the housekeeping can be done in the background, see _background_housekeeping()."""
         top = SETTINGS.get("cache-directory")
-        with self.connection as db:
-            for name in os.listdir(top):
-                if name == CACHE_DB:
-                    continue
+        self._flush()
+        self._ensure_table()
+
+        # A snapshot of the cache directory, os.scandir() gives us the stat data for free on most systems,
+        # and only keep the files that are not in the in-memory table
+        snapshot = []
+        with os.scandir(top) as it:
+            for i, entry in enumerate(it):
+                if not entry.name.startswith(CACHE_DB) and entry.path not in self._table:
+                    snapshot.append(entry)
+                if i % self.HOUSEKEEPING_STEP == 0:
+                    yield
+
+        known = set()
+        parents = defaultdict(list)
+        if snapshot:
+            # The database may have been updated by other processes
+            with self.connection as db:
+                for path, parent in db.execute("SELECT path, parent FROM cache"):
+                    known.add(path)
+                    if parent is None:
+                        parents[os.path.basename(path).split(".")[0]].append(path)
+            yield
+
+        now = time.time()
+        for i, entry in enumerate(snapshot):
+            if i % self.HOUSEKEEPING_STEP == 0:
+                yield
 
-                full = os.path.join(top, name)
-                count = db.execute("SELECT count(*) FROM cache WHERE path=?", (full,)).fetchone()[0]
+            full = entry.path
+            if full in known or full in self._table:
+                continue
 
-                if count > 0:
+            try:
+                if now - entry.stat().st_mtime < 120:  # Two minutes
                     continue
+            except OSError:
+                # Deleted since the snapshot
+                continue
 
-                parent = None
-                start = full.split(".")[0] + "%"
-                for n in db.execute(
-                    "SELECT path FROM cache WHERE parent IS NULL and path LIKE ?",
-                    (start,),
-                ).fetchall():
-                    if full.startswith(n["path"]):
-                        parent = n["path"]
-                        break
+            parent = None
+            for n in parents.get(entry.name.split(".")[0], []):
+                if full.startswith(n):
+                    parent = n
+                    break
 
-                try:
-                    s = os.stat(full)
-                    if time.time() - s.st_mtime < 120:  # Two minutes
-                        continue
-                except OSError:
-                    pass
+            if parent is None:
+                LOG.warning(f"CliMetLab cache: orphan found: {full}")
+            else:
+                LOG.debug(f"CliMetLab cache: orphan found: {full} with parent {parent}")
 
-                if parent is None:
-                    LOG.warning(f"CliMetLab cache: orphan found: {full}")
-                else:
-                    LOG.debug(f"CliMetLab cache: orphan found: {full} with parent {parent}")
+            self._register_cache_file(
+                full,
+                "orphans",
+                None,
+                parent,
+            )
 
-                self._register_cache_file(
-                    full,
-                    "orphans",
-                    None,
-                    parent,
-                )
-        self._update_cache(clean=clean)
+        yield from self._update_cache_steps(clean=clean)
+
+    def _housekeeping_delay(self):
+        """Time to wait before the next background housekeeping step, or None if there is none."""
+        if self._housekeeper is not None:
+            return 0
+        interval = SETTINGS.get("cache-housekeeping-interval")
+        if interval is None:
+            return None
+        return self._last_housekeeping + interval - time.monotonic()
+
+    def _background_housekeeping(self):
+        # Called by the cache thread when there are no pending requests. Each call spends
+        # at most cache-housekeeping-budget seconds, the next one carries on where it stopped.
+        delay = self._housekeeping_delay()
+        if delay is None or delay > 0:
+            return
+
+        if self._housekeeper is None:
+            self._housekeeper = self._housekeeping_steps()
+
+        start = time.monotonic()
+        end = start + SETTINGS.get("cache-housekeeping-budget")
+        finished = True
+        for _ in self._housekeeper:
+            if time.monotonic() >= end:
+                finished = False
+                break
+
+        if finished:
+            self._housekeeper = None
+            self._last_housekeeping = time.monotonic()
+
+        with self._lock:
+            self._metrics.housekeeping(time.monotonic() - start, finished)
 
     def _delete_file(self, path):
         self._ensure_in_cache(path)
@@ -419,6 +805,7 @@ class Cache(threading.Thread):
             LOG.warning(f"cache file lost: {path}")
             with self.connection as db:
                 db.execute("DELETE FROM cache WHERE path=?", (path,))
+            self._forget(path)
             return total
 
         try:
@@ -434,18 +821,36 @@ class Cache(threading.Thread):
 
         with self.connection as db:
             db.execute("DELETE FROM cache WHERE path=?", (path,))
+        self._forget(path)
 
         return total + size
 
-    def _decache(self, bytes, purge=False):
+    def _decache(self, bytes, purge=False, owner=None):
         # _find_orphans()
         # _update_cache(clean=True)
 
         if bytes <= 0:
             return 0
 
-        LOG.warning("CliMetLab cache: trying to free %s", humanize.bytes(bytes))
+        if owner is None:
+            LOG.warning("CliMetLab cache: trying to free %s", humanize.bytes(bytes))
+        else:
+            LOG.warning("CliMetLab cache: trying to free %s of '%s' entries", humanize.bytes(bytes), owner)
+
+        self._ensure_table()
+        name = SETTINGS.get("cache-eviction-policy")
+        policy = eviction_policy(name, self._clocks.get(name, 0.0))
+        # Other threads may have registered files since the last flush
+        self._flush()
+        try:
+            return self._decache_entries(bytes, purge, owner, policy)
+        finally:
+            with self._lock:
+                self._clocks[policy.name] = policy.clock
+            with self.connection as db:
+                db.execute("INSERT OR REPLACE INTO eviction(policy, clock) VALUES(?,?)", (policy.name, policy.clock))
 
+    def _decache_entries(self, bytes, purge, owner, policy):
         total = 0
 
         with self.connection as db:
@@ -454,12 +859,20 @@ class Cache(threading.Thread):
             age = age.days * 24 * 3600 + age.seconds
             LOG.warning(f"Decaching files oldest than {latest.isoformat()} (age: {humanize.seconds(age)})")
 
-            for stmt in (
-                "SELECT * FROM cache WHERE size IS NOT NULL AND owner='orphans' AND creation_date < ?",
-                "SELECT * FROM cache WHERE size IS NOT NULL AND creation_date < ? ORDER BY last_access ASC",
-            ):
-                for entry in db.execute(stmt, (latest,)):
+            if owner is None:
+                queries = (
+                    ("SELECT * FROM cache WHERE size IS NOT NULL AND owner='orphans' AND creation_date < ?", (latest,)),
+                    ("SELECT * FROM cache WHERE size IS NOT NULL AND creation_date < ?", (latest,)),
+                )
+            else:
+                queries = (
+                    ("SELECT * FROM cache WHERE size IS NOT NULL AND owner=? AND creation_date < ?", (owner, latest)),
+                )
+
+            for stmt, params in queries:
+                for entry in policy.order(db.execute(stmt, params).fetchall()):
                     total += self._delete_entry(entry)
+                    policy.evicted(Usage.from_entry(entry))
                     if total >= bytes:
                         LOG.warning(
                             "CliMetLab cache: freed %s from cache",
@@ -483,65 +896,122 @@ class Cache(threading.Thread):
 
         Returns
         -------
-        changes :
-            None or False if database does not need to be updated. TODO: clarify.
+        record : dict
+            The path, owner, size and owner_data (as a json string) of the entry.
+
+        The entry is registered in the in-memory table, and will be written to
+        the database later, see _flush(). This can be called from any thread.
         """
 
         self._ensure_in_cache(path)
 
-        with self.connection as db:
-            now = datetime.datetime.now()
+        now = datetime.datetime.now()
+        args = json.dumps(args, default=default_serialiser)
 
-            args = json.dumps(args, default=default_serialiser)
+        while True:
+            self._ensure_table()
+            with self._lock:
+                if self._table is None:
+                    # The cache directory has just changed
+                    continue
+                known = path in self._table
 
-            db.execute(
-                """
-                UPDATE cache
-                SET accesses    = accesses + 1,
-                    last_access = ?
-                WHERE path=?""",
-                (now, path),
-            )
+            row = None
+            if not known:
+                # The entry may have been created by another process since the table was loaded
+                if threading.current_thread() is self:
+                    row = self._database_entry(path)
+                else:
+                    row = self.enqueue(self._database_entry, path).result()
 
-            changes = db.execute("SELECT changes()").fetchone()[0]
-
-            if not changes:
-                db.execute(
-                    """
-                    INSERT INTO cache(
-                                    path,
-                                    owner,
-                                    args,
-                                    creation_date,
-                                    last_access,
-                                    accesses,
-                                    parent)
-                    VALUES(?,?,?,?,?,?,?)""",
-                    (path, owner, args, now, now, 1, parent),
-                )
+            with self._lock:
+                if self._table is None:
+                    continue
 
-            return dict(db.execute("SELECT * FROM cache WHERE path=?", (path,)).fetchone())
+                entry = self._table.get(path)
+                if entry is None and row is not None:
+                    entry = self._table[path] = [None, row["owner_data"], row["owner"]]
+                    self._resize(entry, row["size"])
+                if entry is None:
+                    entry = self._table[path] = [None, None, owner]
+                    self._inserts[path] = (owner, args, now, parent)
+
+                count, _, _ = self._accesses.get(path, (0, None, None))
+                clock = self._clocks.get(SETTINGS.get("cache-eviction-policy"), 0.0)
+                self._accesses[path] = (count + 1, now, clock)
+
+                record = dict(path=path, owner=owner, size=entry[0], owner_data=entry[1])
+                wake_up = self._changed()
+
+            if wake_up:
+                self._wake_up()
+
+            return record
+
+    def _database_entry(self, path):
+        with self.connection as db:
+            return db.execute("SELECT size, owner_data, owner FROM cache WHERE path=?", (path,)).fetchone()
 
     def _cache_size(self):
+        # Also called to resynchronise the running total with the database,
+        # which may have been changed by other processes
+        self._flush()
         with self.connection as db:
             size = db.execute("SELECT SUM(size) FROM cache").fetchone()[0]
             if size is None:
                 size = 0
-            return size
+        with self._lock:
+            self._total_size = size
+        return size
 
     def _decache_file(self, path):
         self._delete_entry(path)
 
+    def _owner_size(self, owner):
+        self._flush()
+        with self.connection as db:
+            size = db.execute("SELECT SUM(size) FROM cache WHERE owner=?", (owner,)).fetchone()[0]
+            if size is None:
+                size = 0
+        with self._lock:
+            self._owner_sizes[owner] = size
+        return size
+
+    def _resync_sizes(self):
+        # The running totals only count the changes made by this process. PRAGMA data_version
+        # changes when other processes write to the database, the totals are then read again.
+        self._flush()
+        with self.connection as db:
+            (version,) = db.execute("PRAGMA data_version").fetchone()
+            if version == self._data_version:
+                return
+            sizes = db.execute("SELECT owner, SUM(size) FROM cache GROUP BY owner").fetchall()
+
+        with self._lock:
+            self._data_version = version
+            self._owner_sizes = defaultdict(int, {owner: size or 0 for owner, size in sizes})
+            self._total_size = sum(self._owner_sizes.values())
+
     def _check_cache_size(self):
-        # Check absolute limit
-        size = self._cache_size()
+        self._ensure_table()
+        self._resync_sizes()
+
+        # Check the quotas of the owners, using the running totals first
+        for owner, quota in SETTINGS.get("cache-owner-quotas").items():
+            if self._owner_sizes.get(owner, 0) > quota:
+                size = self._owner_size(owner)
+                if size > quota:
+                    self._decache(size - quota, owner=owner)
+
+        # Check absolute limit, using the running total first
         maximum = SETTINGS.get("maximum-cache-size")
-        if maximum is not None and size > maximum:
-            self._housekeeping()
-            self._decache(size - maximum)
+        if maximum is not None and self._total_size > maximum:
+            size = self._cache_size()
+            if size > maximum:
+                self._housekeeping()
+                self._decache(size - maximum)
 
         # Check relative limit
-        size = self._cache_size()
         usage = SETTINGS.get("maximum-cache-disk-usage")
         cache_directory = SETTINGS.get("cache-directory")
         df = disk_usage(cache_directory)
@@ -561,6 +1031,7 @@ class Cache(threading.Thread):
         """
 
         html = [css("table")]
+        self.enqueue(self._flush).result()
         with self.new_connection() as db:
             for n in db.execute("SELECT * FROM cache"):
                 n = dict(n)
@@ -606,17 +1077,29 @@ CACHE.start()
 
 dump_cache_database = in_executor(CACHE._dump_cache_database)
 summary_dump_cache_database = in_executor(CACHE._summary_dump_cache_database)
-register_cache_file = in_executor(CACHE._register_cache_file)
-update_entry = in_executor(CACHE._update_entry)
+# These do not need to go through the cache thread
+register_cache_file = CACHE._register_cache_file
+update_entry = CACHE._update_entry
+file_in_cache_directory = CACHE._file_in_cache_directory
+cache_directory = CACHE._cache_directory
+cache_metrics = CACHE.metrics
+
 check_cache_size = in_executor_forget(CACHE._check_cache_size)
 cache_size = in_executor(CACHE._cache_size)
 cache_entries = in_executor(CACHE._cache_entries)
 purge_cache = in_executor(CACHE._purge_cache)
 housekeeping = in_executor(CACHE._housekeeping)
 decache_file = in_executor(CACHE._decache_file)
-file_in_cache_directory = in_executor(CACHE._file_in_cache_directory)
 settings_changed = in_executor(CACHE._settings_changed)
-cache_directory = in_executor(CACHE._cache_directory)
+flush_cache = in_executor(CACHE._flush)
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        CACHE.enqueue(CACHE._flush).result(timeout=10)
+    except Exception as e:
+        LOG.warning("Cannot update the cache database: %s", e)
 
 
 def cache_file(
@@ -629,7 +1112,8 @@ def cache_file(
     replace=None,
 ):
     """Creates a cache file in the climetlab cache-directory (defined in the :py:class:`Settings`).
-    Uses :py:func:`_register_cache_file()`
+    Uses :py:func:`_register_cache_file()`. Files found in one of the shared-cache-directories
+    are used instead of being created, see :py:func:`shared_cache_file()`.
 
     Parameters
     ----------
@@ -665,6 +1149,30 @@ def cache_file(
         ),
     )
 
+    staged = None
+    if force is not True and not os.path.exists(path):
+        shared = shared_cache_file(path)
+        if shared is not None:
+            known, shared_data = shared_owner_data(shared)
+            # Shared files are only used if we can tell that they are up to date
+            if callable(force) and (not known or force(args, shared, shared_data)):
+                shared = None
+
+        if shared is not None:
+            if not _promote(shared):
+                staged = _stage_link(shared, path)
+                if staged is None:
+                    return shared
+
+            def create(target, args):
+                if staged is not None:
+                    os.rename(staged, target)
+                    how = "link"
+                else:
+                    how = _link_or_copy(shared, target)
+                LOG.debug("Promoting %s to %s (%s)", shared, target, how)
+                return shared_data
+
     try:
         record = register_cache_file(path, owner, args)
         if os.path.exists(path):
@@ -684,11 +1192,13 @@ def cache_file(
 
         with FileLock(lock):
             if not os.path.exists(path):  # Check again, another thread/process may have created the file
+                start = time.monotonic()
                 owner_data = create(path + ".tmp", args)
+                creation_time = time.monotonic() - start
 
                 os.rename(path + ".tmp", path)
 
-                update_entry(path, owner_data)
+                update_entry(path, owner_data, creation_time)
 
                 check_cache_size()
 
@@ -697,9 +1207,183 @@ def cache_file(
         except OSError:
             pass
 
+    if staged is not None and os.path.exists(staged):
+        # The file was created by another thread or process
+        os.unlink(staged)
+
     return path
 
 
+_SHARED_ACCESSES = Counter()
+_SHARED_LOCK = threading.Lock()
+# Read-only connections to the databases of the shared directories
+_SHARED_DATABASES = {}
+# Owner data of the shared files found in these databases, by path and mtime
+_SHARED_OWNER_DATA = LRU(1024)
+
+
+def shared_cache_file(path):
+    """Returns the copy of the cache file `path` found in the first of the ``shared-cache-directories``
+    that has one, or None. These directories are read-only, and can be populated with
+    ``climetlab export-cache``."""
+    name = os.path.basename(path)
+    local = os.path.realpath(os.path.dirname(path))
+    for directory in SETTINGS.get("shared-cache-directories"):
+        if os.path.realpath(directory) == local:
+            continue
+        shared = os.path.join(directory, name)
+        if os.path.exists(shared):
+            return shared
+    return None
+
+
+def _shared_database(directory):
+    # Returns a read-only connection to the database of the shared `directory`, and the
+    # directory found in the paths it records, which may be mounted elsewhere than where
+    # the database was written. Must be called with _SHARED_LOCK held.
+    db = os.path.join(directory, CACHE_DB)
+    inode = os.stat(db).st_ino
+
+    known = _SHARED_DATABASES.get(directory)
+    if known is not None and known[0] != inode:
+        # The database has been replaced
+        known[1].close()
+        known = None
+
+    if known is None:
+        connection = sqlite3.connect(pathlib.Path(db).as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        known = _SHARED_DATABASES[directory] = [inode, connection, None]
+
+    if known[2] is None:
+        row = known[1].execute("SELECT path FROM cache LIMIT 1").fetchone()
+        if row is not None:
+            known[2] = os.path.dirname(row[0])
+
+    return known[1], known[2]
+
+
+def shared_owner_data(shared):
+    """Returns whether the cache file `shared` is recorded in the cache database of its shared
+    directory, and its owner data (e.g. the HTTP headers of a downloaded file)."""
+    try:
+        key = (shared, os.stat(shared).st_mtime_ns)
+    except OSError:
+        return False, None
+
+    with _SHARED_LOCK:
+        owner_data = _SHARED_OWNER_DATA.get(key)
+        if owner_data is None:
+            directory, name = os.path.split(shared)
+            try:
+                connection, recorded = _shared_database(directory)
+                if recorded is None:
+                    return False, None
+                row = connection.execute(
+                    "SELECT owner_data FROM cache WHERE path=?",
+                    (os.path.join(recorded, name),),
+                ).fetchone()
+            except (OSError, sqlite3.Error) as e:
+                LOG.debug("Cannot read the cache database of %s: %s", directory, e)
+                return False, None
+
+            if row is None:
+                # Not memoised, the file may be recorded later
+                return False, None
+
+            # Kept as JSON, so that callers cannot modify the memoised value
+            owner_data = _SHARED_OWNER_DATA[key] = "null" if row[0] is None else row[0]
+
+    return True, json.loads(owner_data)
+
+
+def export_cache_entries(directory, entries):
+    """Record the cache `entries`, as returned by ``dump_cache_database()``, that have
+    been copied to `directory`, so it can be used as one of the ``shared-cache-directories``."""
+    connection = sqlite3.connect(os.path.join(directory, CACHE_DB))
+    try:
+        _create_cache_table(connection)
+        with connection:
+            for entry in entries:
+                entry = dict(entry)
+                entry["path"] = os.path.join(directory, os.path.basename(entry["path"]))
+                for k in ("args", "owner_data"):
+                    if entry.get(k) is not None:
+                        entry[k] = json.dumps(entry[k], default=default_serialiser)
+                columns = ",".join(entry.keys())
+                values = ",".join("?" for _ in entry)
+                connection.execute(
+                    f"INSERT OR REPLACE INTO cache({columns}) VALUES({values})",
+                    tuple(entry.values()),
+                )
+    finally:
+        connection.close()
+
+
+def _promote(shared):
+    # Returns True if the shared file has been accessed often enough by
+    # this process to be copied into the cache directory
+    with _SHARED_LOCK:
+        _SHARED_ACCESSES[shared] += 1
+        return _SHARED_ACCESSES[shared] >= SETTINGS.get("shared-cache-promotion")
+
+
+def _stage_link(shared, path):
+    # Files that can be linked or cloned are promoted straight away, so they are linked
+    # next to `path` first. Returns None if this is not possible.
+    if os.path.isdir(shared):
+        return None
+    staged = f"{path}.{os.getpid()}.{threading.get_ident()}.shared"
+    try:
+        _link(shared, staged)
+    except OSError:
+        return None
+    return staged
+
+
+def _reflink(source, target):
+    if platform.system() != "Linux":
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are only supported on Linux", target)
+
+    import fcntl
+
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(target):
+            os.unlink(target)
+        raise
+    shutil.copystat(source, target)
+
+
+def _link_or_copy(source, target):
+    """Create `target` as a hard link to `source`, or as a copy-on-write clone if it cannot be
+    linked, or as a copy if neither is supported. Returns how the target was created."""
+    if os.path.isdir(source):
+        shutil.copytree(source, target, copy_function=_link_or_copy)
+        return "tree"
+
+    try:
+        return _link(source, target)
+    except OSError:
+        pass
+
+    shutil.copy2(source, target)
+    return "copy"
+
+
+def _link(source, target):
+    # Hard link or copy-on-write clone, raises OSError if neither is supported
+    try:
+        os.link(source, target)
+        return "link"
+    except OSError:
+        pass
+
+    _reflink(source, target)
+    return "reflink"
+
+
 def auxiliary_cache_file(
     owner,
     path,
@@ -0,0 +1,278 @@
+# (C) Copyright 2020 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+"""Policies used to select the cache entries to delete when the cache is full,
+and a simulator to compare them on the content of the cache database."""
+
+import datetime
+import heapq
+import json
+import logging
+from collections import defaultdict
+
+LOG = logging.getLogger(__name__)
+
+# Cost (in seconds) of the entries for which the creation time is unknown
+DEFAULT_COST = 1.0
+
+
+def _timestamp(value):
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def _extra(entry, name):
+    extra = entry.get("extra")
+    if isinstance(extra, str):
+        try:
+            extra = json.loads(extra)
+        except ValueError:
+            return None
+    if isinstance(extra, dict):
+        return extra.get(name)
+    return None
+
+
+def creation_time(entry):
+    """Returns the time it took to create a cache entry, as recorded in the
+    ``extra`` column of the cache database, or None if it is not known."""
+    return _extra(entry, "creation_time")
+
+
+class Usage:
+    """The statistics of a cache entry used by the eviction policies."""
+
+    __slots__ = ("path", "owner", "size", "accesses", "last_access", "cost", "clock")
+
+    def __init__(self, path, owner, size, accesses, last_access, cost, clock=0.0):
+        self.path = path
+        self.owner = owner
+        self.size = size
+        self.accesses = accesses
+        self.last_access = last_access
+        self.cost = cost
+        # Clock of the policy when the entry was last accessed, see GDSF
+        self.clock = clock
+
+    @classmethod
+    def from_entry(cls, entry):
+        entry = dict(entry)
+        cost = creation_time(entry)
+        return cls(
+            path=entry["path"],
+            owner=entry["owner"],
+            size=entry["size"] or 0,
+            accesses=entry["accesses"] or 0,
+            last_access=_timestamp(entry["last_access"]),
+            cost=DEFAULT_COST if cost is None else cost,
+            clock=_extra(entry, "clock") or 0.0,
+        )
+
+
+class EvictionPolicy:
+    """Entries with the lowest priority are deleted first. The priority of an
+    entry only depends on its own statistics and on the clock of the policy when it
+    was last accessed, so it only changes when the entry is accessed."""
+
+    name = None
+
+    def __init__(self, clock=0.0):
+        self.clock = clock
+
+    def priority(self, usage):
+        raise NotImplementedError()
+
+    def evicted(self, usage):
+        """Called when an entry is deleted, to update the clock of the policy."""
+        pass
+
+    def order(self, entries):
+        """Sort rows of the cache database, in the order they should be deleted."""
+        return sorted(entries, key=lambda e: self.priority(Usage.from_entry(e)))
+
+
+class LRU(EvictionPolicy):
+    """Least recently used entries first."""
+
+    name = "lru"
+
+    def priority(self, usage):
+        return (usage.last_access,)
+
+
+class LFU(EvictionPolicy):
+    """Least frequently used entries first, then least recently used."""
+
+    name = "lfu"
+
+    def priority(self, usage):
+        return (usage.accesses, usage.last_access)
+
+
+class GDSF(EvictionPolicy):
+    """Greedy-Dual-Size-Frequency: the least frequently used entries per byte first,
+    so a single large file is deleted before many small ones.
+
+    The clock L is the priority of the last deleted entry, and is added to the priority
+    of the entries when they are accessed, so that entries that were once used a lot,
+    but are not used anymore, end up being deleted."""
+
+    name = "gdsf"
+
+    def value(self, usage):
+        return usage.accesses / max(usage.size, 1)
+
+    def priority(self, usage):
+        return (usage.clock + self.value(usage), usage.last_access)
+
+    def evicted(self, usage):
+        self.clock = max(self.clock, self.priority(usage)[0])
+
+
+class CostAware(GDSF):
+    """Like GDSF, but each access is weighted by the time it took to create the
+    entry, so entries that are expensive to rebuild are kept longer."""
+
+    name = "cost"
+
+    def value(self, usage):
+        return usage.accesses * usage.cost / max(usage.size, 1)
+
+
+POLICIES = {p.name: p for p in (LRU, LFU, GDSF, CostAware)}
+
+
+def eviction_policy(name, clock=0.0):
+    if name not in POLICIES:
+        raise ValueError(f"Unknown cache eviction policy '{name}', possible values are {sorted(POLICIES)}")
+    return POLICIES[name](clock)
+
+
+def _trace(entries):
+    # The database only records the first and last accesses, and the number of
+    # accesses, so the accesses in between are spread uniformly.
+    for entry in entries:
+        if entry["size"] is None:
+            continue
+        first = _timestamp(entry["creation_date"])
+        last = max(first, _timestamp(entry["last_access"]))
+        n = max(entry["accesses"] or 0, 1)
+        for i in range(n):
+            yield (first + (last - first) * i / (n - 1) if n > 1 else first, entry["path"])
+
+
+def simulate(entries, capacity, policy, quotas=None):
+    """Replay the accesses to the cache entries, as reconstructed from the cache database,
+    in a cache of size `capacity` managed with `policy`.
+
+    Parameters
+    ----------
+    entries : list of dict
+        Rows of the cache database, as returned by ``dump_cache_database()``.
+    capacity : int
+        Size of the simulated cache, in bytes.
+    policy : str or EvictionPolicy
+        Eviction policy to simulate.
+    quotas : dict, optional
+        Maximum size of the entries of each owner, in bytes.
+
+    Returns
+    -------
+    dict
+        The numbers of requests, hits and evictions, the hit rates (on the number of
+        requests and on the number of bytes), and the total creation time of the misses.
+    """
+    # Start with a fresh clock
+    policy = eviction_policy(policy if isinstance(policy, str) else policy.name)
+    quotas = quotas or {}
+
+    usages = {e["path"]: Usage.from_entry(e) for e in entries}
+
+    resident = {}  # path -> version
+    total = 0
+    owner_totals = defaultdict(int)
+    # Priority queues with lazy deletion, one for the whole cache and one per owner with a quota
+    heaps = defaultdict(list)
+    version = 0
+
+    requests = hits = evictions = 0
+    requested_bytes = hit_bytes = 0
+    miss_cost = 0.0
+
+    def push(usage):
+        nonlocal version
+        version += 1
+        resident[usage.path] = version
+        item = (policy.priority(usage), version, usage.path)
+        heapq.heappush(heaps[None], item)
+        if usage.owner in quotas:
+            heapq.heappush(heaps[usage.owner], item)
+
+    def evict(heap):
+        nonlocal total, evictions
+        while heap:
+            _, v, path = heapq.heappop(heap)
+            if resident.get(path) == v:
+                del resident[path]
+                usage = usages[path]
+                policy.evicted(usage)
+                total -= usage.size
+                owner_totals[usage.owner] -= usage.size
+                evictions += 1
+                return True
+        return False
+
+    for when, path in sorted(_trace(entries)):
+        usage = usages[path]
+        requests += 1
+        requested_bytes += usage.size
+
+        if path in resident:
+            hits += 1
+            hit_bytes += usage.size
+            usage.accesses += 1
+            usage.last_access = when
+            usage.clock = policy.clock
+            push(usage)
+            continue
+
+        miss_cost += usage.cost
+        usage.accesses = 1
+        usage.last_access = when
+        usage.clock = policy.clock
+
+        quota = quotas.get(usage.owner)
+        if usage.size > capacity or (quota is not None and usage.size > quota):
+            continue
+
+        push(usage)
+        total += usage.size
+        owner_totals[usage.owner] += usage.size
+
+        if quota is not None:
+            while owner_totals[usage.owner] > quota and evict(heaps[usage.owner]):
+                pass
+
+        while total > capacity and evict(heaps[None]):
+            pass
+
+    return dict(
+        policy=policy.name,
+        requests=requests,
+        hits=hits,
+        evictions=evictions,
+        hit_rate=hits / requests if requests else 0.0,
+        byte_hit_rate=hit_bytes / requested_bytes if requested_bytes else 0.0,
+        miss_cost=miss_cost,
+    )
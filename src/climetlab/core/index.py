@@ -15,6 +15,7 @@ from abc import abstractmethod
 from collections import defaultdict
 
 import climetlab as cml
+from climetlab.core.order import Remapping
 from climetlab.core.order import build_remapping
 from climetlab.core.order import normalize_order_by
 from climetlab.core.select import normalize_selection
@@ -159,6 +160,23 @@ class Order(OrderBase):
         return actions
 
 
+def _is_trivial(remapping):
+    return isinstance(remapping, Remapping) and not remapping
+
+
+def _ranks(values, compare):
+    # Rank the unique values of a column according to the `compare` function,
+    # values comparing equal get the same rank
+    ordered = sorted(range(len(values)), key=functools.cmp_to_key(lambda i, j: compare(values[i], values[j])))
+    ranks = [0] * len(values)
+    rank = 0
+    for n, i in enumerate(ordered):
+        if n and compare(values[ordered[n - 1]], values[i]) != 0:
+            rank += 1
+        ranks[i] = rank
+    return ranks
+
+
 class Index(Source):
     @classmethod
     def new_mask_index(self, *args, **kwargs):
@@ -183,9 +201,21 @@ class Index(Source):
 
         selection = Selection(kwargs, remapping=remapping)
 
-        indices = (i for i, element in enumerate(self) if selection.match_element(element))
+        if not _is_trivial(selection.remapping):
+            indices = (i for i, element in enumerate(self) if selection.match_element(element))
+            return self.new_mask_index(self, indices)
 
-        return self.new_mask_index(self, indices)
+        import numpy as np
+
+        # Evaluate the selection on the unique values of each column only
+        columns = self._encoded_metadata(list(selection.actions.keys()))
+        mask = np.ones(len(self), dtype=bool)
+        for k, action in selection.actions.items():
+            values, codes = columns[k]
+            match = np.array([bool(action(v)) for v in values], dtype=bool)
+            mask &= match[codes]
+
+        return self.new_mask_index(self, np.flatnonzero(mask).tolist())
 
     def order_by(self, *args, remapping=None, patches=None, **kwargs):
         """Default order_by method.
@@ -205,12 +235,47 @@ class Index(Source):
 
         order = Order(kwargs, remapping=remapping)
 
-        def cmp(i, j):
-            return order.compare_elements(self[i], self[j])
+        if not _is_trivial(remapping):
 
-        indices = list(range(len(self)))
-        indices = sorted(indices, key=functools.cmp_to_key(cmp))
-        return self.new_mask_index(self, indices)
+            def cmp(i, j):
+                return order.compare_elements(self[i], self[j])
+
+            indices = list(range(len(self)))
+            indices = sorted(indices, key=functools.cmp_to_key(cmp))
+            return self.new_mask_index(self, indices)
+
+        import numpy as np
+
+        # Rank the unique values of each column, then sort the elements on their ranks.
+        # np.lexsort is stable and uses the last key as the primary key.
+        columns = self._encoded_metadata(list(order.actions.keys()))
+        keys = []
+        for k, action in order.actions.items():
+            values, codes = columns[k]
+            keys.append(np.array(_ranks(values, action), dtype=np.int64)[codes])
+
+        indices = np.lexsort(keys[::-1]) if keys else np.arange(len(self))
+        return self.new_mask_index(self, indices.tolist())
+
+    def _encoded_metadata(self, keys):
+        """Returns a dictionary of dictionary-encoded metadata columns for `keys`:
+        each column is a tuple (values, codes), where `values` is the list of unique
+        values and `codes` a NumPy array with the position in `values` of the value
+        of each element.
+        """
+        import numpy as np
+
+        table = self.metadata_table(*keys)
+
+        result = {}
+        for k in keys:
+            column = table[k].tolist()
+            positions = {}
+            for v in column:
+                positions.setdefault(v, len(positions))
+            codes = np.fromiter((positions[v] for v in column), dtype=np.int64, count=len(column))
+            result[k] = (list(positions.keys()), codes)
+        return result
 
     def __getitem__(self, n):
         if isinstance(n, slice):
@@ -242,15 +307,64 @@ class Index(Source):
         assert all(isinstance(_, Index) for _ in sources)
         return MultiIndex(sources)
 
-    def to_numpy(self, *args, **kwargs):
+    def to_numpy(self, *args, out=None, dtype=None, nthreads=1, **kwargs):
+        """Decode all elements into a single array of shape (len(self), *field_shape).
+
+        The array is allocated once, when the shape of the first element is known,
+        and each element is copied into its own slot. A preallocated array can be
+        provided with `out`, and `nthreads` > 1 decodes the elements in a pool of threads.
+        Other arguments are passed to the `to_numpy()` method of each element.
+        """
         import numpy as np
 
-        return np.array([f.to_numpy(*args, **kwargs) for f in self])
+        from climetlab.core.thread import SoftThreadPool
+
+        n = len(self)
+        if n == 0:
+            if out is not None:
+                return out
+            return np.array([], dtype=dtype)
+
+        first = self[0].to_numpy(*args, **kwargs)
+        shape = (n,) + first.shape
+
+        if out is None:
+            result = out = np.empty(shape, dtype=first.dtype if dtype is None else dtype)
+        else:
+            result = out
+            out = out.reshape(shape)
+            if not np.may_share_memory(out, result):
+                raise ValueError(f"Cannot decode into a non-contiguous array of shape {result.shape}")
+
+        out[0] = first
+        del first
+
+        def decode(i):
+            values = self[i].to_numpy(*args, **kwargs)
+            if values.shape != shape[1:]:
+                raise ValueError(f"Element {i} has shape {values.shape}, expected {shape[1:]}")
+            out[i] = values
+
+        nthreads = min(nthreads, n - 1)
+        if nthreads < 2:
+            for i in range(1, n):
+                decode(i)
+            return result
+
+        with SoftThreadPool(nthreads=nthreads) as pool:
+            futures = [pool.submit(decode, i) for i in range(1, n)]
+            for f in futures:
+                f.result()
+
+        return result
 
     def to_pytorch_tensor(self, *args, **kwargs):
+        import numpy as np
         import torch
 
-        return torch.Tensor(self.to_numpy(*args, **kwargs))
+        # Decode straight into a float32 array, which torch can use without a copy
+        kwargs.setdefault("dtype", np.float32)
+        return torch.from_numpy(self.to_numpy(*args, **kwargs))
 
     def full(self, *coords):
         return FullIndex(self, *coords)
@@ -271,6 +385,12 @@ class MaskIndex(Index):
     def __len__(self):
         return len(self.indices)
 
+    def _encoded_metadata(self, keys):
+        import numpy as np
+
+        indices = np.array(self.indices, dtype=np.int64)
+        return {k: (values, codes[indices]) for k, (values, codes) in self.index._encoded_metadata(keys).items()}
+
     def __repr__(self):
         return "MaskIndex(%r,len=%s)" % (self.index, len(self.indices))
 
@@ -297,6 +417,22 @@ class MultiIndex(Index):
     def __len__(self):
         return sum(len(i) for i in self.indexes)
 
+    def _encoded_metadata(self, keys):
+        import numpy as np
+
+        parts = [i._encoded_metadata(keys) for i in self.indexes]
+
+        result = {}
+        for k in keys:
+            positions = {}
+            codes = []
+            for part in parts:
+                values, part_codes = part[k]
+                remap = np.array([positions.setdefault(v, len(positions)) for v in values], dtype=np.int64)
+                codes.append(remap[part_codes])
+            result[k] = (list(positions.keys()), np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64))
+        return result
+
     def graph(self, depth=0):
         print(" " * depth, self.__class__.__name__)
         for s in self.indexes:
@@ -329,9 +465,10 @@ class FullIndex(Index):
         self.shape = shape
         self.holes = np.full(shape, False)
 
-        for f in index:
-            idx = tuple(name_to_index[k][f.metadata(k)] for k in coords)
-            self.holes[idx] = True
+        # Pass2, position of each field in the hypercube
+        table = index.metadata_table(*coords)
+        idx = tuple(np.array([name_to_index[k][v] for v in table[k].tolist()], dtype=np.int64) for k in coords)
+        self.holes[idx] = True
 
         self.holes = self.holes.flatten()
         print("+++++++++", self.holes.shape, coords, self.shape)
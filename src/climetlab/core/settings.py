@@ -112,11 +112,66 @@ SETTINGS_AND_HELP = {
         See :doc:`/guide/caching` for more information.""",
         getter="_as_percent",
     ),
+    "cache-eviction-policy": _(
+        "lru",
+        """Policy used to select the cached entries to delete when a cache limit is reached:
+        ``lru`` (least recently used), ``lfu`` (least frequently used), ``gdsf`` (least frequently
+        used per byte) or ``cost`` (like ``gdsf``, weighted by the time taken to create the entries).
+        See :doc:`/guide/caching` for more information.""",
+    ),
+    "cache-owner-quotas": _(
+        {},
+        """Maximum disk space used by the cached entries of a given owner (ex: {"url": "100G"}).
+        See :doc:`/guide/caching` for more information.""",
+        getter="_as_quotas",
+    ),
+    "shared-cache-directories": _(
+        [],
+        """List of read-only directories, shared with other users or computers, where to look for
+        cached files before creating them. Such directories can be populated with ``climetlab export-cache``.
+        See :doc:`/guide/caching` for more information.""",
+    ),
+    "shared-cache-promotion": _(
+        3,
+        """Number of accesses to a file of a shared cache directory after which it is copied into the
+        ``cache-directory``. Files that can be linked instead of copied are always promoted.""",
+    ),
+    "cache-flush-interval": _(
+        "5s",
+        """Maximum delay before the accesses to cached files are recorded in the cache database.""",
+        getter="_as_seconds",
+    ),
+    "cache-housekeeping-interval": _(
+        "1h",
+        """Interval between the background checks of the cache directory, that find the files missing
+        from the cache database. Set to ``None`` to disable.""",
+        getter="_as_seconds",
+        none_ok=True,
+    ),
+    "cache-housekeeping-budget": _(
+        "1s",
+        """Maximum time spent at once by the background checks of the cache directory. They are resumed
+        when the cache is idle.""",
+        getter="_as_seconds",
+    ),
     "url-download-timeout": _(
         "30s",
         """Timeout when downloading from an url.""",
         getter="_as_seconds",
     ),
+    "url-ranges-gap": _(
+        "1M",
+        """Byte ranges of an URL that are less than this apart are downloaded with a single request,
+        the bytes in between being discarded.""",
+        getter="_as_bytes",
+    ),
+    "url-ranges-maximum-request-size": _(
+        "8M",
+        """Byte ranges larger than this are split into several requests, downloaded in parallel
+        using up to ``number-of-download-threads`` connections.""",
+        getter="_as_bytes",
+        none_ok=True,
+    ),
     "check-out-of-date-urls": _(
         True,
         "Perform a HTTP request to check if the remote version of a cache file has changed",
@@ -342,6 +397,9 @@ class Settings:
     def _as_seconds(self, name, value, none_ok):
         return as_seconds(value, name=name, none_ok=none_ok)
 
+    def _as_quotas(self, name, value, none_ok):
+        return {k: as_bytes(v, name=f"{name}.{k}") for k, v in value.items()}
+
     # def _as_number(self, name, value, units, none_ok):
     #     return as_number(name, value, units, none_ok)
 
@@ -168,7 +168,16 @@ def ecef(lat, lon, i):
 def unstructed_to_structed(grib, chunk_size=-1):
     now = time.time()
     print("----")
-    xyz = np.array([ecef(lat, lon, i) for i, (lat, lon) in enumerate(grib.iterate_grid_points())])
+    lat, lon = grib.grid_points()
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    xyz = np.column_stack(
+        [
+            np.cos(lat) * np.cos(lon),
+            np.cos(lat) * np.sin(lon),
+            np.sin(lat),
+            np.arange(len(lat)),
+        ]
+    )
     print("----", time.time() - now)
     print(len(xyz))
 
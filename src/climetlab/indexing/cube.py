@@ -6,11 +6,16 @@
 # granted to it by virtue of its status as an intergovernmental organisation
 # nor does it submit to any jurisdiction.
 #
+import collections
 import itertools
 import logging
 import math
 import re
 
+import numpy as np
+
+from climetlab.core.thread import SoftThreadPool
+
 LOG = logging.getLogger(__name__)
 
 
@@ -209,10 +214,44 @@ class FieldCube:
         names = self._names(reading_chunks=reading_chunks, coords=self.user_coords)
         indexes = list(range(0, len(lst)) for lst in names)
 
+        # Flat index in self.source of every field, laid out like the cube,
+        # so that a cubelet's fields are a simple slice of this table
+        table = np.arange(len(self.source)).reshape(self.user_shape)
+
         return (
-            Cubelet(self, i, coords_names=n) for n, i in zip(itertools.product(*names), itertools.product(*indexes))
+            Cubelet(self, i, coords_names=n, dataset_indexes=table[i].ravel().tolist())
+            for n, i in zip(itertools.product(*names), itertools.product(*indexes))
         )
 
+    def read_cubelets(self, reading_chunks=None, nthreads=4, prefetch=None, **kwargs):
+        """Yield `(cubelet, array)` pairs in the order of `iterate_cubelets`,
+        decoding up to `prefetch` cubelets ahead in a pool of `nthreads` threads."""
+        cubelets = self.iterate_cubelets(reading_chunks=reading_chunks)
+
+        if nthreads <= 1:
+            for cubelet in cubelets:
+                yield cubelet, cubelet.to_numpy(**kwargs)
+            return
+
+        if prefetch is None:
+            prefetch = 2 * nthreads
+        prefetch = max(prefetch, 1)
+
+        # Make sure the field shape is known before decoding in parallel
+        self.field_shape
+
+        pending = collections.deque()
+        with SoftThreadPool(nthreads=nthreads) as pool:
+            for cubelet in cubelets:
+                pending.append((cubelet, pool.submit(cubelet.to_numpy, **kwargs)))
+                if len(pending) >= prefetch:
+                    cubelet, future = pending.popleft()
+                    yield cubelet, future.result()
+
+            while pending:
+                cubelet, future = pending.popleft()
+                yield cubelet, future.result()
+
     def chunking(self, chunks):
         if isinstance(chunks, (str, int)):
             m = re.match(r"(\d+)\s*(.*)?", str(chunks))
@@ -242,12 +281,13 @@ class FieldCube:
 
 
 class Cubelet:
-    def __init__(self, cube, coords, coords_names=None):
+    def __init__(self, cube, coords, coords_names=None, dataset_indexes=None):
         self._coords_names = coords_names  # only for display purposes
         self.owner = cube
         assert all(isinstance(_, int) for _ in coords), coords
         self.coords = coords
         self.flatten_values = cube.flatten_values
+        self.dataset_indexes = dataset_indexes
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.coords},index_names={self._coords_names})"
@@ -256,5 +296,19 @@ class Cubelet:
     def extended_icoords(self):
         return self.coords
 
+    @property
+    def shape(self):
+        if len(self.dataset_indexes) == 1:
+            return self.owner.field_shape
+        rest = self.owner.user_shape[len(self.coords) :]
+        return (1,) * len(self.coords) + rest + self.owner.field_shape
+
     def to_numpy(self, **kwargs):
-        return self.owner[self.coords].to_numpy(reshape=not self.flatten_values, **kwargs)
+        if self.dataset_indexes is None:
+            return self.owner[self.coords].to_numpy(reshape=not self.flatten_values, **kwargs)
+
+        source = self.owner.source
+        if len(self.dataset_indexes) == 1:
+            return source[self.dataset_indexes[0]].to_numpy(reshape=not self.flatten_values, **kwargs)
+
+        return source[tuple(self.dataset_indexes)].to_numpy(reshape=False, **kwargs).reshape(self.shape)
@@ -16,6 +16,12 @@ STATISTICS_KEY_NAMES = ["mean", "std", "min", "max", "shape"]
 MORE_KEY_NAMES_WITH_UNDERSCORE = ["_param_id"]
 MORE_KEY_NAMES = ["datetime", "param_level"]
 
+# Keys that are not used to describe the availability of a field. Note that
+# the "datetime" column is renamed "valid_datetime" in SQL databases.
+AVAILABILITY_IGNORE_KEY_NAMES = (
+    FILEPARTS_KEY_NAMES + STATISTICS_KEY_NAMES + MORE_KEY_NAMES_WITH_UNDERSCORE + MORE_KEY_NAMES + ["valid_datetime"]
+)
+
 
 class DBKey:
     cast = None
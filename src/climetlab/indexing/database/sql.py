@@ -17,6 +17,7 @@ import time
 from threading import local
 
 import numpy as np
+from lru import LRU
 
 import climetlab as cml
 from climetlab.core.order import build_remapping
@@ -50,10 +51,18 @@ def execute(connection, statement, *arg, **kwargs):
         assert False
         dump_sql(statement)
 
+    return _retry_if_locked(connection.execute, statement, *arg, **kwargs)
+
+
+def executemany(connection, statement, rows):
+    return _retry_if_locked(connection.executemany, statement, rows)
+
+
+def _retry_if_locked(method, statement, *arg, **kwargs):
     delay = 1
     while delay < 30 * 60:  # max delay 30 min
         try:
-            return connection.execute(statement, *arg, **kwargs)
+            return method(statement, *arg, **kwargs)
         except sqlite3.OperationalError as e:
             if not str(e).endswith("database is locked"):
                 raise e
@@ -109,8 +118,24 @@ def dbname_to_entryname(n):
 class EntriesLoader:
     table_name = "entries"
 
-    def __init__(self, connection):
+    def __init__(
+        self,
+        connection,
+        batch_size=10_000,
+        journal_mode=None,
+        synchronous=None,
+        cache_size=None,
+    ):
+        """
+        batch_size: number of entries inserted with each executemany().
+        journal_mode, synchronous, cache_size: values of the corresponding
+            SQLite PRAGMAs during loading. None keeps the current setting.
+        """
         self.connection = connection
+        self.batch_size = batch_size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
         self.patch()
         self.keys = self.read_from_table()
         self.path_table = PathTable(connection)
@@ -188,40 +213,87 @@ class EntriesLoader:
         name = entryname_to_dbname(k)
         return klass(name)
 
-    def load_iterator(self, iterator):
-        paths_or_urls = set()
-
-        count = 0
-        for entry in iterator:
-            if count == 0:
-                self.keys = self.create_table_from_entry_if_needed(entry)
-
-            for k, v in entry.items():
-                dbname = entryname_to_dbname(k)
-                if dbname not in self.keys:
-                    LOG.debug(f"Inserting column in databse {k}, {dbname}")
-                    self.keys = self._add_column(k, v)
+    def _insert_statement(self):
+        column_names = [k for k, v in self.keys.items()]
+        return (
+            f"INSERT INTO {self.table_name} ("
+            + ",".join(column_names)
+            + ") VALUES("
+            + ",".join(["?"] * len(column_names))
+            + ");"
+        )
 
+    def set_pragmas(self):
+        for name in ("journal_mode", "synchronous", "cache_size"):
+            value = getattr(self, name)
+            if value is not None:
+                execute(self.connection, f"PRAGMA {name}={value};")
+
+    def _add_columns(self, batch):
+        names = set()
+        for entry in batch:
+            names.update(entry.keys())
+
+        new = set(k for k in names if entryname_to_dbname(k) not in self.keys)
+        if not new:
+            return False
+
+        # Columns are added in the order the keys are first seen, the
+        # type of each column is guessed from that first value
+        for entry in batch:
+            for k in [k for k in entry if k in new]:
+                LOG.debug(f"Inserting column in databse {k}, {entryname_to_dbname(k)}")
+                self.keys = self._add_column(k, entry[k])
+                new.remove(k)
+            if not new:
+                break
+
+        return True
+
+    def _load_batch(self, batch, paths_or_urls):
+        if not self.keys:
+            self.keys = self.create_table_from_entry_if_needed(batch[0])
+
+        if self._add_columns(batch) or self._statement is None:
+            self._statement = self._insert_statement()
+            self._entrynames = [dbname_to_entryname(k) for k in self.keys]
+
+        rows = []
+        for entry in batch:
             if "_path" in entry:
                 paths_or_urls.add(entry["_path"])
             if "_url" in entry:
                 paths_or_urls.add(entry["_url"])
+            rows.append(tuple(entry.get(k) for k in self._entrynames))
 
-            column_names = [k for k, v in self.keys.items()]
-            statement = (
-                f"INSERT INTO {self.table_name} ("
-                + ",".join(column_names)
-                + ") VALUES("
-                + ",".join(["?"] * len(column_names))
-                + ");"
-            )
-            values = [entry.get(dbname_to_entryname(k)) for k, v in self.keys.items()]
-            execute(self.connection, statement, tuple(values))
+        executemany(self.connection, self._statement, rows)
+
+    def load_iterator(self, iterator, stats=None):
+        """stats: optional dictionary of (size, mtime, inode) recorded
+        in the paths table for each path loaded."""
+        paths_or_urls = set()
+        stats = stats or {}
+
+        self.set_pragmas()
+
+        # Entries are inserted by batches with executemany(), new columns
+        # are added once per batch before the batch is inserted
+        self._statement = None
+        batch = []
+        count = 0
+        for entry in iterator:
+            batch.append(entry)
             count += 1
+            if len(batch) >= self.batch_size:
+                self._load_batch(batch, paths_or_urls)
+                batch = []
+
+        if batch:
+            self._load_batch(batch, paths_or_urls)
 
         date = datetime.datetime.now().isoformat()
         for path in paths_or_urls:
-            self.path_table.insert(path, date)
+            self.path_table.insert(path, date, stats.get(path))
 
         return count
 
@@ -242,12 +314,30 @@ class EntriesLoader:
         return f"{self.__class__.__name__}({self.table_name},{content}"
 
 
+# Size of the cache of compiled queries, and of the cache of prepared
+# statements of each SQLite connection
+SQL_QUERY_CACHE_SIZE = int(os.environ.get("CLIMETLAB_SQL_QUERY_CACHE_SIZE", 1000))
+
+COMPILED_QUERIES = LRU(SQL_QUERY_CACHE_SIZE)
+
+
 class Connection(local):
     # Inheriting from threading.local allows one connection for each thread
     # __init__ is "called each time the local object is used in a separate thread".
     # https://github.com/python/cpython/blob/0346eddbe933b5f1f56151bdebf5bd49392bc275/Lib/_threading_local.py#L65
     def __init__(self, db_path):
-        self._conn = sqlite3.connect(db_path)
+        self._conn = sqlite3.connect(db_path, cached_statements=SQL_QUERY_CACHE_SIZE)
+        self._schema = (None, None)
+
+    def schema_signature(self):
+        """A hash of the schema of the database, only computed again when it has changed."""
+        ((version,),) = self._conn.execute("PRAGMA schema_version").fetchall()
+        if self._schema[0] != version:
+            m = hashlib.md5()
+            for (sql,) in self._conn.execute("SELECT sql FROM sqlite_master ORDER BY name"):
+                m.update(str(sql).encode("utf-8"))
+            self._schema = (version, m.hexdigest())
+        return self._schema[1]
 
 
 class SqlFilter:
@@ -271,23 +361,18 @@ class SqlFilter:
     def is_empty(self):
         return not self.kwargs
 
-    def create_new_view(self, db, view):
-        new_view = "entries_" + self.h(parent_view=view)
-        assert new_view != view
-        view_statement = self.create_view_statement(db, old_view=view, new_view=new_view)
-        if not view_statement:
-            # nothing to do
-            return view
-
-        LOG.debug("%s", view_statement)
-        for i in execute(db.connection, view_statement):
-            LOG.error(str(i))
-        return new_view
+    def compile(self, db, source, params):
+        """Returns the `(source, params)` of a sub-query applying this filter
+        to `source`, or the arguments unchanged if there is nothing to do.
+        `source` can be used after FROM and `params` are the values bound
+        to its placeholders, in order."""
+        raise NotImplementedError()
 
 
 class SqlSelection(SqlFilter):
-    def create_view_statement(self, db, old_view, new_view):
+    def compile(self, db, source, params):
         conditions = []
+        values = []
         for k, v in self.kwargs.items():
             if v is None or v is cml.ALL:
                 continue
@@ -298,25 +383,23 @@ class SqlSelection(SqlFilter):
             if not isinstance(v, (list, tuple)):
                 v = [v]
 
-            v = [dbkey.cast(x) for x in v]
-            v = ["'" + str(x) + "'" for x in v]
+            values += [dbkey.cast(x) for x in v]
 
-            conditions.append(f"{name} IN ({', '.join(v)})")
+            conditions.append(f"{name} IN ({', '.join(['?'] * len(v))})")
 
         if not conditions:
-            return None
+            return source, params
 
-        assert new_view != old_view
         return (
-            f"CREATE TEMP VIEW IF NOT EXISTS {new_view} AS SELECT * "
-            + f"FROM {old_view} WHERE "
-            + " AND ".join(conditions)
-            + ";"
+            f"(SELECT * FROM {source} WHERE " + " AND ".join(conditions) + ")",
+            params + tuple(values),
         )
 
 
 class SqlRemapping(SqlFilter):
-    def create_view_statement(self, db, old_view, new_view):
+    def compile(self, db, source, params):
+        values = []
+
         class SqlCustomJoiner:
             def format_name(self, x):
                 name = entryname_to_dbname(x)
@@ -325,7 +408,8 @@ class SqlRemapping(SqlFilter):
             def format_string(self, name):
                 if not name:
                     return name
-                return "'" + str(name) + "'"
+                values.append(str(name))
+                return "?"
 
             def join(self, lst):
                 lst = [_ for _ in lst if len(_)]
@@ -333,19 +417,19 @@ class SqlRemapping(SqlFilter):
                 return " || ".join(lst)
 
         sql_concatenations = []
-        for k, v in self.remapping.remapping.items():
+        for k in self.remapping:
             joiner = SqlCustomJoiner()
             alias = entryname_to_dbname(k)
             expr = self.remapping.substitute(k, joiner)
             sql_concatenations.append(f"TRIM({expr},'_') AS {alias}")
 
-        select = ", ".join(sql_concatenations)
-
         if not sql_concatenations:
-            return None
+            return source, params
+
+        select = ", ".join(sql_concatenations)
 
-        assert new_view != old_view
-        return f"CREATE TEMP VIEW IF NOT EXISTS {new_view} AS SELECT *, {select} " f"FROM {old_view};"
+        # The values of the select come before the ones of the source
+        return f"(SELECT *, {select} FROM {source})", tuple(values) + params
 
 
 class SqlOrder(SqlFilter):
@@ -360,11 +444,9 @@ class SqlOrder(SqlFilter):
 
         return SqlOrder(kwargs)
 
-    def create_view_statement(self, db, old_view, new_view):
-        func_name = "userorder_" + new_view
-
+    def compile(self, db, source, params):
         order_bys = []
-        dict_of_dicts = {}
+        values = []
 
         for k, v in self.kwargs.items():
             name = entryname_to_dbname(k)
@@ -378,31 +460,24 @@ class SqlOrder(SqlFilter):
                 order_bys.append(name + " DESC")
                 continue
             if isinstance(v, (list, tuple)):
-                v = [dbkey.cast(x) for x in v]
-                dict_of_dicts[name] = dict(zip(v, range(len(v))))
-                order_bys.append(func_name + "(" + "'" + name + "'" + ", " + name + ")")
+                # Rank of each value in the user list, values that are
+                # not in the list come last
+                ranks = dict(zip([dbkey.cast(x) for x in v], range(len(v))))
+                cases = []
+                for value, rank in ranks.items():
+                    cases.append(f"WHEN ? THEN {rank}")
+                    values.append(value)
+                order_bys.append(f"CASE {name} {' '.join(cases)} ELSE {len(v)} END")
                 continue
 
             raise ValueError(f"{k},{v}, {type(v)}")
 
         if not order_bys:
-            return None
-
-        if dict_of_dicts:
-
-            def order_func(k, v):
-                return dict_of_dicts[k][v]
+            return source, params
 
-            if LOG.level == logging.DEBUG:
-                sqlite3.enable_callback_tracebacks(True)
-            db.connection.create_function(func_name, 2, order_func, deterministic=True)
-
-        assert new_view != old_view
         return (
-            f"CREATE TEMP VIEW IF NOT EXISTS {new_view} AS SELECT * "
-            + f"FROM {old_view} ORDER BY "
-            + ",".join(order_bys)
-            + ";"
+            f"(SELECT * FROM {source} ORDER BY " + ",".join(order_bys) + ")",
+            params + tuple(values),
         )
 
 
@@ -439,6 +514,9 @@ class VersionedDatabaseMixin:
 class PathTable:
     table_name = "paths"
 
+    # Used to detect files that have changed since they were indexed
+    STAT_COLUMNS = ("size", "mtime", "inode")
+
     def __init__(self, connection):
         self.connection = connection
         self.ensure_table()
@@ -448,18 +526,48 @@ class PathTable:
         for i in execute(self.connection, statement):
             LOG.error(str(i))  # Output of .execute should be empty
 
-    def insert(self, key, date):
-        statement = f"""INSERT INTO {self.table_name} (key, date) VALUES(?,?);"""
+        # Tables created by older versions do not have the stat columns
+        columns = [x[1] for x in execute(self.connection, f"PRAGMA table_info({self.table_name})")]
+        for name in self.STAT_COLUMNS:
+            if name not in columns:
+                try:
+                    execute(self.connection, f"ALTER TABLE {self.table_name} ADD COLUMN {name} INTEGER;")
+                except sqlite3.OperationalError as e:
+                    # Read-only database, or another process did it first
+                    LOG.debug("Cannot add column %s to %s: %s", name, self.table_name, e)
+
+    def insert(self, key, date, stat=None):
+        size, mtime, inode = stat if stat is not None else (None, None, None)
+        statement = f"""INSERT OR REPLACE INTO {self.table_name} (key, date, size, mtime, inode) VALUES(?,?,?,?,?);"""
         LOG.debug("%s", statement)
-        execute(self.connection, statement, (key, date))
+        execute(self.connection, statement, (key, date, size, mtime, inode))
+
+    def update_stats(self, stats):
+        """Set the (size, mtime, inode) of keys already in the table, keeping their date."""
+        statement = f"""UPDATE {self.table_name} SET size=?, mtime=?, inode=? WHERE key=?;"""
+        executemany(self.connection, statement, [(*stat, key) for key, stat in stats.items()])
 
     def get_date(self, key):
-        statement = f"""SELECT * FROM {self.table_name} WHERE key="{key}";"""
+        statement = f"""SELECT date FROM {self.table_name} WHERE key=?;"""
         LOG.debug("%s", statement)
-        for key, date in execute(self.connection, statement):
+        for (date,) in execute(self.connection, statement, (key,)):
             return date
         return None
 
+    def stats(self):
+        """Returns a dictionary of all keys with their (size, mtime, inode),
+        which is None for files recorded before the stats were stored."""
+        statement = f"""SELECT key, size, mtime, inode FROM {self.table_name};"""
+        result = {}
+        for key, size, mtime, inode in execute(self.connection, statement):
+            result[key] = None if size is None else (size, mtime, inode)
+        return result
+
+    def delete(self, keys):
+        keys = [(k,) for k in keys]
+        executemany(self.connection, f"DELETE FROM {EntriesLoader.table_name} WHERE path=?;", keys)
+        executemany(self.connection, f"DELETE FROM {self.table_name} WHERE key=?;", keys)
+
 
 class SqlDatabase(Database, VersionedDatabaseMixin):
     EXTENSION = ".db"
@@ -468,14 +576,21 @@ class SqlDatabase(Database, VersionedDatabaseMixin):
         self,
         db_path,
         filters=None,
+        _parent=None,
     ):
         self._cache_column_names = {}
 
         self.db_path = db_path
         self._filters = filters or []
-        self._view = None
-        self._connection = None
+        self._query = None
+
+        if _parent is not None:
+            # Share the connections, and their caches of prepared statements
+            self._connection = _parent._connection
+            self.dbkeys = _parent.dbkeys
+            return
 
+        self._connection = None
         self.dbkeys = EntriesLoader(self.connection).keys
 
     def __str__(self):
@@ -485,13 +600,27 @@ class SqlDatabase(Database, VersionedDatabaseMixin):
         EntriesLoader(self.connection).build_sql_indexes()
 
     @property
-    def view(self):
-        if self._view is None:
-            self._view = "entries"
+    def query(self):
+        """The filters compiled into a single query, as a `(source, params)` tuple
+        where `source` can be used after FROM, with `params` as bound values."""
+        if self._query is None:
+            # The compiled queries depend on the columns of the database, which
+            # can change when it is updated or rebuilt
+            self.connection
+            key = f"{self.db_path}:{self._connection.schema_signature()}"
             for f in self._filters:
-                self._view = f.create_new_view(self, self._view)
-            LOG.debug("DB %s %s", self.db_path, self._view)
-        return self._view
+                key = f.h(parent=key)
+
+            query = COMPILED_QUERIES.get(key)
+            if query is None:
+                source, params = "entries", ()
+                for f in self._filters:
+                    source, params = f.compile(self, source, params)
+                query = COMPILED_QUERIES[key] = (source, params)
+
+            self._query = query
+            LOG.debug("DB %s %s %s", self.db_path, *self._query)
+        return self._query
 
     @property
     def connection(self):
@@ -507,16 +636,12 @@ class SqlDatabase(Database, VersionedDatabaseMixin):
 
         remapping = build_remapping(remapping, patches)
         with self.connection as con:
-            view = self.view
-            # orders = [f for f in self._filters if isinstance(f, SqlOrder)]
-            # if orders:
-            #     order = orders[0].merge(*orders)
-            #     view = order.create_new_view(self, view)
+            source, params = self.query
 
             results = {}
             for c in coords:
                 column = entryname_to_dbname(c)
-                values = [v[0] for v in execute(con, f"SELECT DISTINCT {column} FROM {view};")]
+                values = [v[0] for v in execute(con, f"SELECT DISTINCT {column} FROM {source};", params)]
                 LOG.debug("Reordered values for {column}", column, values)
                 results[column] = values
 
@@ -526,17 +651,56 @@ class SqlDatabase(Database, VersionedDatabaseMixin):
         return self.__class__(
             self.db_path,
             filters=self._filters + [filter],
+            _parent=self,
         )
 
+    def set_journal_mode(self, mode):
+        for (result,) in execute(self.connection, f"PRAGMA journal_mode={mode};"):
+            LOG.debug("Journal mode of %s is %s", self.db_path, result)
+
+    def paths_stats(self):
+        with self.connection as connection:
+            return PathTable(connection).stats()
+
+    def paths_signature(self, stats=None):
+        """A hash of the paths recorded in the database and of their stats,
+        which changes whenever a file is added, modified or removed."""
+        if stats is None:
+            stats = self.paths_stats()
+        return hashlib.md5(json.dumps(sorted(stats.items())).encode()).hexdigest()
+
+    def record_paths(self, stats):
+        """Record paths without entries, with their (size, mtime, inode), so that
+        files that cannot be parsed are not parsed again until they change."""
+        date = datetime.datetime.now().isoformat()
+        with self.connection as connection:
+            table = PathTable(connection)
+            for key, stat in stats.items():
+                table.insert(key, date, stat)
+
+    def update_paths_stats(self, stats):
+        with self.connection as connection:
+            PathTable(connection).update_stats(stats)
+
+    @property
+    def availability_index_path(self):
+        root, _ = os.path.splitext(self.db_path)
+        return root + "-availability.pickle"
+
+    def remove_paths(self, paths):
+        with self.connection as connection:
+            PathTable(connection).delete(paths)
+
     def already_loaded(self, path_or_url, owner):
         with self.connection as connection:
             date = PathTable(connection).get_date(path_or_url)
             return date is not None
 
-    def load_iterator(self, iterator):
+    def load_iterator(self, iterator, stats=None, **kwargs):
+        """See EntriesLoader for the available options."""
         with self.connection as connection:
-            loader = EntriesLoader(connection)
-            count = loader.load_iterator(iterator)
+            loader = EntriesLoader(connection, **kwargs)
+            count = loader.load_iterator(iterator, stats=stats)
             self.dbkeys = loader.keys
 
             assert count >= 1, "No entry found."
@@ -584,15 +748,17 @@ class SqlDatabase(Database, VersionedDatabaseMixin):
         limit_str = f" LIMIT {limit}" if limit is not None else ""
         offset_str = f" OFFSET {offset}" if offset is not None else ""
 
-        statement = f"SELECT {names_str} FROM {self.view} {limit_str} {offset_str};"
+        source, params = self.query
+        statement = f"SELECT {names_str} FROM {source} {limit_str} {offset_str};"
         LOG.debug("%s", statement)
 
-        for tupl in execute(self.connection, statement):
+        for tupl in execute(self.connection, statement, params):
             yield tupl
 
     def count(self):
-        statement = f"SELECT COUNT(*) FROM {self.view};"
-        for result in execute(self.connection, statement):
+        source, params = self.query
+        statement = f"SELECT COUNT(*) FROM {source};"
+        for result in execute(self.connection, statement, params):
             return result[0]
         assert False, statement  # Fail if result is empty.
 
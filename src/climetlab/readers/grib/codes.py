@@ -9,12 +9,12 @@
 
 import datetime
 import logging
+import mmap
 import os
 import threading
 import time
 import warnings
 from functools import cached_property
-from itertools import islice
 
 import eccodes
 
@@ -23,6 +23,8 @@ from climetlab.core.constants import DATETIME
 from climetlab.profiling import call_counter
 from climetlab.utils.bbox import BoundingBox
 
+from .geometry import grid_geometry
+
 LOG = logging.getLogger(__name__)
 
 
@@ -64,7 +66,90 @@ def missing_is_none(x):
 
 
 # This does not belong here, should be in the C library
+def _message_length(buf, offset, size):
+    # Decode the total length of the GRIB message starting at `offset`
+    # from the mapped buffer. Returns None if the header is truncated.
+
+    def get(start, count):
+        if start + count > size:
+            raise IndexError(start)
+        return int.from_bytes(buf[start : start + count], byteorder="big", signed=False)
+
+    try:
+        length = get(offset + 4, 3)
+        edition = get(offset + 7, 1)
+
+        if edition == 1:
+            if length & 0x800000:
+                # Large GRIB1 messages, see ecCodes grib_io.c
+                pos = offset + 8
+                sec1len = get(pos, 3)
+                flags = get(pos + 7, 1)
+                pos += sec1len
+
+                if flags & (1 << 7):
+                    pos += get(pos, 3)
+
+                if flags & (1 << 6):
+                    pos += get(pos, 3)
+
+                sec4len = get(pos, 3)
+
+                if sec4len < 120:
+                    length &= 0x7FFFFF
+                    length *= 120
+                    length -= sec4len
+                    length += 4
+
+        if edition == 2:
+            length = get(offset + 8, 8)
+
+    except IndexError:
+        return None
+
+    return length
+
+
 def get_messages_positions(path):
+    """Yield the (offset, length) of each GRIB message in `path`.
+    The file is memory-mapped and scanned for the `GRIB` marker
+    with a bulk search, skipping any data between messages."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = buf.find(b"GRIB", 0)
+            while offset >= 0:
+                length = _message_length(buf, offset, size)
+                if length is None:
+                    break
+
+                yield offset, length
+
+                if length == 0:
+                    # Corrupted header, resynchronise on the next marker
+                    offset = buf.find(b"GRIB", offset + 1)
+                    continue
+
+                offset = buf.find(b"GRIB", offset + length)
+
+
+def get_messages_positions_array(path):
+    """Same as :py:func:`get_messages_positions`, but returns a (n, 2) int64
+    NumPy array of offsets and lengths."""
+    import numpy as np
+
+    positions = np.fromiter(
+        (x for position in get_messages_positions(path) for x in position),
+        dtype=np.int64,
+    )
+    return positions.reshape(-1, 2)
+
+
+# Reference implementation, one read() per header field. Kept for benchmarking.
+def get_messages_positions_with_read(path):
     fd = os.open(path, os.O_RDONLY)
     try:
 
@@ -125,6 +210,12 @@ def get_messages_positions(path):
 
 eccodes_codes_release = call_counter(eccodes.codes_release)
 eccodes_codes_new_from_file = call_counter(eccodes.codes_new_from_file)
+eccodes_codes_new_from_message = call_counter(eccodes.codes_new_from_message)
+
+# "mmap": map each file once and decode messages from slices of the map,
+#         so threads can read different messages of the same file concurrently.
+# "file": seek and read a shared file object under a lock.
+GRIB_READER_MODE = os.environ.get("CLIMETLAB_GRIB_READER_MODE", "mmap")
 
 # For some reason, cffi can ge stuck in the GC if that function
 # needs to be called defined for the first time in a GC thread.
@@ -218,6 +309,12 @@ class CodesHandle:
     def get_data(self):
         return eccodes.codes_grib_get_data(self.handle)
 
+    def get_latitudes_longitudes(self):
+        return (
+            eccodes.codes_get_double_array(self.handle, "latitudes"),
+            eccodes.codes_get_double_array(self.handle, "longitudes"),
+        )
+
     def as_mars(self, param="shortName"):
         r = {}
         it = eccodes.codes_keys_iterator_new(self.handle, "mars")
@@ -291,9 +388,7 @@ class CodesHandle:
             self.offset = 0
 
     def read_bytes(self, offset, length):
-        with open(self.path, "rb") as f:
-            f.seek(offset)
-            return f.read(length)
+        return CodesReader.from_cache(self.path).read_bytes(offset, length)
 
     def get_message(self):
         return eccodes.codes_get_message(self.handle)
@@ -316,7 +411,7 @@ class ReaderLRUCache(dict):
             except KeyError:
                 pass
 
-            c = self[key] = CodesReader(path)
+            c = self[key] = READERS[GRIB_READER_MODE].create(path)
 
             while len(self) >= self.size:
                 _, oldest = min((v.last, k) for k, v in self.items())
@@ -341,11 +436,15 @@ class CodesReader:
         except Exception:
             pass
 
+    @classmethod
+    def create(cls, path):
+        return cls(path)
+
     @classmethod
     def from_cache(cls, path):
         return cache[path]
 
-    def at_offset(self, offset):
+    def at_offset(self, offset, length=None):
         with self.lock:
             self.last = time.time()
             self.file.seek(offset, 0)
@@ -356,6 +455,88 @@ class CodesReader:
             assert handle is not None, (self.file, offset)
             return CodesHandle(handle, self.path, offset)
 
+    def read_bytes(self, offset, length):
+        with self.lock:
+            self.last = time.time()
+            self.file.seek(offset, 0)
+            return self.file.read(length)
+
+
+class MMapCodesReader(CodesReader):
+    """Map the file once, and create handles from slices of the map.
+    No lock is needed, as reading the map does not change any state.
+    The file is mapped again if it has been modified since, so that
+    reading the map never goes past the end of the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.last = time.time()
+        self.mapping = self._map()
+
+    @classmethod
+    def create(cls, path):
+        # Empty files cannot be mapped
+        if os.path.getsize(path) == 0:
+            return CodesReader(path)
+        return cls(path)
+
+    def _map(self):
+        # Returns the map, its size, and the stats of the file when it was mapped
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+        return buf, len(buf) if buf is not None else 0, (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _mapped(self, end):
+        # Previous maps are not closed, as other threads may still be reading
+        # them. They are released when they are no longer referenced.
+        buf, size, stats = self.mapping
+        st = os.stat(self.path)
+        if end > size or stats != (st.st_size, st.st_mtime_ns, st.st_ino):
+            buf, size, _ = self.mapping = self._map()
+        return buf, size
+
+    def at_offset(self, offset, length=None):
+        self.last = time.time()
+        buf, size = self._mapped(offset + (length or 0))
+        if length is None and buf is not None:
+            length = _message_length(buf, offset, size)
+        assert length and offset + length <= size, (self.path, offset)
+
+        # ecCodes copies the message, so the view can be released straight away
+        with memoryview(buf)[offset : offset + length] as message:
+            handle = eccodes_codes_new_from_message(message)
+
+        assert handle is not None, (self.path, offset)
+        return CodesHandle(handle, self.path, offset)
+
+    def read_bytes(self, offset, length):
+        self.last = time.time()
+        buf, _ = self._mapped(offset + length)
+        if buf is None:
+            return b""
+        return buf[offset : offset + length]
+
+
+READERS = {
+    "file": CodesReader,
+    "mmap": MMapCodesReader,
+}
+
+# Grids defined by latitudes and longitudes, whose coordinates
+# do not depend on the shape of the Earth
+LATLON_GRIDS = (
+    "regular_ll",
+    "reduced_ll",
+    "rotated_ll",
+    "regular_gg",
+    "reduced_gg",
+    "rotated_gg",
+    "reduced_rotated_gg",
+)
+
+EARTH_KEYS = ("shapeOfTheEarth", "radius", "earthMajorAxis", "earthMinorAxis")
+
 
 # count = defaultdict(int)
 
@@ -376,11 +557,11 @@ class GribField(Base):
         if self._handle_cache is not None:
             key = (self.path, self._offset)
             if key not in self._handle_cache:
-                self._handle_cache[key] = CodesReader.from_cache(self.path).at_offset(self._offset)
+                self._handle_cache[key] = CodesReader.from_cache(self.path).at_offset(self._offset, self._length)
             return self._handle_cache[key]
 
         if self._handle is None:
-            self._handle = CodesReader.from_cache(self.path).at_offset(self._offset)
+            self._handle = CodesReader.from_cache(self.path).at_offset(self._offset, self._length)
 
         return self._handle
 
@@ -404,8 +585,27 @@ class GribField(Base):
             self._offset = int(self.handle.get("offset"))
         return self._offset
 
+    @cached_property
+    def geometry(self):
+        """The GridGeometry shared by all fields on the same grid"""
+        earth = None
+        if self.handle.get("gridType") not in LATLON_GRIDS:
+            # The coordinates of projected grids depend on the shape of the Earth,
+            # which is not part of md5GridSection, see CodesHandle.get()
+            earth = tuple(self._earth_key(k) for k in EARTH_KEYS)
+        return grid_geometry(self.handle.get("md5GridSection"), earth)
+
+    def _earth_key(self, name):
+        try:
+            return self.handle.get(name)
+        except eccodes.GribInternalError:
+            # For instance, radius when its scaled value is missing
+            return None
+
     @property
     def shape(self):
+        # Not kept in the geometry, as computing md5GridSection
+        # costs more than reading these keys
         Nj = missing_is_none(self.handle.get("Nj"))
         Ni = missing_is_none(self.handle.get("Ni"))
         if Ni is None or Nj is None:
@@ -415,29 +615,36 @@ class GribField(Base):
 
     @property
     def mars_grid(self):
-        if len(self.shape) == 2:
-            return [
-                self.handle.get("iDirectionIncrementInDegrees"),
-                self.handle.get("jDirectionIncrementInDegrees"),
-            ]
+        def compute():
+            if len(self.shape) == 2:
+                return (
+                    self.handle.get("iDirectionIncrementInDegrees"),
+                    self.handle.get("jDirectionIncrementInDegrees"),
+                )
+
+            return self.handle.get("gridName")
+
+        grid = self.geometry.get("mars_grid", compute)
+        return list(grid) if isinstance(grid, tuple) else grid
+
+    def _area(self):
+        def compute():
+            return dict(
+                north=self.handle.get("latitudeOfFirstGridPointInDegrees"),
+                south=self.handle.get("latitudeOfLastGridPointInDegrees"),
+                west=self.handle.get("longitudeOfFirstGridPointInDegrees"),
+                east=self.handle.get("longitudeOfLastGridPointInDegrees"),
+            )
 
-        return self.handle.get("gridName")
+        return dict(self.geometry.get("area", compute))
 
     @property
     def mars_area(self):
-        north = self.handle.get("latitudeOfFirstGridPointInDegrees")
-        south = self.handle.get("latitudeOfLastGridPointInDegrees")
-        west = self.handle.get("longitudeOfFirstGridPointInDegrees")
-        east = self.handle.get("longitudeOfLastGridPointInDegrees")
-        return [north, west, south, east]
+        area = self._area()
+        return [area["north"], area["west"], area["south"], area["east"]]
 
     def plot_map(self, backend):
-        backend.bounding_box(
-            north=self.handle.get("latitudeOfFirstGridPointInDegrees"),
-            south=self.handle.get("latitudeOfLastGridPointInDegrees"),
-            west=self.handle.get("longitudeOfFirstGridPointInDegrees"),
-            east=self.handle.get("longitudeOfLastGridPointInDegrees"),
-        )
+        backend.bounding_box(**self._area())
         backend.plot_grib(self.path, self.handle.get("offset"))
 
     @call_counter
@@ -460,14 +667,13 @@ class GribField(Base):
         )
 
     def _grid_definition(self):
-        return dict(
-            north=self.handle.get("latitudeOfFirstGridPointInDegrees"),
-            south=self.handle.get("latitudeOfLastGridPointInDegrees"),
-            west=self.handle.get("longitudeOfFirstGridPointInDegrees"),
-            east=self.handle.get("longitudeOfLastGridPointInDegrees"),
-            south_north_increment=self.handle.get("jDirectionIncrementInDegrees"),
-            west_east_increment=self.handle.get("iDirectionIncrementInDegrees"),
-        )
+        def compute():
+            return dict(
+                south_north_increment=self.handle.get("jDirectionIncrementInDegrees"),
+                west_east_increment=self.handle.get("iDirectionIncrementInDegrees"),
+            )
+
+        return dict(**self._area(), **self.geometry.get("increments", compute))
 
     def field_metadata(self):
         m = self._grid_definition()
@@ -496,36 +702,42 @@ class GribField(Base):
 
     @property
     def resolution(self):
-        grid_type = self["gridType"]
+        def compute():
+            grid_type = self["gridType"]
+
+            if grid_type in ("reduced_gg", "reduced_rotated_gg"):
+                return self["gridName"]
 
-        if grid_type in ("reduced_gg", "reduced_rotated_gg"):
-            return self["gridName"]
+            if grid_type in ("regular_ll", "rotated_ll"):
+                x = round(self["DxInDegrees"] * 1_000_000) / 1_000_000
+                y = round(self["DyInDegrees"] * 1_000_000) / 1_000_000
+                assert x == y, (x, y)
+                return x
 
-        if grid_type in ("regular_ll", "rotated_ll"):
-            x = round(self["DxInDegrees"] * 1_000_000) / 1_000_000
-            y = round(self["DyInDegrees"] * 1_000_000) / 1_000_000
-            assert x == y, (x, y)
-            return x
+            if grid_type == "lambert":
+                x = self["DxInMetres"]
+                y = self["DyInMetres"]
+                assert x == y, (x, y)
+                return str(x / 1000).replace(".", "p") + "km"
 
-        if grid_type == "lambert":
-            x = self["DxInMetres"]
-            y = self["DyInMetres"]
-            assert x == y, (x, y)
-            return str(x / 1000).replace(".", "p") + "km"
+            raise ValueError(f"Unknown gridType={grid_type}")
 
-        raise ValueError(f"Unknown gridType={grid_type}")
+        return self.geometry.get("resolution", compute)
 
     @property
     def grid_type(self):
-        return self.handle.get("gridType")
+        return self.geometry.get("grid_type", lambda: self.handle.get("gridType"))
 
     @property
     def rotation(self):
-        return (
-            self.handle.get("latitudeOfSouthernPoleInDegrees"),
-            self.handle.get("longitudeOfSouthernPoleInDegrees"),
-            self.handle.get("angleOfRotationInDegrees"),
-        )
+        def compute():
+            return (
+                self.handle.get("latitudeOfSouthernPoleInDegrees"),
+                self.handle.get("longitudeOfSouthernPoleInDegrees"),
+                self.handle.get("angleOfRotationInDegrees"),
+            )
+
+        return self.geometry.get("rotation", compute)
 
     def datetime(self):
         date = self.handle.get("date")
@@ -553,12 +765,7 @@ class GribField(Base):
         return [self.valid_datetime()]
 
     def to_bounding_box(self):
-        return BoundingBox(
-            north=self.handle.get("latitudeOfFirstGridPointInDegrees"),
-            south=self.handle.get("latitudeOfLastGridPointInDegrees"),
-            west=self.handle.get("longitudeOfFirstGridPointInDegrees"),
-            east=self.handle.get("longitudeOfLastGridPointInDegrees"),
-        )
+        return BoundingBox(**self._area())
 
     def _attributes(self, names):
         result = {}
@@ -632,10 +839,10 @@ class GribField(Base):
         return self.handle.as_mars(param)
 
     def write(self, f):
-        f.write(self.handle.read_bytes(self._offset, self._length))
+        f.write(CodesReader.from_cache(self.path).read_bytes(self._offset, self._length))
 
     def plot_numpy(self, backend, array):
-        if self.handle.get("gridType") == "regular_ll":
+        if self.grid_type == "regular_ll":
             metadata = self.field_metadata()
 
             backend.bounding_box(
@@ -656,73 +863,65 @@ class GribField(Base):
         clone = self.handle.clone()
         clone.set_values(array)
         clone.save(tmp)
-        GribField(tmp, 0, self._length).plot_map(backend)
+        GribField(tmp, 0, None).plot_map(backend)
 
     def iterate_grid_points(self):
-        latlon = self.handle.get("latitudeLongitudeValues")
-        yield from zip(islice(latlon, 0, None, 3), islice(latlon, 1, None, 3))
+        lat, lon = self.grid_points()
+        yield from zip(lat.tolist(), lon.tolist())
 
-    @cached_property
+    @property
     def rotated(self):
         return "rotated" in self.grid_type
 
-    @cached_property
+    @property
     def rotated_iterator(self):
-        return self.handle.get("iteratorDisableUnrotate") is not None
+        return self.geometry.get(
+            "rotated_iterator",
+            lambda: self.handle.get("iteratorDisableUnrotate") is not None,
+        )
 
     def grid_points(self):
-        import numpy as np
-
         if self.rotated and not self.rotated_iterator:
             warnings.warn(f"ecCodes does not support rotated iterator for {self.grid_type}")
             return self.grid_points_unrotated()
 
-        data = self.data
-        lat = np.array([d["lat"] for d in data])
-        lon = np.array([d["lon"] for d in data])
-
-        lon[lon >= 360] -= 360
+        def compute():
+            lat, lon = self.handle.get_latitudes_longitudes()
+            lon[lon >= 360] -= 360
+            return lat, lon
 
-        return lat, lon
+        return self.geometry.grid_points("grid_points", compute)
 
     def grid_points_unrotated(self):
-        import numpy as np
+        def compute():
+            lat_y, lon_x = self.handle.get_latitudes_longitudes()
+            south_pole_lat, south_pole_lon, _ = self.rotation
+            return unrotate(lat_y, lon_x, south_pole_lat, south_pole_lon)
 
-        data = self.data
-        lat_y = np.array([d["lat"] for d in data])
-        lon_x = np.array([d["lon"] for d in data])
-
-        south_pole_lat, south_pole_lon, _ = self.rotation
-        # print(self.rotation)
-
-        lat, lon = unrotate(lat_y, lon_x, south_pole_lat, south_pole_lon)
-        # print(max(lat), min(lat), max(lon), min(lon))
-        # exit(1)
-        return lat, lon
+        return self.geometry.grid_points("grid_points_unrotated", compute)
 
     def grid_points_raw(self):
-        import numpy as np
-
         if not self.rotated:
             return self.grid_points()
 
         if not self.rotated_iterator:
             warnings.warn(f"ecCodes does not support rotated iterator for {self.grid_type}")
-            data = self.handle.get_data()
-            lat = np.array([d["lat"] for d in data])
-            lon = np.array([d["lon"] for d in data])
-            return lat, lon
+            return self.geometry.grid_points("grid_points_raw", self.handle.get_latitudes_longitudes)
 
-        try:
-            self.handle.set("iteratorDisableUnrotate", 1)
-            data = self.handle.get_data()
-            lat = np.array([d["lat"] for d in data])
-            lon = np.array([d["lon"] for d in data])
-            return lat, lon
-        finally:
-            self.handle.set("iteratorDisableUnrotate", 0)
+        def compute():
+            try:
+                self.handle.set("iteratorDisableUnrotate", 1)
+                return self.handle.get_latitudes_longitudes()
+            finally:
+                self.handle.set("iteratorDisableUnrotate", 0)
+
+        return self.geometry.grid_points("grid_points_raw", compute)
 
     @property
     def proj_string(self):
         # +proj=lcc +lon_0=5.000000 +lat_0=53.500000 +lat_1=53.500000 +lat_2=53.500000 +R=6367470.000000
-        return self.handle.get("projString")
+        # The shape of the Earth is not part of md5GridSection, see CodesHandle.get()
+        return self.geometry.get(
+            ("proj_string", self.handle.get("shapeOfTheEarth")),
+            lambda: self.handle.get("projString"),
+        )
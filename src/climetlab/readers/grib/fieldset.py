@@ -7,14 +7,13 @@
 # nor does it submit to any jurisdiction.
 #
 
-import json
 import logging
 from collections import defaultdict
 
-from climetlab.core.caching import auxiliary_cache_file
 from climetlab.utils.bbox import BoundingBox
 
 from .pandas import PandasMixIn
+from .points import PointsMixIn
 from .pytorch import PytorchMixIn
 from .tensorflow import TensorflowMixIn
 from .xarray import XarrayMixIn
@@ -22,7 +21,7 @@ from .xarray import XarrayMixIn
 LOG = logging.getLogger(__name__)
 
 
-class FieldSetMixin(PandasMixIn, XarrayMixIn, PytorchMixIn, TensorflowMixIn):
+class FieldSetMixin(PandasMixIn, PointsMixIn, XarrayMixIn, PytorchMixIn, TensorflowMixIn):
     _statistics = None
 
     def _find_all_coords_dict(self):
@@ -38,6 +37,52 @@ class FieldSetMixin(PandasMixIn, XarrayMixIn, PytorchMixIn, TensorflowMixIn):
 
         return {k: list(v) for k, v in coords.items()}
 
+    def _metadata_columns(self, iterable, names, kinds, remapping):
+        from climetlab.core.constants import DATETIME
+        from climetlab.core.order import Remapping
+
+        from .codes import CodesHandle
+        from .codes import GribField
+
+        if not isinstance(remapping, Remapping) or remapping:
+            return super()._metadata_columns(iterable, names, kinds, remapping)
+
+        # Typed keys are read straight from the handle, unless GribField.metadata()
+        # changes their values (e.g. unknown short names are replaced by the param).
+        # The other keys go through GribField.metadata() as well.
+        typed = {
+            "int": CodesHandle.get_long,
+            "float": CodesHandle.get_double,
+            "str": CodesHandle.get_string,
+        }
+        converted = (DATETIME, "level", "param", "shortName")
+        aliases = {"_param_id": "paramId"}
+
+        getters = []
+        for name, kind in zip(names, kinds):
+            if kind is None or name in converted:
+                getters.append((name, None))
+            else:
+                getters.append((aliases.get(name, name), typed[kind]))
+
+        casts = [dict(int=int, float=float, str=str).get(kind) for kind in kinds]
+        columns = [[] for _ in names]
+        appends = [c.append for c in columns]
+
+        for f in iterable:
+            handle = f.handle if isinstance(f, GribField) else None
+            metadata = f.metadata
+            for name, (key, getter), cast, append in zip(names, getters, casts, appends):
+                if getter is not None and handle is not None:
+                    append(getter(handle, key))
+                    continue
+                v = metadata(name)
+                if cast is not None and v is not None:
+                    v = cast(v)
+                append(v)
+
+        return columns
+
     @property
     def all_coords(self):
         if not self._coords:
@@ -58,11 +103,6 @@ class FieldSetMixin(PandasMixIn, XarrayMixIn, PytorchMixIn, TensorflowMixIn):
 
         return mv_read(self.path)
 
-    def to_numpy(self, **kwargs):
-        import numpy as np
-
-        return np.array([f.to_numpy(**kwargs) for f in self])
-
     def plot_map(self, backend):
         return self.first.plot_map(backend)
 
@@ -82,68 +122,79 @@ class FieldSetMixin(PandasMixIn, XarrayMixIn, PytorchMixIn, TensorflowMixIn):
     def to_bounding_box(self):
         return BoundingBox.multi_merge([s.to_bounding_box() for s in self])
 
-    def statistics(self):
-        import numpy as np
+    def accumulate_statistics(self, per_point=False, group_by=None):
+        """Accumulates the statistics of the values of the fields, ignoring missing values.
+        Returns a StatisticsAccumulator, or a dictionary of them if `group_by` is given
+        (a metadata key or a list of keys). Accumulators of different parts of a fieldset can
+        be merged, so that they can be computed in parallel."""
+        from climetlab.utils.accumulators import StatisticsAccumulator
 
-        if self._statistics is not None:
-            return self._statistics
+        keys = [group_by] if isinstance(group_by, str) else group_by
+        groups = {}
 
-        if False:
-            cache = auxiliary_cache_file(
-                "grib-statistics--",
-                self.path,
-                content="null",
-                extension=".json",
-            )
+        for f in self:
+            if per_point:
+                stats = StatisticsAccumulator.from_values(f.to_numpy()[None, ...], axis=0)
+            else:
+                stats = StatisticsAccumulator.from_values(f.values)
 
-            with open(cache) as f:
-                self._statistics = json.load(f)
+            key = None
+            if keys:
+                key = tuple(f.metadata(k) for k in keys)
+                if isinstance(group_by, str):
+                    key = key[0]
 
-            if self._statistics is not None:
-                return self._statistics
+            if key in groups:
+                groups[key].merge(stats)
+            else:
+                groups[key] = stats
 
-        stdev = None
-        average = None
-        maximum = None
-        minimum = None
-        count = 0
+        if keys:
+            return groups
 
-        for s in self:
-            v = s.values
-            if count:
-                stdev = np.add(stdev, np.multiply(v, v))
-                average = np.add(average, v)
-                maximum = np.maximum(maximum, v)
-                minimum = np.minimum(minimum, v)
+        return groups.get(None, StatisticsAccumulator())
+
+    def statistics(self, per=None, group_by=None):
+        """Returns the minimum, maximum, average, standard deviation and number of values of the
+        fields, ignoring missing values. `per` can be None (all values), "point" (one value per
+        grid point) or "field" (a list with one entry per field). See `accumulate_statistics`
+        for `group_by`. Results of fieldsets read from a file are cached."""
+        from climetlab.utils.accumulators import StatisticsAccumulator
+
+        if per not in (None, "point", "field"):
+            raise ValueError(f"Invalid value for per: {per}, values are None, 'point' and 'field'")
+
+        if per == "field" and group_by is not None:
+            raise ValueError("Statistics per field cannot be grouped")
+
+        if isinstance(group_by, (list, tuple)):
+            group_by = list(group_by)
+
+        key = [per, group_by]
+        if self._statistics is None:
+            self._statistics = {}
+
+        cached = repr(key)
+        if cached in self._statistics:
+            return self._statistics[cached]
+
+        result = self._load_statistics(key)
+        if result is None:
+            if per == "field":
+                result = [StatisticsAccumulator.from_values(f.values).as_dict() for f in self]
             else:
-                stdev = np.multiply(v, v)
-                average = v
-                maximum = v
-                minimum = v
-
-            count += 1
-
-        nans = np.count_nonzero(np.isnan(average))
-        assert nans == 0, "Statistics with missing values not yet implemented"
-
-        maximum = np.amax(maximum)
-        minimum = np.amin(minimum)
-        average = np.mean(average) / count
-        stdev = np.sqrt(np.mean(stdev) / count - average * average)
-
-        self._statistics = dict(
-            minimum=minimum,
-            maximum=maximum,
-            average=average,
-            stdev=stdev,
-            count=count,
-        )
-
-        if False:
-            with open(cache, "w") as f:
-                json.dump(self._statistics, f)
-
-        return self._statistics
+                stats = self.accumulate_statistics(per_point=per == "point", group_by=group_by)
+                result = {k: v.as_dict() for k, v in stats.items()} if group_by else stats.as_dict()
+            self._save_statistics(key, result)
+
+        self._statistics[cached] = result
+        return result
+
+    def _load_statistics(self, key):
+        return None
+
+    def _save_statistics(self, key, statistics):
+        pass
 
     def save(self, filename):
         with open(filename, "wb") as f:
@@ -0,0 +1,111 @@
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import logging
+import os
+import threading
+
+from lru import LRU
+
+LOG = logging.getLogger(__name__)
+
+# Number of grids kept in memory
+GRID_GEOMETRY_CACHE_SIZE = int(os.environ.get("CLIMETLAB_GRID_GEOMETRY_CACHE_SIZE", 16))
+
+# Also keep the coordinates of the grid points in the cache directory
+GRID_GEOMETRY_PERSISTENCE = os.environ.get("CLIMETLAB_GRID_GEOMETRY_PERSISTENCE", "0").lower() in (
+    "1",
+    "yes",
+    "true",
+)
+
+
+class GridGeometry:
+    """Values that only depend on the grid of a field, such as its shape, bounding box
+    or coordinates. They are computed once and shared by all the fields with the same
+    md5GridSection, and the same shape of the Earth if it changes their coordinates."""
+
+    def __init__(self, md5, earth=None):
+        self.md5 = md5
+        self.earth = earth
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.md5},{list(self._cache.keys())})"
+
+    def get(self, name, compute):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        value = compute()
+
+        with self._lock:
+            return self._cache.setdefault(name, value)
+
+    def grid_points(self, kind, compute):
+        """Returns the `(lat, lon)` arrays of the grid, as read-only arrays."""
+
+        def _compute():
+            if GRID_GEOMETRY_PERSISTENCE and self.md5 is not None:
+                return _load_grid_points(self.md5, self.earth, kind, compute)
+
+            result = compute()
+            for a in result:
+                a.flags.writeable = False  # Shared between fields
+            return result
+
+        return self.get(kind, _compute)
+
+
+def _load_grid_points(md5, earth, kind, compute):
+    import numpy as np
+
+    from climetlab.core.caching import cache_file
+
+    def create(target, args):
+        with open(target, "wb") as f:
+            np.save(f, np.stack(compute()))
+
+    args = dict(md5GridSection=md5, kind=kind)
+    if earth is not None:
+        args["earth"] = list(earth)
+
+    path = cache_file(
+        "grib-grid-points",
+        create,
+        args,
+        extension=".npy",
+    )
+
+    lat, lon = np.load(path, mmap_mode="r")
+    return lat, lon
+
+
+GEOMETRIES = LRU(GRID_GEOMETRY_CACHE_SIZE)
+LOCK = threading.Lock()
+
+
+def grid_geometry(md5, earth=None):
+    """Returns the shared GridGeometry of the grid identified by `md5`, which is
+    the value of md5GridSection, and by `earth`, the keys describing the shape of
+    the Earth for grids whose coordinates depend on it, as it is not part of
+    md5GridSection. If `md5` is None, a new, unshared, geometry is returned."""
+
+    if md5 is None:
+        return GridGeometry(None)
+
+    key = (md5, earth)
+    with LOCK:
+        geometry = GEOMETRIES.get(key)
+        if geometry is None:
+            geometry = GEOMETRIES[key] = GridGeometry(md5, earth)
+        return geometry
@@ -19,21 +19,28 @@ from climetlab.core.index import MaskIndex
 from climetlab.core.index import MultiIndex
 from climetlab.decorators import normalize_grib_key_values
 from climetlab.decorators import normalize_grib_keys
-from climetlab.indexing.database import FILEPARTS_KEY_NAMES
-from climetlab.indexing.database import MORE_KEY_NAMES
-from climetlab.indexing.database import MORE_KEY_NAMES_WITH_UNDERSCORE
-from climetlab.indexing.database import STATISTICS_KEY_NAMES
+from climetlab.indexing.database import AVAILABILITY_IGNORE_KEY_NAMES
 from climetlab.indexing.fieldset import FieldSet
 from climetlab.readers.grib.codes import GribField
 from climetlab.readers.grib.fieldset import FieldSetMixin
 from climetlab.utils import progress_bar
 from climetlab.utils.availability import Availability
+from climetlab.utils.availability import AvailabilityIndex
 
 LOG = logging.getLogger(__name__)
 
 
+def _selected(value, accepted):
+    if not isinstance(accepted, (list, tuple)):
+        accepted = (accepted,)
+    if not isinstance(value, (list, tuple)):
+        value = (value,)
+    return all(v in accepted for v in value)
+
+
 class GribFieldSet(FieldSetMixin, FieldSet):
     _availability = None
+    _availability_index = None
 
     def __init__(self, *args, **kwargs):
         if self.availability_path is not None and os.path.exists(self.availability_path):
@@ -68,18 +75,16 @@ class GribFieldSet(FieldSetMixin, FieldSet):
         request = normalize_grib_key_values(request, as_tuple=True)
 
         keys = list(request.keys())
-
-        ds = self.sel(**request)
+        index = self.availability_index
 
         def dicts():
-            for i in progress_bar(
-                iterable=range(len(ds)),
-                desc="Building availability",
-            ):
-                metadata = ds.get_metadata(i)
-                dic = {k: metadata.get(k, "-") for k in keys}
+            # Same as self.sel(**request), on the distinct combinations of values
+            for dic in index.dicts(keys):
+                if any(v is None for v in dic.values()):
+                    continue
                 dic = normalize_grib_key_values(dic, as_tuple=False)
-                yield dic
+                if all(request[k] is None or _selected(dic[k], request[k]) for k in keys):
+                    yield dic
 
         available = Availability(dicts())
 
@@ -94,26 +99,28 @@ class GribFieldSet(FieldSetMixin, FieldSet):
 
     def _custom_availability(self, keys=None, ignore_keys=None, filter_keys=lambda k: True):
         def dicts():
+            if keys is not None:
+                table = self.metadata_table(*keys, progress_bar=True)
+                for row in zip(*(table[k].tolist() for k in keys)):
+                    yield {k: "-" if v is None else str(v) for k, v in zip(keys, row)}
+                return
+
             for i in progress_bar(
                 iterable=range(len(self)),
                 desc="Building availability",
             ):
-                if keys is not None:
-                    dic = self.get_metadata(i)
-                    dic = {k: str(dic.get(k, "-")) for k in keys}
-                else:
-                    dic = self.get_metadata(i)
-
-                    for k in list(dic.keys()):
-                        if not filter_keys(k):
-                            dic.pop(k)
-                            continue
-                        if ignore_keys and k in ignore_keys:
-                            dic.pop(k)
-                            continue
-                        if dic[k] is None:
-                            dic.pop(k)
-                            continue
+                dic = self.get_metadata(i)
+
+                for k in list(dic.keys()):
+                    if not filter_keys(k):
+                        dic.pop(k)
+                        continue
+                    if ignore_keys and k in ignore_keys:
+                        dic.pop(k)
+                        continue
+                    if dic[k] is None:
+                        dic.pop(k)
+                        continue
 
                 yield dic
 
@@ -121,19 +128,49 @@ class GribFieldSet(FieldSetMixin, FieldSet):
 
         return Availability(dicts())
 
-    @property
-    def availability(self):
-        if self._availability is not None:
-            return self._availability
-        LOG.debug("Building availability")
+    def get_metadata(self, n):
+        return self[n].as_mars()
 
-        self._availability = self._custom_availability(
-            ignore_keys=FILEPARTS_KEY_NAMES + STATISTICS_KEY_NAMES + MORE_KEY_NAMES_WITH_UNDERSCORE + MORE_KEY_NAMES
+    @property
+    def availability_index(self):
+        if self._availability_index is None:
+            index = self._load_availability_index()
+            if index is None:
+                index = self._build_availability_index()
+                self._save_availability_index(index)
+            self._availability_index = index
+        return self._availability_index
+
+    def _build_availability_index(self):
+        LOG.debug("Building availability index")
+        index = AvailabilityIndex(ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES)
+        index.add(
+            self.get_metadata(i)
+            for i in progress_bar(
+                iterable=range(len(self)),
+                desc="Building availability",
+            )
         )
-        return self.availability
+        return index
+
+    def _load_availability_index(self):
+        return None
+
+    def _save_availability_index(self, index):
+        pass
+
+    @property
+    def availability(self):
+        if self._availability is None:
+            self._availability = self.availability_index.availability()
+        return self._availability
 
     def is_full_hypercube(self):
-        non_empty_coords = {k: v for k, v in self.availability._tree.unique_values().items() if len(v) > 1}
+        if self._availability is not None:
+            unique_values = self._availability._tree.unique_values()
+        else:
+            unique_values = self.availability_index.unique_values()
+        non_empty_coords = {k: v for k, v in unique_values.items() if len(v) > 1}
         expected_size = math.prod([len(v) for k, v in non_empty_coords.items()])
         return len(self) == expected_size
 
@@ -16,13 +16,17 @@ import requests
 from multiurl import robust
 
 from climetlab.core.caching import cache_file
+from climetlab.indexing.database import AVAILABILITY_IGNORE_KEY_NAMES
 from climetlab.readers.grib.index import FieldSetInFiles
 from climetlab.utils import progress_bar
+from climetlab.utils.availability import AvailabilityIndex
 
 LOG = logging.getLogger(__name__)
 
 
 class FieldsetInFilesWithDBIndex(FieldSetInFiles):
+    DB_LOADER_OPTIONS = {}
+
     def __init__(self, db, **kwargs):
         """Should not be instanciated directly.
         The public API are the constructors "_from*()" class methods.
@@ -45,6 +49,42 @@ class FieldsetInFilesWithDBIndex(FieldSetInFiles):
         dirpath = os.path.dirname(self.db.db_path)
         return os.path.join(dirpath, "availability.pickle")
 
+    # The availability index is stored next to the database, and is updated
+    # when files are indexed (see GribIndexingDirectoryParserIterator). It only
+    # describes the whole database, so it is not used once a selection is applied.
+
+    def _build_availability_index(self):
+        if self.db._filters:
+            return super()._build_availability_index()
+
+        LOG.debug("Building availability index from %s", self.db)
+        index = AvailabilityIndex(ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES)
+        index.add(self.db.lookup_dicts())
+        return index
+
+    def _load_availability_index(self):
+        if self.db._filters:
+            return None
+        try:
+            return AvailabilityIndex.from_pickle(
+                self.db.availability_index_path,
+                signature=self.db.paths_signature(),
+                ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES,
+            )
+        except Exception:
+            LOG.exception("Cannot load %s", self.db.availability_index_path)
+
+        return None
+
+    def _save_availability_index(self, index):
+        if self.db._filters:
+            return
+        try:
+            index.to_pickle(self.db.availability_index_path, signature=self.db.paths_signature())
+        except Exception:
+            # The database may be in a read-only directory
+            LOG.debug("Cannot write %s", self.db.availability_index_path, exc_info=True)
+
     @classmethod
     def from_iterator(
         cls,
@@ -57,7 +97,7 @@ class FieldsetInFilesWithDBIndex(FieldSetInFiles):
         def load(target, *args):
             LOG.debug(f"Building db in {target}")
             db = cls.DBCLASS(target)
-            db.load_iterator(iterator)
+            db.load_iterator(iterator, **cls.DB_LOADER_OPTIONS)
 
         db_name = cache_file(
             "grib-index",
@@ -8,20 +8,24 @@
 #
 
 
-import json
+import hashlib
 import logging
 import os
+import pickle
 
 from climetlab.core.caching import auxiliary_cache_file
-from climetlab.readers.grib.codes import get_messages_positions
+from climetlab.indexing.database import AVAILABILITY_IGNORE_KEY_NAMES
+from climetlab.readers.grib.codes import get_messages_positions_array
 from climetlab.readers.grib.index import FieldSetInFiles
+from climetlab.utils.availability import AvailabilityIndex
 from climetlab.utils.parts import Part
 
 LOG = logging.getLogger(__name__)
 
 
 class FieldSetInOneFile(FieldSetInFiles):
-    VERSION = 1
+    COLUMNS_VERSION = 1
+    STATISTICS_VERSION = 1
 
     @property
     def availability_path(self):
@@ -33,11 +37,11 @@ class FieldSetInOneFile(FieldSetInFiles):
         self.path = path
         self.offsets = None
         self.lengths = None
+        self._columns = None
         self.mappings_cache_file = auxiliary_cache_file(
             "grib-index",
             path,
-            content="null",
-            extension=".json",
+            extension=".npy",
         )
 
         if not self._load_cache():
@@ -45,51 +49,166 @@ class FieldSetInOneFile(FieldSetInFiles):
 
         super().__init__(**kwargs)
 
+    def _set_positions(self, positions):
+        self.positions = positions
+        self.offsets = positions[:, 0]
+        self.lengths = positions[:, 1]
+
     def _build_offsets_lengths_mapping(self):
-        offsets = []
-        lengths = []
+        self._set_positions(get_messages_positions_array(self.path))
+        self._save_cache()
 
-        for offset, length in get_messages_positions(self.path):
-            offsets.append(offset)
-            lengths.append(length)
+    def _save_cache(self):
+        import numpy as np
 
-        self.offsets = offsets
-        self.lengths = lengths
+        try:
+            with open(self.mappings_cache_file, "wb") as f:
+                np.save(f, self.positions, allow_pickle=False)
+        except Exception:
+            LOG.exception("Write to cache failed %s", self.mappings_cache_file)
 
-        self._save_cache()
+    def _load_cache(self):
+        import numpy as np
 
-    def _save_cache(self):
         try:
-            with open(self.mappings_cache_file, "w") as f:
-                json.dump(
+            if os.path.getsize(self.mappings_cache_file) == 0:
+                # Cache file just created, not populated yet
+                return False
+
+            positions = np.load(self.mappings_cache_file, allow_pickle=False)
+            assert positions.ndim == 2 and positions.shape[1] == 2, positions.shape
+            self._set_positions(positions)
+            return True
+        except Exception:
+            LOG.exception("Load from cache failed %s", self.mappings_cache_file)
+
+        return False
+
+    def _encoded_metadata(self, keys):
+        # Metadata columns are built once per key, and cached next
+        # to the offsets so that they survive between sessions
+        if self._columns is None:
+            self._columns = self._load_columns()
+
+        missing = [k for k in keys if k not in self._columns]
+        if missing:
+            self._columns.update(super()._encoded_metadata(missing))
+            self._save_columns()
+
+        return {k: self._columns[k] for k in keys}
+
+    @property
+    def columns_cache_file(self):
+        return auxiliary_cache_file(
+            "grib-metadata-index",
+            self.path,
+            extension=".pickle",
+        )
+
+    def _load_columns(self):
+        try:
+            path = self.columns_cache_file
+            if os.path.getsize(path) == 0:
+                return {}
+
+            with open(path, "rb") as f:
+                c = pickle.load(f)
+                assert c["version"] == self.COLUMNS_VERSION
+                assert c["count"] == len(self), (c["count"], len(self))
+                return c["columns"]
+        except Exception:
+            LOG.exception("Load from cache failed %s", self.path)
+
+        return {}
+
+    def _save_columns(self):
+        try:
+            path = self.columns_cache_file
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(
                     dict(
-                        version=self.VERSION,
-                        offsets=self.offsets,
-                        lengths=self.lengths,
+                        version=self.COLUMNS_VERSION,
+                        count=len(self),
+                        columns=self._columns,
                     ),
                     f,
                 )
+            os.replace(path + ".tmp", path)
         except Exception:
-            LOG.exception("Write to cache failed %s", self.mappings_cache_file)
+            LOG.exception("Write to cache failed %s", self.path)
+
+    def _statistics_cache_file(self, key):
+        return auxiliary_cache_file(
+            "grib-statistics",
+            self.path,
+            index=key,
+            extension=".pickle",
+        )
 
-    def _load_cache(self):
+    def _load_statistics(self, key):
         try:
-            with open(self.mappings_cache_file) as f:
-                c = json.load(f)
-                if not isinstance(c, dict):
-                    return False
-
-                assert c["version"] == self.VERSION
-                self.offsets = c["offsets"]
-                self.lengths = c["lengths"]
-                return True
+            path = self._statistics_cache_file(key)
+            if os.path.getsize(path) == 0:
+                return None
+
+            with open(path, "rb") as f:
+                c = pickle.load(f)
+                assert c["version"] == self.STATISTICS_VERSION
+                assert c["count"] == len(self), (c["count"], len(self))
+                return c["statistics"]
         except Exception:
-            LOG.exception("Load from cache failed %s", self.mappings_cache_file)
+            LOG.exception("Load from cache failed %s", self.path)
 
-        return False
+        return None
+
+    def _save_statistics(self, key, statistics):
+        try:
+            path = self._statistics_cache_file(key)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(
+                    dict(
+                        version=self.STATISTICS_VERSION,
+                        count=len(self),
+                        statistics=statistics,
+                    ),
+                    f,
+                )
+            os.replace(path + ".tmp", path)
+        except Exception:
+            LOG.exception("Write to cache failed %s", self.path)
+
+    @property
+    def availability_index_cache_file(self):
+        return auxiliary_cache_file(
+            "grib-availability",
+            self.path,
+            extension=".pickle",
+        )
+
+    def _availability_signature(self):
+        # The positions of the messages identify the content of the file
+        return hashlib.md5(self.positions.tobytes()).hexdigest()
+
+    def _load_availability_index(self):
+        try:
+            return AvailabilityIndex.from_pickle(
+                self.availability_index_cache_file,
+                signature=self._availability_signature(),
+                ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES,
+            )
+        except Exception:
+            LOG.exception("Load from cache failed %s", self.path)
+
+        return None
+
+    def _save_availability_index(self, index):
+        try:
+            index.to_pickle(self.availability_index_cache_file, signature=self._availability_signature())
+        except Exception:
+            LOG.exception("Write to cache failed %s", self.path)
 
     def part(self, n):
-        return Part(self.path, self.offsets[n], self.lengths[n])
+        return Part(self.path, int(self.offsets[n]), int(self.lengths[n]))
 
     def number_of_parts(self):
         return len(self.offsets)
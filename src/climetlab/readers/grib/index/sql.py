@@ -11,6 +11,7 @@ import logging
 from collections import namedtuple
 
 from climetlab.core.constants import DATETIME
+from climetlab.core.order import Remapping
 from climetlab.core.order import build_remapping
 from climetlab.core.order import normalize_order_by
 from climetlab.core.select import normalize_selection
@@ -21,6 +22,7 @@ from climetlab.indexing.database.sql import SqlDatabase
 from climetlab.indexing.database.sql import SqlOrder
 from climetlab.indexing.database.sql import SqlRemapping
 from climetlab.indexing.database.sql import SqlSelection
+from climetlab.indexing.database.sql import entryname_to_dbname
 from climetlab.readers.grib.index.db import FieldsetInFilesWithDBIndex
 from climetlab.utils.serialise import register_serialisation
 
@@ -38,6 +40,9 @@ class FieldsetInFilesWithSqlIndex(FieldsetInFilesWithDBIndex):
     DBCLASS = SqlDatabase
     DB_CACHE_SIZE = 100_000
     DB_DICT_CACHE_SIZE = 100_000
+    # Databases are built in a temporary file by cache_file(), which
+    # is discarded if anything goes wrong, so there is no need for a journal
+    DB_LOADER_OPTIONS = dict(journal_mode="OFF", synchronous="OFF")
 
     def apply_filters(self, filters):
         obj = self
@@ -67,6 +72,31 @@ class FieldsetInFilesWithSqlIndex(FieldsetInFilesWithDBIndex):
         dic = {k: v for k, v in zip(keys, values)}
         return dic
 
+    def _metadata_columns(self, iterable, names, kinds, remapping):
+        # Read the columns straight from the database, without decoding any field
+        keys = list(self._normalize_kwargs_names(**{k: None for k in names}).keys())
+        dbnames = [entryname_to_dbname(k) for k in keys]
+
+        if (
+            not isinstance(remapping, Remapping)
+            or remapping
+            or len(dbnames) != len(names)
+            or not all(n in self.db.dbkeys for n in dbnames)
+        ):
+            return super()._metadata_columns(iterable, names, kinds, remapping)
+
+        casts = [dict(int=int, float=float, str=str).get(kind) for kind in kinds]
+        columns = [[] for _ in names]
+        appends = [c.append for c in columns]
+
+        for row in self.db._execute_select(dbnames):
+            for v, cast, append in zip(row, casts, appends):
+                if cast is not None and v is not None:
+                    v = cast(v)
+                append(v)
+
+        return columns
+
     def filter(self, filter):
         db = self.db.filter(filter)
         return self.__class__(db=db)
@@ -7,11 +7,20 @@
 # nor does it submit to any jurisdiction.
 #
 
+import collections
 import datetime
 import logging
+import os
+import queue
 import re
+import threading
+from concurrent.futures import Future
+from functools import cached_property
 from io import IOBase
 
+from lru import LRU
+
+from climetlab.core.thread import SoftThreadPool
 from climetlab.decorators import normalize
 from climetlab.decorators import normalize_grib_keys
 from climetlab.utils.humanize import list_to_human
@@ -40,6 +49,20 @@ ORDER = {}
 for i, k in enumerate(_ORDER):
     ORDER[k] = i
 
+# Keys that usually change from one field to the next. They are set last, on a
+# clone of a template where all the other keys have already been set
+VARYING = (
+    "date",
+    "time",
+    "step",
+    "levelist",
+    "level",
+    "number",
+)
+
+# Number of prepared templates kept by each coder
+GRIB_TEMPLATES_CACHE_SIZE = int(os.environ.get("CLIMETLAB_GRIB_TEMPLATES_CACHE_SIZE", 64))
+
 
 def order(key):
     ORDER.setdefault(key, len(ORDER))
@@ -67,12 +90,56 @@ class GribCoder:
         self.template = template
         self._bbox = {}
         self.kwargs = kwargs
+        self._samples = {}
+        self._templates = LRU(GRIB_TEMPLATES_CACHE_SIZE)
+        self._normalized = LRU(GRIB_TEMPLATES_CACHE_SIZE)
+        self._lock = threading.Lock()
 
     @normalize_grib_keys
     @normalize("date", "date")
     def _normalize_kwargs_names(self, **kwargs):
         return kwargs
 
+    @normalize_grib_keys
+    def _kwargs_names(self, **kwargs):
+        return kwargs
+
+    def _normalize_kwargs_names_cached(self, kwargs):
+        if not kwargs:
+            return {}
+
+        # Only the renaming of the keys is cached, the values are those of this call
+        key = tuple(sorted(kwargs))
+        names = self._normalized.get(key)
+        if names is None:
+            names = self._normalized[key] = self._kwargs_names(**{k: k for k in kwargs})
+
+        result = {name: kwargs[k] for name, k in names.items()}
+        if "date" in result:
+            result.update(self._normalize_kwargs_names(date=result["date"]))
+        return result
+
+    @cached_property
+    def _normalized_kwargs(self):
+        return self._normalize_kwargs_names(**self.kwargs)
+
+    def _prepared_template(self, handle, metadata):
+        # Returns a clone of `handle` where all the keys of `metadata` that
+        # are not in VARYING have been set. Templates are shared by all the
+        # fields that only differ by these keys.
+        static = [(k, v) for k, v in metadata.items() if k not in VARYING]
+        key = (id(handle), repr(static))
+
+        with self._lock:
+            base, prepared = self._templates.get(key, (None, None))
+            if base is not handle:
+                prepared = handle.clone()
+                for k, v in static:
+                    prepared.set(k, v)
+                self._templates[key] = (handle, prepared)
+
+            return prepared.clone()
+
     def encode(
         self,
         values,
@@ -83,9 +150,9 @@ class GribCoder:
         **kwargs,
     ):
         # Make a copy as we may modify it
-        md = self._normalize_kwargs_names(**self.kwargs)
-        md.update(self._normalize_kwargs_names(**metadata))
-        md.update(self._normalize_kwargs_names(**kwargs))
+        md = dict(self._normalized_kwargs)
+        md.update(self._normalize_kwargs_names_cached(metadata))
+        md.update(self._normalize_kwargs_names_cached(kwargs))
 
         metadata = md
 
@@ -97,7 +164,7 @@ class GribCoder:
         if template is None:
             handle = self.handle_from_metadata(values, metadata, compulsary)
         else:
-            handle = template.handle.clone()
+            handle = template.handle
 
         # print("->", metadata)
         self.update_metadata(handle, metadata, compulsary)
@@ -125,8 +192,10 @@ class GribCoder:
 
         LOG.debug("GribOutput.metadata %s", metadata)
 
+        handle = self._prepared_template(handle, metadata)
         for k, v in metadata.items():
-            handle.set(k, v)
+            if k in VARYING:
+                handle.set(k, v)
 
         if values is not None:
             handle.set_values(values)
@@ -249,8 +318,12 @@ class GribCoder:
                 choices = list_to_human([f"'{c}'" for c in check], "or")
                 raise ValueError(f"Please provide a value for {choices}.")
 
-        LOG.debug("CodesHandle.from_sample(%s)", sample)
-        return CodesHandle.from_sample(sample)
+        # Samples are never modified, only cloned
+        with self._lock:
+            if sample not in self._samples:
+                LOG.debug("CodesHandle.from_sample(%s)", sample)
+                self._samples[sample] = CodesHandle.from_sample(sample)
+            return self._samples[sample]
 
     def _ll_field(self, values, metadata):
         Nj, Ni = values.shape
@@ -354,10 +427,37 @@ class GribCoder:
 
 
 class GribOutput:
-    def __init__(self, file, split_output=False, template=None, **kwargs):
-        self._files = {}
+    """Writes fields to `file`, which is either a file object or a path. If `split_output`
+    is true, the path is a pattern such as `"{param}.grib"`, formatted with the metadata of
+    each field. At most `max_open_files` files are kept open at the same time, and files are
+    written with buffers of `buffer_size` bytes.
+
+    If `asynchronous` is true, the fields are encoded and written in a background thread,
+    and `write()` returns a Future. At most `queue_size` fields are kept waiting.
+    If `atomic` is true, the files are written under a temporary name, and renamed when the
+    output is closed. If `fsync` is true, the files are synced to disk when closed.
+    """
+
+    def __init__(
+        self,
+        file,
+        split_output=False,
+        template=None,
+        asynchronous=False,
+        queue_size=16,
+        max_open_files=64,
+        buffer_size=4 * 1024 * 1024,
+        fsync=False,
+        atomic=False,
+        **kwargs,
+    ):
+        self._files = LRU(max_open_files, callback=self._evicted)
+        self._paths = {}
         self.fileobj = None
         self.filename = None
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.atomic = atomic
 
         if isinstance(file, IOBase):
             self.fileobj = file
@@ -372,15 +472,49 @@ class GribOutput:
 
         self._coder = GribCoder(template=template, **kwargs)
 
-    def close(self):
+        self._queue = None
+        self._error = None
+        if asynchronous:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+    def close(self, discard=False):
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+
         for f in self._files.values():
-            f.close()
+            self._close_file(f)
+        self._files.clear()
+
+        for path, tmp in self._paths.items():
+            if tmp == path:
+                continue
+            if discard:
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, path)
+        self._paths = {}
+
+        self._raise_error()
+
+    def flush(self):
+        """Waits until all the pending fields are written, and flushes the open files."""
+        if self._queue is not None:
+            self._queue.join()
+
+        for f in self._files.values():
+            f.flush()
+
+        self._raise_error()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, trace):
-        self.close()
+        self.close(discard=exc_type is not None)
 
     def write(
         self,
@@ -390,6 +524,30 @@ class GribOutput:
         template=None,
         **kwargs,
     ):
+        if self._queue is not None:
+            import numpy as np
+
+            self._raise_error()
+
+            # The caller may reuse its buffers as soon as we return
+            if values is not None:
+                values = np.array(values, copy=True)
+
+            future = Future()
+            self._queue.put(
+                (
+                    future,
+                    values,
+                    dict(
+                        check_nans=check_nans,
+                        metadata=dict(metadata),
+                        template=template,
+                        **kwargs,
+                    ),
+                )
+            )
+            return future
+
         handle = self._coder.encode(
             values,
             check_nans=check_nans,
@@ -398,10 +556,81 @@ class GribOutput:
             **kwargs,
         )
 
+        return handle, self._write(handle)
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                future, values, kwargs = item
+                try:
+                    handle = self._coder.encode(values, **kwargs)
+                    future.set_result((handle, self._write(handle)))
+                except Exception as e:
+                    LOG.exception("GribOutput: failed to write field")
+                    if self._error is None:
+                        self._error = e
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, handle):
         file, path = self.f(handle)
-        handle.write(file)
+        # CodesHandle.write() flushes after each message
+        file.write(handle.get_message())
+        return path
 
-        return handle, path
+    def write_many(
+        self,
+        arrays,
+        metadatas,
+        check_nans=False,
+        template=None,
+        nthreads=4,
+        **kwargs,
+    ):
+        """Encodes each array with the corresponding metadata in a pool of `nthreads`
+        threads, and writes the fields in the order they are given. Returns the list
+        of the paths written to."""
+
+        # Fields already queued must be written first
+        self.flush()
+
+        def encode(values, metadata):
+            return self._coder.encode(
+                values,
+                check_nans=check_nans,
+                metadata=metadata,
+                template=template,
+                **kwargs,
+            )
+
+        paths = []
+
+        if nthreads <= 1:
+            for values, metadata in zip(arrays, metadatas):
+                paths.append(self._write(encode(values, metadata)))
+            return paths
+
+        pending = collections.deque()
+        with SoftThreadPool(nthreads=nthreads) as pool:
+            for values, metadata in zip(arrays, metadatas):
+                pending.append(pool.submit(encode, values, metadata))
+                if len(pending) >= 2 * nthreads:
+                    paths.append(self._write(pending.popleft().result()))
+
+            while pending:
+                paths.append(self._write(pending.popleft().result()))
+
+        return paths
 
     def f(self, handle):
         if self.fileobj:
@@ -413,9 +642,23 @@ class GribOutput:
             path = self.filename
 
         if path not in self._files:
-            self._files[path] = open(path, "wb")
+            # Files closed because too many were open are reopened in append mode
+            mode = "ab" if path in self._paths else "wb"
+            if path not in self._paths:
+                self._paths[path] = path + ".tmp" if self.atomic else path
+            self._files[path] = open(self._paths[path], mode, buffering=self.buffer_size)
+
         return self._files[path], path
 
+    def _evicted(self, path, f):
+        self._close_file(f)
+
+    def _close_file(self, f):
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+
 
 def new_grib_output(*args, **kwargs):
     return GribOutput(*args, **kwargs)
@@ -12,26 +12,92 @@ import logging
 LOG = logging.getLogger(__name__)
 
 
-class PandasMixIn:
-    def to_pandas(self, latitude=None, longitude=None, **kwargs):
-        import pandas as pd
+def _point_index(field, latitude, longitude):
+    import numpy as np
+
+    from .points import cached_weights
+
+    def compute():
+        lat, lon = field.grid_points()
+        return np.flatnonzero((lat == latitude) & (lon == longitude))
+
+    return cached_weights(field.geometry, ("point_index", latitude, longitude), compute)
+
+
+def _categorical(values, counts):
+    import numpy as np
+    import pandas as pd
+
+    categories = list(dict.fromkeys(v for v in values if v is not None))
+    codes = {c: i for i, c in enumerate(categories)}
+    codes = np.array([-1 if v is None else codes[v] for v in values], dtype=np.int32)
+    return pd.Categorical.from_codes(np.repeat(codes, counts), categories=categories)
+
+
+def _frame(fields, latitude=None, longitude=None):
+    import numpy as np
+    import pandas as pd
 
-        def ident(x):
-            return x
+    select = latitude is not None or longitude is not None
 
-        filter = ident
+    lats, lons, values, counts = [], [], [], []
+    datetimes, mars = [], []
+    for f in fields:
+        lat, lon = f.grid_points()
+        v = f.values
+
+        if select:
+            index = _point_index(f, latitude, longitude)
+            lat, lon, v = lat[index], lon[index], v[index]
+
+        lats.append(lat)
+        lons.append(lon)
+        values.append(v)
+        counts.append(len(v))
+        datetimes.append(f.valid_datetime())
+        mars.append(f.as_mars())
+
+    if not counts:
+        return pd.DataFrame()
+
+    columns = dict(
+        lat=np.concatenate(lats),
+        lon=np.concatenate(lons),
+        value=np.concatenate(values),
+        datetime=np.repeat(np.array(datetimes, dtype="datetime64[ns]"), counts),
+    )
+
+    # MARS keys are the same for all the points of a field, and often
+    # for many fields, so they are stored as categories
+    for k in dict.fromkeys(k for m in mars for k in m):
+        columns[k] = _categorical([m.get(k) for m in mars], counts)
+
+    return pd.DataFrame(columns)
+
+
+class PandasMixIn:
+    def to_pandas(self, latitude=None, longitude=None, **kwargs):
+        """Returns a DataFrame with one row per grid point and field, with the
+        columns lat, lon, value, datetime, and one categorical column per MARS key.
+        If `latitude` and `longitude` are given, only the matching grid points are returned.
+        """
+        # Some sources pass the options of the readers of other formats, such
+        # as `pandas_read_csv_kwargs`, which do not apply to GRIB
+        unknown = sorted(k for k in kwargs if not k.endswith("_kwargs"))
+        if unknown:
+            raise TypeError(f"to_pandas() got unexpected keyword arguments {unknown}")
 
-        def select_point(d):
-            return [x for x in d if x["lat"] == latitude and x["lon"] == longitude]
+        return _frame(self, latitude=latitude, longitude=longitude)
 
-        if latitude is not None or longitude is not None:
-            filter = select_point
+    def iterate_pandas(self, fields_per_chunk=100, latitude=None, longitude=None):
+        """Same as `to_pandas`, but yields one DataFrame for every `fields_per_chunk` fields,
+        so that large fieldsets can be processed without building a single DataFrame."""
+        chunk = []
+        for f in self:
+            chunk.append(f)
+            if len(chunk) >= fields_per_chunk:
+                yield _frame(chunk, latitude=latitude, longitude=longitude)
+                chunk = []
 
-        frames = []
-        for s in self:
-            df = pd.DataFrame(filter(s.data))
-            df["datetime"] = s.valid_datetime()
-            for k, v in s.as_mars().items():
-                df[k] = v
-            frames.append(df)
-        return pd.concat(frames)
+        if chunk:
+            yield _frame(chunk, latitude=latitude, longitude=longitude)
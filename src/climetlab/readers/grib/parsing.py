@@ -10,7 +10,6 @@ import datetime
 import logging
 import os
 import sys
-import time
 from multiprocessing import Process
 from multiprocessing import Queue
 
@@ -164,6 +163,7 @@ class GribIndexingDirectoryParserIterator:
         followlinks=True,
         verbose=False,
         with_statistics=True,
+        workers=None,
     ):
         self.db_path = db_path
         self.extensions = set(extensions)
@@ -172,6 +172,7 @@ class GribIndexingDirectoryParserIterator:
         self.followlinks = followlinks
         self.verbose = verbose
         self.with_statistics = with_statistics
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
 
         self._tasks = None
 
@@ -181,70 +182,186 @@ class GribIndexingDirectoryParserIterator:
         return SqlDatabase(self.db_path)
 
     def worker(self, i):
-        _i = i
-        time.sleep(i)
+        # Workers only parse files, all writes to the database are done
+        # by the parent process, see load_database()
         while True:
-            task = self.q_in.get()
-            if task is None:
+            path = self.q_in.get()
+            if path is None:
                 break
-            n = self.process_path(_i, task)
-            self.q_out.put(n)
+            self.q_out.put((path, self.parse_path(i, path)))
 
     def load_database(self):
         start = datetime.datetime.now()
 
-        n_proc = 5
-        if sys.platform == "win32":
-            n_proc = 1  # deactivate multiprocessing for window
+        db = self._new_db()
+        db.set_journal_mode("WAL")
 
-        if n_proc == 1:
-            count = 0
-            for path in self.tasks:
-                count += self.process_path(0, path)
-        else:
-            assert n_proc > 1, n_proc
+        availability = self._load_availability_index(db)
 
-            self.q_in = Queue()
-            self.q_out = Queue()
+        diff = self.diff(db)
 
-            workers = []
-            for i in range(n_proc):
-                proc = Process(target=self.worker, args=(i,))
-                proc.start()
-                workers.append(proc)
+        # Files recorded by older versions get their stats, so their changes are detected from now on
+        unrecorded = {self._format_path(path): stat for path, stat in diff["unrecorded"]}
+        if unrecorded:
+            db.update_paths_stats(unrecorded)
 
-            for path in self.tasks:
-                self.q_in.put(path)
+        # Entries of modified files are removed and the files parsed again
+        obsolete = diff["removed"] + [self._format_path(path) for path, _ in diff["modified"]]
+        if obsolete:
+            db.remove_paths(obsolete)
+            if availability is not None:
+                availability.remove(*obsolete)
 
-            for i in range(n_proc):
-                self.q_in.put(None)
+        tasks = sorted(diff["added"] + diff["modified"])
+        stats = {self._format_path(path): stat for path, stat in tasks}
+        tasks = [path for path, _ in tasks]
 
-            count = 0
-            for _ in progress_bar(
-                desc="Indexing...",
-                iterable=self.tasks,
-                total=len(self.tasks),
-            ):
-                count += self.q_out.get()
+        workers = self.workers
+        if sys.platform == "win32":
+            workers = 1  # deactivate multiprocessing for window
+        workers = max(1, min(workers, len(tasks)))
 
-            for p in workers:
-                p.join()
+        pbar = progress_bar(desc="Indexing", total=len(tasks))
 
-            del self.q_in
-            del self.q_out
+        count = 0
+        for path, entries in self._parse_tasks(tasks, workers):
+            n = self.write_entries(db, path, entries, stats)
+            if availability is not None:
+                availability.add(entries)
+            count += n
+            pbar.set_postfix_str(f"{os.path.basename(path)}: {plural(n, 'field')}")
+            pbar.update(1)
+
+        pbar.close()
 
-        self._new_db().build_indexes()
+        db.build_indexes()
+        db.set_journal_mode("DELETE")
+
+        if availability is not None and (tasks or obsolete or unrecorded):
+            self._save_availability_index(db, availability)
 
         end = datetime.datetime.now()
-        print(f"Indexed {plural(count,'field')} in {seconds(end - start)}.")
+        print(
+            f"Indexed {plural(count,'field')} in {seconds(end - start)}"
+            f" ({len(diff['added'])} new, {len(diff['modified'])} modified,"
+            f" {len(diff['removed'])} removed, {len(diff['unchanged'])} unchanged files)."
+        )
+        return count
+
+    def _load_availability_index(self, db):
+        # The availability index is updated along with the database, as long as
+        # it matches its content. Otherwise it will be rebuilt when needed.
+        from climetlab.indexing.database import AVAILABILITY_IGNORE_KEY_NAMES
+        from climetlab.utils.availability import AvailabilityIndex
+
+        stats = db.paths_stats()
+        if not stats:
+            return AvailabilityIndex(ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES)
 
-    def process_path(self, i, path):
-        db = self._new_db()
+        try:
+            return AvailabilityIndex.from_pickle(
+                db.availability_index_path,
+                signature=db.paths_signature(stats),
+                ignore_keys=AVAILABILITY_IGNORE_KEY_NAMES,
+            )
+        except Exception:
+            LOG.exception("Cannot load %s", db.availability_index_path)
 
-        if db.already_loaded(self._format_path(path), self):
-            LOG.warning(f"Skipping {path}, already loaded")
+        return None
+
+    def _save_availability_index(self, db, availability):
+        try:
+            availability.to_pickle(db.availability_index_path, signature=db.paths_signature())
+        except Exception:
+            LOG.exception("Cannot write %s", db.availability_index_path)
+
+    def diff(self, db):
+        """Compare the files in the directory with the ones recorded in the database.
+        Returns a dictionary with the lists of "added", "modified" and "unchanged" files,
+        as (path, stat) tuples, and the list of "removed" keys of the database.
+        Files recorded without stats by older versions are considered unchanged, and
+        are also listed as "unrecorded".
+        """
+        self._tasks = None  # Look for new files
+        known = db.paths_stats()
+        diff = dict(added=[], modified=[], removed=[], unchanged=[], unrecorded=[])
+
+        seen = set()
+        for path in self.tasks:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                LOG.error(f"Cannot stat {path}: {e}")
+                continue
+
+            stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+            key = self._format_path(path)
+            seen.add(key)
+
+            if key not in known:
+                diff["added"].append((path, stat))
+            elif known[key] is None:
+                diff["unchanged"].append((path, stat))
+                diff["unrecorded"].append((path, stat))
+            elif tuple(known[key]) == stat:
+                diff["unchanged"].append((path, stat))
+            else:
+                diff["modified"].append((path, stat))
+
+        diff["removed"] = sorted(k for k in known if k not in seen)
+
+        if self.verbose:
+            for what in ("added", "modified"):
+                for path, _ in diff[what]:
+                    print(f"{what}: {path}")
+            for key in diff["removed"]:
+                print(f"removed: {key}")
+
+        return diff
+
+    def _parse_tasks(self, tasks, workers):
+        if workers == 1:
+            for path in tasks:
+                yield path, self.parse_path(0, path)
+            return
+
+        self.q_in = Queue()
+        self.q_out = Queue()
+
+        procs = []
+        for i in range(workers):
+            proc = Process(target=self.worker, args=(i,))
+            proc.start()
+            procs.append(proc)
+
+        for path in tasks:
+            self.q_in.put(path)
+
+        for i in range(workers):
+            self.q_in.put(None)
+
+        try:
+            for _ in range(len(tasks)):
+                yield self.q_out.get()
+        finally:
+            for p in procs:
+                p.join()
+
+            del self.q_in
+            del self.q_out
+
+    def write_entries(self, db, path, entries, stats=None):
+        if not entries:
+            # Recorded anyway, so the file is not parsed again until it changes
+            key = self._format_path(path)
+            db.record_paths({key: (stats or {}).get(key)})
             return 0
+        LOG.debug(f"Loading {len(entries)} entries from {path}")
+        # The database is in WAL mode while loading, where synchronous=NORMAL
+        # is still safe against corruption
+        return db.load_iterator(entries, stats=stats, synchronous="NORMAL")
 
+    def parse_path(self, i, path):
         lst = []
         LOG.debug(f"Parsing file {path}")
 
@@ -258,16 +375,15 @@ class GribIndexingDirectoryParserIterator:
                 lst.append(field)
         except PermissionError as e:
             LOG.error(f"Could not read {path}: {e}")
-            return 0
+            return []
         except Exception as e:
             LOG.exception(f"(grib-parsing) Ignoring {path}, {e}")
-            return 0
+            return []
 
         if not lst:
             LOG.warn(f"No entry found in {path}.")
-            return 0
 
-        return db.load_iterator(lst)
+        return lst
 
     @property
     def tasks(self):
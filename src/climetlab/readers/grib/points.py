@@ -0,0 +1,209 @@
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import logging
+import os
+
+import numpy as np
+from lru import LRU
+
+LOG = logging.getLogger(__name__)
+
+# Number of locations and of grid points compared at once when scipy is not available
+BRUTE_FORCE_CHUNK_SIZE = 64
+BRUTE_FORCE_GRID_CHUNK_SIZE = 65536
+
+# Number of sets of interpolation weights kept for each grid
+POINTS_WEIGHTS_CACHE_SIZE = int(os.environ.get("CLIMETLAB_POINTS_WEIGHTS_CACHE_SIZE", 8))
+
+
+def unit_sphere(lat, lon):
+    """Returns the (n, 3) cartesian coordinates of the points on the unit sphere."""
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+class _BruteForceTree:
+    # Same interface as scipy's cKDTree.query(), for k=1. The nearest point
+    # on the sphere is the one with the largest dot product. The grid is
+    # compared by chunks, keeping the best point so far, so that memory
+    # does not depend on the size of the grid.
+    def __init__(self, xyz):
+        self.xyz = xyz
+
+    def query(self, points):
+        result = np.empty(len(points), dtype=np.int64)
+        for i in range(0, len(points), BRUTE_FORCE_CHUNK_SIZE):
+            chunk = points[i : i + BRUTE_FORCE_CHUNK_SIZE]
+            rows = np.arange(len(chunk))
+            best = np.full(len(chunk), -np.inf)
+            index = np.zeros(len(chunk), dtype=np.int64)
+            for j in range(0, len(self.xyz), BRUTE_FORCE_GRID_CHUNK_SIZE):
+                dot = chunk @ self.xyz[j : j + BRUTE_FORCE_GRID_CHUNK_SIZE].T
+                k = np.argmax(dot, axis=1)
+                better = dot[rows, k] > best
+                best[better] = dot[rows, k][better]
+                index[better] = k[better] + j
+            result[i : i + len(chunk)] = index
+        return None, result
+
+
+def spatial_index(xyz):
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        LOG.debug("scipy not available, using brute force nearest neighbours search")
+        return _BruteForceTree(xyz)
+
+    return cKDTree(xyz)
+
+
+def cached_weights(geometry, key, compute):
+    """Returns the weights, or other values depending on a list of locations, of `key`
+    for the grid `geometry`. Only the most recently used ones are kept, as each list of
+    locations adds a new entry."""
+    cache = geometry.get("weights", lambda: LRU(POINTS_WEIGHTS_CACHE_SIZE))
+    result = cache.get(key)
+    if result is None:
+        result = cache[key] = compute()
+    return result
+
+
+def nearest_weights(field, lats, lons):
+    geometry = field.geometry
+
+    def tree():
+        return spatial_index(unit_sphere(*field.grid_points()))
+
+    def compute():
+        _, index = geometry.get("spatial_index", tree).query(unit_sphere(lats, lons))
+        index = index.reshape(-1, 1)
+        weights = np.ones((len(lats), 1))
+
+        # Locations outside of a regional grid get missing values
+        outside = _outside(geometry.get("domain", lambda: _domain(field)), lats, lons)
+        index[outside] = 0
+        weights[outside] = np.nan
+        return index, weights
+
+    return cached_weights(geometry, ("nearest", lats.tobytes(), lons.tobytes()), compute)
+
+
+def _domain(field):
+    """Returns the `(south, north, west, east)` bounds of the grid of `field`,
+    or None if the grid goes all around the globe. `west` can be larger
+    than `east` if the grid crosses the meridian where longitudes wrap."""
+    lat, lon = field.grid_points()
+    x = np.unique(np.mod(lon, 360))
+    if len(x) < 2:
+        return None
+
+    # The grid is regional if one of the gaps between its longitudes,
+    # going all around the globe, is much larger than the others
+    gaps = np.diff(np.append(x, x[0] + 360))
+    k = np.argmax(gaps)
+    if gaps[k] <= 2 * np.partition(gaps, -2)[-2]:
+        return None
+
+    return np.min(lat), np.max(lat), x[(k + 1) % len(x)], x[k]
+
+
+def _outside(domain, lats, lons):
+    if domain is None:
+        return np.zeros(len(lats), dtype=bool)
+
+    south, north, west, east = domain
+    return (lats < south) | (lats > north) | (np.mod(lons - west, 360) > np.mod(east - west, 360))
+
+
+def _regular_axes(field):
+    shape = field.shape
+    lat, lon = field.grid_points()
+    if len(shape) != 2:
+        raise NotImplementedError(f"Bilinear interpolation not supported for grid {field.grid_type}")
+
+    lat, lon = lat.reshape(shape), lon.reshape(shape)
+    ys, xs = lat[:, 0], lon[0, :]
+    regular = np.array_equal(lat, np.broadcast_to(ys[:, None], shape))
+    regular = regular and np.array_equal(lon, np.broadcast_to(xs, shape))
+    if not regular:
+        raise NotImplementedError(f"Bilinear interpolation not supported for grid {field.grid_type}")
+
+    return ys, xs
+
+
+def _axis_position(axis, values):
+    # Returns the index of the left neighbour of each value, the distance
+    # to it as a fraction of the interval, and whether the value is outside
+    # of the axis
+    outside = (values < axis[0]) | (values > axis[-1])
+    i = np.clip(np.searchsorted(axis, values, side="right") - 1, 0, len(axis) - 2)
+    t = (values - axis[i]) / (axis[i + 1] - axis[i])
+    return i, t, outside
+
+
+def bilinear_weights(field, lats, lons):
+    def compute():
+        ys, xs = _regular_axes(field)
+        ny, nx = len(ys), len(xs)
+
+        descending = ys[0] > ys[-1]
+        j, t, outside_y = _axis_position(ys[::-1] if descending else ys, lats)
+        j0, j1 = j, j + 1
+        if descending:
+            j0, j1 = ny - 1 - j0, ny - 1 - j1
+
+        # Global grids wrap around the last meridian
+        step = xs[1] - xs[0]
+        x = xs
+        if np.isclose(xs[-1] - xs[0] + step, 360):
+            x = np.append(xs, xs[0] + 360)
+
+        i, u, outside_x = _axis_position(x, (lons - xs[0]) % 360 + xs[0])
+        i0, i1 = i, (i + 1) % nx
+
+        index = np.column_stack([j0 * nx + i0, j0 * nx + i1, j1 * nx + i0, j1 * nx + i1])
+        weights = np.column_stack([(1 - t) * (1 - u), (1 - t) * u, t * (1 - u), t * u])
+
+        # Locations outside of a regional grid get missing values
+        outside = outside_y | outside_x
+        index[outside] = 0
+        weights[outside] = np.nan
+        return index, weights
+
+    return cached_weights(field.geometry, ("bilinear", lats.tobytes(), lons.tobytes()), compute)
+
+
+METHODS = {
+    "nearest": nearest_weights,
+    "bilinear": bilinear_weights,
+}
+
+
+class PointsMixIn:
+    def extract_points(self, lats, lons, method="nearest"):
+        """Returns the values of all fields at the given locations, as an array of
+        shape (number of fields, number of locations). The spatial index and the
+        interpolation weights are computed once per grid, and reused by all fields
+        defined on that grid. The values at locations outside of a regional grid are NaN."""
+        if method not in METHODS:
+            raise ValueError(f"Invalid method '{method}', values are {sorted(METHODS)}")
+        weights = METHODS[method]
+
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        if lats.shape != lons.shape:
+            raise ValueError(f"lats and lons must have the same shape, got {lats.shape} and {lons.shape}")
+
+        result = np.empty((len(self), len(lats)))
+        for i, f in enumerate(self):
+            index, w = weights(f, lats, lons)
+            result[i] = np.einsum("ij,ij->i", f.values[index], w)
+        return result
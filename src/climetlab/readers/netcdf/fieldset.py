@@ -7,6 +7,7 @@
 # nor does it submit to any jurisdiction.
 #
 
+import os
 from functools import cached_property
 from itertools import product
 
@@ -22,6 +23,43 @@ from .coords import TimeCoordinate
 from .dataset import DataSet
 from .field import NetCDFField
 
+# Upper bound of the size of the hyperslabs read by NetCDFFieldSet.to_numpy()
+NETCDF_SLAB_SIZE = int(os.environ.get("CLIMETLAB_NETCDF_SLAB_SIZE", 256 * 1024 * 1024))
+
+# Hyperslabs can include fields that are not selected, as long as they
+# are less than this many times larger than the selected fields
+NETCDF_SLAB_WASTE = 2
+
+
+def _split_slab(data_array, positions, indices):
+    """Splits a group of fields of `data_array`, at the given `positions` in the output and
+    `indices` in the leading dimensions of the variable, into hyperslabs that are dense enough
+    and smaller than NETCDF_SLAB_SIZE. Splits are made on the boundaries of the chunks of the file.
+    """
+    import numpy as np
+
+    lo = indices.min(axis=0)
+    hi = indices.max(axis=0) + 1
+    box = int(np.prod(hi - lo))
+    size = box * data_array.shape[-2] * data_array.shape[-1] * data_array.dtype.itemsize
+
+    if box == 1 or (box <= NETCDF_SLAB_WASTE * len(positions) and size <= NETCDF_SLAB_SIZE):
+        yield positions, indices, lo, hi
+        return
+
+    # Split along the longest dimension, keeping the fields of a chunk together
+    d = int(np.argmax(hi - lo))
+    chunks = data_array.encoding.get("chunksizes")
+    keys = indices[:, d] // (chunks[d] if chunks else 1)
+    if keys.min() == keys.max():
+        keys = indices[:, d]
+
+    unique = np.unique(keys)
+    left = keys <= unique[(len(unique) - 1) // 2]
+
+    yield from _split_slab(data_array, positions[left], indices[left])
+    yield from _split_slab(data_array, positions[~left], indices[~left])
+
 
 class NetCDFFieldSet(FieldSet):
     @classmethod
@@ -135,6 +173,84 @@ class NetCDFFieldSet(FieldSet):
 
         return fields
 
+    def _slabs(self):
+        """Groups consecutive fields of the same variable into hyperslabs, as tuples
+        (data_array, positions, indices, lo, hi), where `positions` are the positions of
+        the fields in the fieldset and `indices` their indices in the leading dimensions of the
+        variable, the hyperslab spanning `lo` to `hi`. Returns None if a field is not a 2D slice
+        of a variable.
+        """
+        import numpy as np
+
+        groups = []
+        for i, field in enumerate(self.fields):
+            if not isinstance(field, NetCDFField):
+                return None
+
+            key = (id(field.owner), field.variable)
+            if not groups or groups[-1][0] != key:
+                data_array = field.owner.xr_dataset[field.variable]
+                groups.append((key, data_array, data_array.dims[:-2], [], []))
+
+            _, _, dims, positions, indices = groups[-1]
+            index = {s.name: s.index for s in field.slices}
+            if sorted(index) != sorted(dims):
+                return None
+
+            positions.append(i)
+            indices.append([index[d] for d in dims])
+
+        slabs = []
+        for _, data_array, dims, positions, indices in groups:
+            positions = np.array(positions, dtype=np.int64)
+            indices = np.array(indices, dtype=np.int64).reshape(len(positions), len(dims))
+            for slab in _split_slab(data_array, positions, indices):
+                slabs.append((data_array,) + slab)
+        return slabs
+
+    def to_numpy(self, *args, out=None, dtype=None, nthreads=1, reshape=True, **kwargs):
+        """Read all fields into a single array of shape (len(self), *field_shape).
+        Consecutive fields of the same variable are read with one hyperslab per group
+        of contiguous slices, instead of one read per field. `nthreads` is ignored as
+        the netCDF library is not thread-safe, see `Index.to_numpy()` for the other arguments.
+        """
+        import numpy as np
+
+        slabs = None if args or kwargs or len(self) == 0 else self._slabs()
+        if not slabs:
+            return super().to_numpy(*args, out=out, dtype=dtype, nthreads=nthreads, reshape=reshape, **kwargs)
+
+        template = slabs[0][0]
+        shape = (len(self),) + template.shape[-2:]
+
+        if out is None:
+            result = out = np.empty(shape, dtype=template.dtype if dtype is None else dtype)
+            if not reshape:
+                result = result.reshape(len(self), -1)
+        else:
+            result = out
+            out = out.reshape(shape)
+            if not np.may_share_memory(out, result):
+                raise ValueError(f"Cannot decode into a non-contiguous array of shape {result.shape}")
+
+        for data_array, positions, indices, lo, hi in slabs:
+            if data_array.shape[-2:] != shape[1:]:
+                raise ValueError(f"Element {positions[0]} has shape {data_array.shape[-2:]}, expected {shape[1:]}")
+
+            dims = data_array.dims[:-2]
+            values = data_array.isel({d: slice(a, b) for d, a, b in zip(dims, lo, hi)}).values
+            values = values.reshape((-1,) + shape[1:])
+
+            flat = np.ravel_multi_index(tuple((indices - lo).T), tuple(hi - lo))
+            start, count = positions[0], len(positions)
+            if np.array_equal(positions, np.arange(start, start + count)) and np.array_equal(flat, np.arange(count)):
+                # The hyperslab holds exactly these fields, in the same order
+                out[start : start + count] = values
+            else:
+                out[positions] = values[flat]
+
+        return result
+
     def to_xarray(self, **kwargs):
         import xarray as xr
 
@@ -15,6 +15,8 @@ from tqdm import tqdm
 
 import climetlab as cml
 
+from .benchmarks.grib_indexer import benchmark as benchmark_grib_indexer
+from .benchmarks.grib_scanner import benchmark as benchmark_grib_scanner
 from .benchmarks.indexed_url import benchmark as benchmark_indexed_url
 from .tools import experimental
 from .tools import parse_args
@@ -164,12 +166,23 @@ class BenchmarkCmd:
     @parse_args(
         indexedurl=dict(
             action="store_true",
-            help="Benchmark on using indexed URL (byte-range) and various servers.",
+            help=(
+                "Benchmark the download of indexed URLs (byte-ranges) from a local server,"
+                " arguments are the latency (ms), the bandwidth (MiB/s) and the number of fields."
+            ),
         ),
         dataloading=dict(
             action="store_true",
             help="Test loading some data.",
         ),
+        gribscanner=dict(
+            action="store_true",
+            help="Compare GRIB message scanners on synthetic GRIB1/GRIB2 files.",
+        ),
+        gribindexer=dict(
+            action="store_true",
+            help="Measure the GRIB directory indexer throughput on synthetic files.",
+        ),
         nargs=dict(nargs="*"),
         all=dict(action="store_true", help="Run all benchmarks."),
     )
@@ -178,8 +191,16 @@ class BenchmarkCmd:
         """Run predefined benchmarks, for CliMetLab development purposes."""
         if args.all or args.indexedurl:
             print("Starting benchmark.")
-            benchmark_indexed_url()
+            benchmark_indexed_url(*args.nargs[:3])
 
         if args.all or args.dataloading:
             print("Starting benchmark.")
             benchmark_dataloading(*args.nargs)
+
+        if args.all or args.gribscanner:
+            print("Starting benchmark.")
+            benchmark_grib_scanner(*[int(n) for n in args.nargs[:2]])
+
+        if args.all or args.gribindexer:
+            print("Starting benchmark.")
+            benchmark_grib_indexer(*[int(n) for n in args.nargs[:2]])
@@ -0,0 +1,48 @@
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import os
+import time
+
+from climetlab.core.temporary import temp_directory
+from climetlab.readers.grib.parsing import GribIndexingDirectoryParserIterator
+
+from .grib_scanner import make_synthetic_file
+
+
+def make_synthetic_directory(directory, files, fields_per_file):
+    for i in range(files):
+        sample = "regular_ll_sfc_grib2" if i % 2 else "regular_ll_sfc_grib1"
+        make_synthetic_file(os.path.join(directory, f"data-{i:05d}.grib"), sample, fields_per_file)
+
+
+def benchmark(files=100, fields_per_file=100, workers=(1, 2, 4, 8)):
+    with temp_directory() as tmpdir:
+        directory = os.path.join(tmpdir, "data")
+        os.mkdir(directory)
+        make_synthetic_directory(directory, files, fields_per_file)
+
+        print(f"Indexing {files:,} files of {fields_per_file:,} fields")
+
+        for n in workers:
+            db_path = os.path.join(tmpdir, f"index-{n}.db")
+            parser = GribIndexingDirectoryParserIterator(
+                directory,
+                db_path=db_path,
+                relative_paths=True,
+                with_statistics=True,
+                workers=n,
+            )
+
+            start = time.time()
+            count = parser.load_database()
+            elapsed = time.time() - start
+
+            assert count == files * fields_per_file, (count, files, fields_per_file)
+            print(f"  workers={n}: {count / elapsed:,.0f} fields/s")
@@ -0,0 +1,67 @@
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import os
+import time
+
+import eccodes
+
+from climetlab.core.temporary import temp_directory
+from climetlab.readers.grib.codes import get_messages_positions
+from climetlab.readers.grib.codes import get_messages_positions_with_read
+from climetlab.utils.humanize import bytes as humanize_bytes
+from climetlab.utils.humanize import seconds
+
+SAMPLES = {
+    "grib1": "regular_ll_sfc_grib1",
+    "grib2": "regular_ll_sfc_grib2",
+}
+
+
+def make_synthetic_file(path, sample, count, padding=0):
+    """Write `count` copies of an ecCodes sample in `path`, with
+    `padding` bytes of garbage between messages to force resynchronisation."""
+    handle = eccodes.codes_new_from_samples(sample, eccodes.CODES_PRODUCT_GRIB)
+    try:
+        message = eccodes.codes_get_message(handle)
+    finally:
+        eccodes.codes_release(handle)
+
+    with open(path, "wb") as f:
+        for _ in range(count):
+            f.write(message)
+            if padding:
+                f.write(b"\0" * padding)
+
+
+def _time(scanner, path):
+    start = time.time()
+    result = list(scanner(path))
+    return time.time() - start, result
+
+
+def benchmark(count=100_000, padding=0):
+    with temp_directory() as tmpdir:
+        for name, sample in SAMPLES.items():
+            path = os.path.join(tmpdir, f"synthetic.{name}")
+            make_synthetic_file(path, sample, count, padding=padding)
+            size = os.path.getsize(path)
+
+            print(f"{name}: {count:,} messages, {humanize_bytes(size)}, padding={padding}")
+
+            elapsed_read, expected = _time(get_messages_positions_with_read, path)
+            elapsed_mmap, result = _time(get_messages_positions, path)
+
+            assert result == expected, f"Scanners disagree on {path}"
+            assert len(result) == count, (len(result), count)
+
+            print(f"  read() scanner: {seconds(elapsed_read)}")
+            print(f"  mmap scanner:   {seconds(elapsed_mmap)}")
+            if elapsed_mmap:
+                print(f"  speedup:        {elapsed_read / elapsed_mmap:.1f}x")
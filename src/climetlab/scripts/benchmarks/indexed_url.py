@@ -7,242 +7,110 @@
 # nor does it submit to any jurisdiction.
 #
 
+"""Benchmark the download of byte ranges of an URL, as done for indexed URLs, from a local
+HTTP server with a given latency and bandwidth, so that results do not depend on the network."""
 
+import random
 import time
 
-from climetlab import load_source
-from climetlab.core.statistics import collect_statistics
-from climetlab.core.statistics import retrieve_statistics
-
-CML_BASEURL_S3 = "https://object-store.os-api.cci1.ecmwf.int/climetlab"
-CML_BASEURL_CDS = "https://datastore.copernicus-climate.eu/climetlab"
-CML_BASEURL_GET = "https://get.ecmwf.int/repository/test-data/climetlab"
-
-
-def get_methods_list():
-    methods = []
-    # methods.append("cluster(2)|blocked(256)")
-    # methods.append("cluster(5)|blocked(4096)")
-    for i in [10, 100]:
-        for j in [12, 16, 24]:
-            methods.append(f"cluster({i})|blocked({2**j})")
-
-    # for i in range(1,10,2):
-    #     methods.append(f"sharp({10**i},1)")
-
-    # for i in [1, 2, 3, 4, 5, 7, 10, 20, 50, 100, 500, 1000]:
-    for i in [1, 5, 10, 50, 100]:
-        methods.append(f"cluster({i})")
-
-    methods.append("auto")
-
-    for i in range(8, 25, 4):
-        methods.append(f"blocked({2**i})")
-
-    return methods
-
-
-def check_grib_value(value, requested):
-    if isinstance(requested, (list, tuple)):
-        return any([check_grib_value(value, _v) for _v in requested])
-    else:
-        try:
-            return int(value) == int(requested)
-        except (TypeError, ValueError):
-            return str(value) == str(requested)
-
-
-def retrieve_and_check(index, request, range_method=None, **kwargs):
-    print("--------")
-    parts = index.get_path_offset_length(request)
-    print("range_method", range_method)
-    print("REQUEST", request)
-    for url, p in parts:
-        total = len(index.get_backend(url).entries)
-        print(f"PARTS: {len(p)}/{total} parts in {url}")
-
-    ####################
-    # from climetlab import load_source
-    # from climetlab.indexing import PerUrlIndex
-    #
-    # baseurl = "https://datastore.copernicus-climate.eu/climetlab"
-    # s = load_source(
-    #     "indexed-urls",
-    #     PerUrlIndex(
-    #         f"{baseurl}/test-data/input/indexed-urls/large_grib_1.grb",
-    #     ),
-    #     {"param": "r", "time": "1200"},
-    #     range_method="auto",
-    #     force=True,
-    # )
-    # assert 0, "Stop here"
-    ####################
-
-    now = time.time()
-    s = load_source("indexed-urls", index, request, range_method=range_method, **kwargs)
-    elapsed = time.time() - now
-    print("ELAPSED", elapsed)
-    try:
-        paths = [s.path]
-    except AttributeError:
-        paths = [p.path for p in s.sources]
-
-    for path in paths:
-        # check that the downloaded gribs match the request
-        for grib in load_source("file", path):
-            for k, v in request.items():
-                if k == "param":
-                    k = "shortName"
-                assert check_grib_value(grib._get(k), v), (grib._get(k), v)
-    return elapsed
-
-
-def radix(long, sep="("):
-    assert long is not None, long
-    if not isinstance(long, str):
-        return long
-    if sep not in long:
-        return long
-    return long.split(sep)[0]
-
-
-def url_to_server(url):
-    if url.startswith(CML_BASEURL_S3):
-        return "EWC"
-    if url.startswith(CML_BASEURL_CDS):
-        return "CDS"
-    if url.startswith(CML_BASEURL_GET):
-        return "GET"
-    return "Other"
-
-
-def benchmark():
-    collect_statistics(True)
-
-    baseurls = [
-        CML_BASEURL_S3,
-        CML_BASEURL_CDS,
-        # CML_BASEURL_GET,
-    ]
-
-    requests = [
-        {"param": "r", "time": "1000", "step": "0"},
-        {"param": "r", "time": "1000"},
-        {"param": "r", "time": ["1100", "1200", "1300", "1400"]},
-        {
-            "param": ["r", "z"],
-            "time": ["0200", "1000", "1800", "2300"],
-            "levelist": ["500", "850"],
-        },
-        {"param": ["r", "z"], "levelist": ["500", "850"]},
-        {"param": "r"},
-        # {"param": ["r", "z"]},
-        {"param": ["r", "z", "t"]},
-        # {},
-    ]
-
-    methods = get_methods_list()
-
-    # requests = [requests[2]]
-    # methods = [methods[0]]
-    # baseurls = [baseurls[0]]
-    # requests = requests[::2]
-    # methods = methods[::2]
-    # baseurls = [baseurls[0]]
-    failed = []
-    successfull = 0
-    import tqdm
-
-    from climetlab.indexing import PerUrlIndex
-
-    for request in tqdm.tqdm(requests):
-        for range_method in tqdm.tqdm(methods):
-            for baseurl in baseurls:
-                index = PerUrlIndex(
-                    f"{baseurl}/test-data/input/indexed-urls/large_grib_1.grb",
-                )
-                try:
-                    retrieve_and_check(
-                        index,
-                        request,
-                        range_method,
-                        force=True,
-                    )
-                    successfull += 1
-                except Exception as e:
-                    failed.append((index, request, range_method))
-                    print("FAILED for ", index, request, range_method)
-                    print(e)
-
-    stats = retrieve_statistics()
-
-    run_id = get_run_id()
-
-    logfiles = []
-
-    path = f"climetlab_benchmark{run_id}.json"
-    logfiles.append(path)
-    stats.write_to_json(path)
-    print(f"BENCHMARK FINISHED. Raw logs saved in {path}")
-
-    df = stats.to_pandas()
-
-    df["server"] = df["url"].apply(url_to_server)
-    df["speed"] = df["total"] / df["elapsed"] / (1024 * 1024)  # MB/s
-    df["method"] = df["full_method"].apply(radix)
-
-    df = df.rename(
-        dict(
-            size_parts="size_requested",
-            size_blocks="size_downloaded",
+from climetlab.core.settings import SETTINGS
+from climetlab.core.temporary import temp_directory
+from climetlab.sources.url import download_and_cache
+from climetlab.sources.url import download_parts_and_cache
+from climetlab.testing import range_server
+
+FIELD_SIZE = 1024 * 1024
+PARAMS = ("z", "t", "u", "v")
+
+# Selections are in the order of the index, not of the fields in the file
+SELECTIONS = {
+    "one field": lambda f: f["param"] == "t" and f["step"] == 0,
+    "one param": lambda f: f["param"] == "t",
+    "two params": lambda f: f["param"] in ("t", "u"),
+    "first half": lambda f: f["step"] < f["steps"] // 2,
+}
+
+METHODS = [
+    ("multiurl", "auto"),
+    ("multiurl", "cluster(10)|blocked(4096)"),
+    ("multiurl", "blocked(4096)"),
+    ("concurrent", "0"),
+    ("concurrent", "1M"),
+    ("concurrent", "4M"),
+]
+
+
+def make_fields(count, seed=0):
+    """Layout of a GRIB file: fields of various sizes, ordered by step then param."""
+    rng = random.Random(seed)
+    steps = -(-count // len(PARAMS))
+    fields = []
+    offset = 0
+    for i in range(count):
+        length = rng.randint(FIELD_SIZE // 2, FIELD_SIZE * 3 // 2)
+        fields.append(
+            dict(
+                param=PARAMS[i % len(PARAMS)],
+                step=i // len(PARAMS),
+                steps=steps,
+                offset=offset,
+                length=length,
+            )
         )
-    )
-    df["size_ratio"] = df["size_downloaded"] / df["size_requested"]
+        offset += length
+    return fields, offset
 
-    path = f"climetlab_benchmark{run_id}.csv"
-    df.to_csv(path)
-    # df.to_csv("climetlab_benchmark.csv")
-    logfiles.append(path)
 
-    print(f"Benchmark finished ({successfull} successfull, {len(failed)} failed).")
-    print(
-        "All data in the log files are anonymous."
-        "Only the log file names contain personal data (machine name, IP, etc.)."
-    )
-    for f in logfiles:
-        print(f"Log file: {f}")
+def download(method, option, url, parts):
+    if method == "multiurl":
+        return download_and_cache(url, parts=parts, range_method=option, force=True)
 
+    with SETTINGS.temporary("url-ranges-gap", option):
+        return download_parts_and_cache(url, parts, force=True)
 
-def get_run_id(keys=("hostname", "ip", "date", "user", "time")):
-    run_id = ""
 
-    import datetime
+def benchmark(latency=50, bandwidth=20, count=64):
+    """Latency is in milliseconds, bandwidth is in MiB/s per connection."""
 
-    now = datetime.datetime.now()
+    latency = float(latency) / 1000
+    bandwidth = float(bandwidth) * 1024 * 1024
+    fields, size = make_fields(int(count))
+    data = random.Random(0).randbytes(size)
 
-    for k in keys:
-        if k == "hostname":
-            import socket
+    print(f"Serving {size / 1024 / 1024:.1f} MiB, latency {latency * 1000:g} ms, {bandwidth / 1024 / 1024:g} MiB/s")
 
-            run_id += "_" + str(socket.gethostname())
-            continue
-
-        if k == "user":
-            import getpass
-
-            run_id += "_" + str(getpass.getuser())
-            continue
-
-        if k == "ip":
-            from requests import get
-
-            ip = get("https://api.ipify.org").text
-            run_id += "_" + str(ip)
-
-        if k == "date":
-            run_id += "_" + now.strftime("%Y-%m-%d")
-
-        if k == "time":
-            run_id += "_" + now.strftime("%H%M")
+    rows = []
+    with temp_directory() as tmpdir, SETTINGS.temporary("cache-directory", tmpdir):
+        with range_server(data, latency=latency, bandwidth=bandwidth) as server:
+            for name, selection in SELECTIONS.items():
+                selected = sorted(
+                    (f for f in fields if selection(f)),
+                    key=lambda f: (f["param"], f["step"]),
+                )
+                parts = [(f["offset"], f["length"]) for f in selected]
+                expected = b"".join(data[offset : offset + length] for offset, length in parts)
+
+                for method, option in METHODS:
+                    del server.requests[:]
+                    start = time.time()
+                    path = download(method, option, server.url, parts)
+                    elapsed = time.time() - start
+
+                    with open(path, "rb") as f:
+                        assert f.read() == expected, (name, method, option)
+
+                    rows.append(
+                        (
+                            name,
+                            f"{method} {option}",
+                            len(parts),
+                            len(server.requests),
+                            elapsed,
+                            len(expected) / elapsed / 1024 / 1024,
+                        )
+                    )
 
-    return run_id
+    print()
+    print(f"{'selection':<12} {'method':<36} {'parts':>6} {'requests':>9} {'seconds':>8} {'MiB/s':>8}")
+    for name, method, parts, requests, elapsed, speed in rows:
+        print(f"{name:<12} {method:<36} {parts:>6} {requests:>9} {elapsed:>8.2f} {speed:>8.1f}")
@@ -167,6 +167,21 @@ class CacheCmd:
             action="store_true",
             help="reverse the order of the sort, from larger to smaller",
         ),
+        simulate=dict(
+            action="store_true",
+            help="replay the accesses recorded in the cache database to predict the hit rates of the eviction policies",
+        ),
+        capacity=dict(
+            type=str,
+            metavar="SIZE",
+            help="size of the simulated cache, defaults to the maximum-cache-size setting or half the cache size",
+        ),
+        policy=dict(
+            type=str,
+            metavar="POLICY",
+            action="append",
+            help="eviction policy to simulate (can be repeated), defaults to all policies",
+        ),
         **MATCHER,
     )
     def do_cache(self, args):
@@ -185,8 +200,49 @@ class CacheCmd:
 
         self.matcher = Matcher(args)
         cache = dump_cache_database(matcher=self.matcher)
+        if args.simulate:
+            return self.simulate(cache, args)
         return self.generate_output(cache, args)
 
+    def simulate(self, cache, args):
+        from climetlab.core.eviction import POLICIES
+        from climetlab.core.eviction import simulate
+
+        total = sum(e["size"] for e in cache if e["size"] is not None)
+
+        if args.capacity is not None:
+            capacity = parse_size(args.capacity)
+        else:
+            capacity = SETTINGS.get("maximum-cache-size")
+            if capacity is None:
+                capacity = total // 2
+
+        quotas = SETTINGS.get("cache-owner-quotas")
+        results = [simulate(cache, capacity, policy, quotas) for policy in args.policy or POLICIES.keys()]
+
+        if args.json:
+            print(json.dumps(results, sort_keys=True, indent=4))
+            return
+
+        print(
+            colored(
+                f"Simulating a cache of {humanize.bytes(capacity)} with {humanize.number(len(cache))} "
+                f"entries totalling {humanize.bytes(total)}.",
+                "green",
+            )
+        )
+
+        def generate_table():
+            for r in results:
+                yield (
+                    f"{r['policy']}:",
+                    f"hits {r['hit_rate']:.1%}, byte hits {r['byte_hit_rate']:.1%}, "
+                    f"evictions {humanize.number(r['evictions'])}, "
+                    f"creation time {humanize.seconds(r['miss_cost'])}",
+                )
+
+        print_table(generate_table())
+
     def generate_output(self, cache, args):
         from climetlab.core.caching import cache_directory
 
@@ -340,6 +396,7 @@ class CacheCmd:
         import stat
 
         from climetlab.core.caching import dump_cache_database
+        from climetlab.core.caching import export_cache_entries
 
         directory = args.directory
 
@@ -435,6 +492,7 @@ class CacheCmd:
 
         count = 0
         errors = 0
+        copied = []
         for entry in tqdm(iterable=cache):
             path = entry["path"]
 
@@ -446,11 +504,15 @@ class CacheCmd:
 
             try:
                 copy(path, dest)
+                copied.append(entry)
                 count += 1
             except FileNotFoundError as e:
                 LOG.exception(e)
                 errors += 1
 
+        # So the directory can be used as a shared cache directory, see cache_file()
+        export_cache_entries(directory, copied)
+
         if permissions_dirs:
             LOG.info("All entries copied. Now setting permissions.")
             new_dirs.update_permission_dirs(permissions_dirs)
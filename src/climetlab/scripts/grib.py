@@ -85,6 +85,7 @@ class GribCmd:
             "--output",
             dict(help="Custom location of the database file, will write absolute filenames in the database."),
         ),
+        workers=dict(type=int, help="Number of processes used to parse the GRIB files. Default is the number of CPUs."),
     )
     def do_index_directory(self, args):
         """Index a directory containing GRIB files."""
@@ -128,6 +129,7 @@ class GribCmd:
             relative_paths=relative_paths,
             followlinks=followlinks,
             with_statistics=True,
+            workers=args.workers,
         )
         parser.load_database()
 
@@ -9,6 +9,7 @@
 
 
 import logging
+import os
 
 from multiurl import Downloader
 
@@ -22,6 +23,25 @@ from .file import FileSource
 LOG = logging.getLogger(__name__)
 
 
+def _out_of_date(downloader, url, path, cache_data, update_if_out_of_date):
+    if SETTINGS.get("check-out-of-date-urls") is False:
+        return False
+
+    if downloader.out_of_date(path, cache_data):
+        if SETTINGS.get("download-out-of-date-urls") or update_if_out_of_date:
+            LOG.warning(
+                "Invalidating cache version and re-downloading %s",
+                url,
+            )
+            return True
+        else:
+            LOG.warning(
+                "To enable automatic downloading of updated URLs set the 'download-out-of-date-urls'"
+                " setting to True",
+            )
+    return False
+
+
 def download_and_cache(
     url,
     *,
@@ -68,22 +88,7 @@ def download_and_cache(
         return
 
     def out_of_date(url, path, cache_data):
-        if SETTINGS.get("check-out-of-date-urls") is False:
-            return False
-
-        if downloader.out_of_date(path, cache_data):
-            if SETTINGS.get("download-out-of-date-urls") or update_if_out_of_date:
-                LOG.warning(
-                    "Invalidating cache version and re-downloading %s",
-                    url,
-                )
-                return True
-            else:
-                LOG.warning(
-                    "To enable automatic downloading of updated URLs set the 'download-out-of-date-urls'"
-                    " setting to True",
-                )
-        return False
+        return _out_of_date(downloader, url, path, cache_data, update_if_out_of_date)
 
     if force is None:
         force = out_of_date
@@ -103,6 +108,89 @@ def download_and_cache(
     return path
 
 
+def download_parts_and_cache(
+    url,
+    parts,
+    *,
+    owner="url",
+    verify=True,
+    force=None,
+    chunk_size=1024 * 1024,
+    http_headers=None,
+    update_if_out_of_date=False,
+    **kwargs,
+):
+    """Same as ``download_and_cache(url, parts=parts)``, with the same cache entry, but the
+    byte ranges are coalesced and downloaded concurrently (see ``RangeDownloader``).
+    Falls back to ``multiurl`` if the server does not support byte ranges."""
+    from climetlab.utils.parts import RangeDownloader
+    from climetlab.utils.parts import RangesNotSupported
+
+    LOG.debug("URL %s", url)
+
+    options = dict(
+        chunk_size=chunk_size,
+        timeout=SETTINGS.get("url-download-timeout"),
+        verify=verify,
+        http_headers=http_headers,
+    )
+
+    # Used for the extension and the freshness of the cache entry, no request is made
+    # unless they need the HTTP headers
+    downloader = Downloader(url, **options)
+
+    def out_of_date(url, path, cache_data):
+        return _out_of_date(downloader, url, path, cache_data, update_if_out_of_date)
+
+    if force is None:
+        force = out_of_date
+
+    def download(target, _):
+        ranges = RangeDownloader(
+            url,
+            parts,
+            gap=SETTINGS.get("url-ranges-gap"),
+            maximum_size=SETTINGS.get("url-ranges-maximum-request-size"),
+            threads=SETTINGS.get("number-of-download-threads"),
+            statistics_gatherer=record_statistics,
+            progress_bar=progress_bar,
+            **options,
+        )
+        try:
+            return ranges.download(target)
+        except RangesNotSupported as e:
+            LOG.warning("%s, downloading with multiurl", e)
+
+        if os.path.exists(target):
+            os.unlink(target)
+
+        fallback = Downloader(
+            url,
+            parts=parts,
+            statistics_gatherer=record_statistics,
+            progress_bar=progress_bar,
+            **options,
+        )
+        fallback.download(target)
+        return fallback.cache_data()
+
+    # multiurl splits parts that are not in ascending order between several downloaders,
+    # and the extension of the cache file is then unknown
+    offsets = [offset for offset, _ in parts]
+    if offsets == sorted(offsets):
+        extension = downloader.extension()
+    else:
+        extension = ".unknown"
+
+    return cache_file(
+        owner,
+        download,
+        dict(url=url, parts=parts),
+        extension=extension,
+        force=force,
+    )
+
+
 class Url(FileSource):
     def __init__(
         self,
@@ -7,10 +7,13 @@
 # nor does it submit to any jurisdiction.
 #
 
+import http.server
 import logging
 import os
 import pathlib
 import shutil
+import threading
+import time
 from contextlib import contextmanager
 from unittest.mock import patch
 
@@ -139,6 +142,97 @@ def build_testdata(dir="testdata"):
     return dir
 
 
+class _RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        server = self.server
+        data = server.data
+        server.requests.append(self.headers.get("range"))
+        time.sleep(server.latency)
+
+        ranges = []
+        header = self.headers.get("range")
+        if header and server.ranges:
+            for r in header.split("=", 1)[1].split(","):
+                first, last = r.strip().split("-")
+                ranges.append((int(first), min(int(last), len(data) - 1)))
+
+        headers = {"etag": '"cml-test"', "accept-ranges": "bytes" if server.ranges else "none"}
+        if not ranges:
+            status, payload = 200, [data]
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            status, payload = 206, [data[first : last + 1]]
+            headers["content-range"] = f"bytes {first}-{last}/{len(data)}"
+        else:
+            boundary = "CLIMETLAB"
+            payload = []
+            for first, last in ranges:
+                payload.append(
+                    f"--{boundary}\r\ncontent-type: application/octet-stream\r\n"
+                    f"content-range: bytes {first}-{last}/{len(data)}\r\n\r\n".encode()
+                )
+                payload.append(data[first : last + 1])
+                payload.append(b"\r\n")
+            payload.append(f"--{boundary}--\r\n".encode())
+            status = 206
+            headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("content-length", str(sum(len(p) for p in payload)))
+        self.end_headers()
+
+        if body:
+            chunk = 64 * 1024
+            for p in payload:
+                for i in range(0, len(p), chunk):
+                    self.wfile.write(p[i : i + chunk])
+                    if server.bandwidth:
+                        time.sleep(len(p[i : i + chunk]) / server.bandwidth)
+
+
+class _RangeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close the connections they do not need anymore
+        pass
+
+
+@contextmanager
+def range_server(data, latency=0, bandwidth=None, ranges=True):
+    """Serve `data` over HTTP on localhost, for testing and benchmarking downloads without
+    network access. `latency` is the delay (in seconds) before each response, and `bandwidth`
+    the maximum transfer rate (in bytes per second) of each connection. Set `ranges` to False
+    to ignore the "range" headers. Yields the server: its `url` attribute is the URL of the data,
+    and its `requests` attribute the list of the "range" headers received."""
+
+    server = _RangeServer(("127.0.0.1", 0), _RangeRequestHandler)
+    server.data = data
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.ranges = ranges
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/data.bin"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 @contextmanager
 def cd(dir):
     old = os.getcwd()
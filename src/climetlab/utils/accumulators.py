@@ -0,0 +1,91 @@
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import numpy as np
+
+
+def _divide(a, b):
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    return np.divide(a, b, out=np.zeros(a.shape), where=b > 0)
+
+
+class StatisticsAccumulator:
+    """Running count, mean, variance, minimum and maximum of a stream of values,
+    ignoring missing values (NaNs).
+
+    The mean and variance are updated with the pairwise formulas of Chan et al.,
+    which are numerically stable, and allow accumulators built independently
+    (e.g. by parallel workers) to be merged. All quantities are arrays of the same
+    shape, so that statistics can be computed per grid point as well as overall.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=np.inf, maximum=-np.inf):
+        self.count = np.asarray(count, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+        self.minimum = np.asarray(minimum, dtype=np.float64)
+        self.maximum = np.asarray(maximum, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values, axis=None):
+        """Statistics of `values`, reduced along `axis` (all axes if None)."""
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+
+        count = np.count_nonzero(valid, axis=axis, keepdims=True)
+        mean = _divide(np.where(valid, values, 0).sum(axis=axis, keepdims=True), count)
+        m2 = np.square(np.where(valid, values - mean, 0)).sum(axis=axis)
+
+        return cls(
+            count=count.reshape(m2.shape),
+            mean=mean.reshape(m2.shape),
+            m2=m2,
+            minimum=np.where(valid, values, np.inf).min(axis=axis),
+            maximum=np.where(valid, values, -np.inf).max(axis=axis),
+        )
+
+    def add(self, values, axis=None):
+        self.merge(self.from_values(values, axis=axis))
+        return self
+
+    def merge(self, other):
+        """Merges the statistics of `other` into this accumulator."""
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        ratio = _divide(other.count, count)
+
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.count * ratio
+        self.count = count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @property
+    def variance(self):
+        return np.where(self.count > 0, _divide(self.m2, self.count), np.nan)
+
+    def as_dict(self):
+        def scalar(x):
+            return x.item() if x.ndim == 0 else x
+
+        missing = self.count == 0
+        return dict(
+            minimum=scalar(np.where(missing, np.nan, self.minimum)),
+            maximum=scalar(np.where(missing, np.nan, self.maximum)),
+            average=scalar(np.where(missing, np.nan, self.mean)),
+            stdev=scalar(np.sqrt(self.variance)),
+            count=scalar(self.count),
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.as_dict()})"
@@ -14,6 +14,7 @@ import itertools
 import json
 import os
 import pickle
+from collections import Counter
 
 import yaml
 
@@ -212,6 +213,160 @@ class Availability:
         return getattr(self._tree, name)
 
 
+class AvailabilityIndex:
+    """A compact summary of the metadata of a collection of fields, from which
+    an :class:`Availability` can be built without going through the fields again.
+
+    Each distinct combination of metadata values is stored once, dictionary-encoded,
+    with the number of fields that share it. Combinations are counted per source
+    (usually the path of a file), so that sources can be added or removed incrementally.
+    """
+
+    VERSION = 1
+
+    def __init__(self, ignore_keys=()):
+        self.ignore_keys = tuple(ignore_keys)
+        self.keys = []
+        self.vocabularies = []
+        self.sources = {}
+        self._setup()
+
+    def _setup(self):
+        self._ignore = set(self.ignore_keys)
+        self._positions = {k: i for i, k in enumerate(self.keys)}
+        self._codes = [{v: c for c, v in enumerate(values)} for values in self.vocabularies]
+        self._changed()
+
+    def _changed(self):
+        self._availability = None
+        self._unique_values = None
+
+    def __len__(self):
+        return sum(sum(counter.values()) for counter in self.sources.values())
+
+    def _encode(self, entry):
+        codes = [-1] * len(self.keys)
+        for k, v in entry.items():
+            if v is None or k in self._ignore:
+                continue
+
+            i = self._positions.get(k)
+            if i is None:
+                i = self._positions[k] = len(self.keys)
+                self.keys.append(k)
+                self.vocabularies.append([])
+                self._codes.append({})
+                codes.append(-1)
+
+            code = self._codes[i].get(v)
+            if code is None:
+                code = self._codes[i][v] = len(self.vocabularies[i])
+                self.vocabularies[i].append(v)
+            codes[i] = code
+
+        # Keys are only ever appended, so rows encoded before a key was
+        # added remain valid, as long as trailing missing values are dropped
+        while codes and codes[-1] < 0:
+            codes.pop()
+        return tuple(codes)
+
+    def add(self, entries, source=None):
+        """Adds `entries`, an iterable of metadata dictionaries. Entries are attributed
+        to `source`, or to their "_path" if no source is given."""
+        for entry in entries:
+            key = source if source is not None else entry.get("_path")
+            counter = self.sources.get(key)
+            if counter is None:
+                counter = self.sources[key] = Counter()
+            counter[self._encode(entry)] += 1
+        self._changed()
+
+    def remove(self, *sources):
+        for source in sources:
+            self.sources.pop(source, None)
+        self._changed()
+
+    def _rows(self):
+        rows = set()
+        for counter in self.sources.values():
+            rows.update(counter.keys())
+        return rows
+
+    def dicts(self, keys=None, missing=None):
+        """Iterates over the distinct combinations of metadata values, as dictionaries.
+        If `keys` is given, combinations are restricted to these keys, which are
+        set to `missing` for the fields that do not have them."""
+        if keys is None:
+            for row in self._rows():
+                yield {self.keys[i]: self.vocabularies[i][c] for i, c in enumerate(row) if c >= 0}
+            return
+
+        positions = [self._positions.get(k) for k in keys]
+        seen = set()
+        for row in self._rows():
+            codes = tuple(-1 if i is None or i >= len(row) else row[i] for i in positions)
+            if codes in seen:
+                continue
+            seen.add(codes)
+            yield {k: missing if c < 0 else self.vocabularies[i][c] for k, i, c in zip(keys, positions, codes)}
+
+    def unique_values(self):
+        """The values of each key, with "-" for the fields that do not have it,
+        as in :meth:`Availability.unique_values`."""
+        if self._unique_values is None:
+            used = [set() for _ in self.keys]
+            for row in self._rows():
+                for i, codes in enumerate(used):
+                    codes.add(row[i] if i < len(row) else -1)
+            self._unique_values = {
+                k: tuple("-" if c < 0 else values[c] for c in sorted(codes))
+                for k, values, codes in zip(self.keys, self.vocabularies, used)
+                if codes != {-1}
+            }
+        return self._unique_values
+
+    def availability(self):
+        if self._availability is None:
+            self._availability = Availability(self.dicts())
+        return self._availability
+
+    def to_pickle(self, filename, signature=None):
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump(
+                dict(
+                    version=self.VERSION,
+                    signature=signature,
+                    ignore_keys=self.ignore_keys,
+                    keys=self.keys,
+                    vocabularies=self.vocabularies,
+                    sources=self.sources,
+                ),
+                f,
+            )
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def from_pickle(cls, filename, signature=None, ignore_keys=()):
+        """Returns None if the file does not exist, is empty, was written by
+        another version or does not match `signature` and `ignore_keys`."""
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            return None
+
+        with open(filename, "rb") as f:
+            c = pickle.load(f)
+
+        if c["version"] != cls.VERSION or c["signature"] != signature or c["ignore_keys"] != tuple(ignore_keys):
+            return None
+
+        index = cls.__new__(cls)
+        index.ignore_keys = c["ignore_keys"]
+        index.keys = c["keys"]
+        index.vocabularies = c["vocabularies"]
+        index.sources = c["sources"]
+        index._setup()
+        return index
+
+
 if __name__ == "__main__":
     for n in Availability.from_mars_list("mars.list.tree").iterate():
         print(n)
@@ -14,8 +14,8 @@ import datetime
 import itertools
 from collections import defaultdict
 from copy import copy
-from functools import cmp_to_key
 
+import numpy as np
 from dateutil.parser import parse as parse_dates
 
 
@@ -161,16 +161,6 @@ def _cleanup(x):
     return str(repr(x))
 
 
-def _to_hashable(x):
-    assert isinstance(x, dict)
-    return tuple((k, v) for k, v in sorted(x.items()))
-
-
-def _from_hashable(x):
-    assert isinstance(x, tuple)
-    return {k: v for k, v in x}
-
-
 def _as_tuple(t):
     if isinstance(t, tuple):
         return t
@@ -181,6 +171,25 @@ def _as_tuple(t):
     return (t,)
 
 
+def _subtract(box, other):
+    """Returns a list of disjoint boxes covering `box` minus `other`. Boxes are
+    dictionaries of sets of values, with the same keys."""
+    if any(not box[k] & other[k] for k in box):
+        return [box]
+
+    result = []
+    current = dict(box)
+    for k in box:
+        outside = current[k] - other[k]
+        if outside:
+            piece = dict(current)
+            piece[k] = outside
+            result.append(piece)
+        current[k] = current[k] & other[k]
+
+    return result
+
+
 def _as_interval(interval):
     if not isinstance(interval, (list, tuple)):
         interval = [interval]
@@ -350,14 +359,28 @@ class Tree:
         return result
 
     def missing(self, **kwargs):
+        """Returns the part of the request that is not in the tree. The request
+        is a cartesian product of values, from which the leaves of the tree are
+        subtracted, so that neither of them need to be expanded."""
         request = self._kwargs_to_request(**kwargs)
-        user = {_to_hashable(x) for x in self._iterate_request(request)}
-        tree = {_to_hashable(x) for x in self.iterate(True)}
+        boxes = [self._as_box(request)]
+
+        for r in self.flatten():
+            if r.keys() != request.keys():
+                continue
+
+            leaf = self._as_box(r)
+            boxes = [b for box in boxes for b in _subtract(box, leaf)]
+            if not boxes:
+                break
 
-        s = [_from_hashable(x) for x in user.difference(user.intersection(tree))]
+        s = [{k: sorted(v, key=_sort_key) for k, v in box.items()} for box in boxes]
 
         return _factorise(s, intervals=self._intervals)
 
+    def _as_box(self, r):
+        return {k: frozenset(Interval.expand(v) if k in self._intervals else v) for k, v in r.items()}
+
     def _match(self, request):
         matches = {}
         for name, values in [(n, v) for (n, v) in request.items() if n in self._values]:
@@ -531,14 +554,30 @@ class Tree:
         return "".join(str(x) for x in text)
 
 
+def _sort_key(x):
+    # Same order as the one used to sort the rows of a table: values of the
+    # same type are compared together, otherwise the name of the types are compared
+    if isinstance(x, tuple):
+        return (str(type(x)), tuple(_sort_key(a) for a in x))
+    return (str(type(x)), x)
+
+
 class Column(object):
-    """Just what is says on the tin, a column of values."""
+    """Just what is says on the tin, a column of values.
+
+    Values are dictionary encoded: each distinct value is stored once in
+    `vocabulary`, and rows are represented by integer codes in `codes`.
+    """
 
     def __init__(self, title, values):
         self.title = title
-        self.values = values
         self.prio = 0
         self.diff = -1
+        self._index = {}
+        self._ranks = None
+        index = self._index
+        self.codes = np.array([index.setdefault(v, len(index)) for v in values], dtype=np.int64)
+        self.vocabulary = list(index)
 
     def __lt__(self, other):
         return (self.prio, self.diff, self.title) < (
@@ -547,29 +586,56 @@ class Column(object):
             other.title,
         )
 
+    def encode(self, v):
+        code = self._index.get(v)
+        if code is None:
+            code = self._index[v] = len(self.vocabulary)
+            self.vocabulary.append(v)
+            self._ranks = None
+        return code
+
     def value(self, i):
-        return self.values[i]
+        return self.vocabulary[self.codes[i]]
 
     def set_value(self, i, v):
-        self.values[i] = v
+        self.codes[i] = self.encode(v)
+
+    def ranks(self):
+        """Position of each code when values are sorted."""
+        if self._ranks is None:
+            order = sorted(range(len(self.vocabulary)), key=lambda i: _sort_key(self.vocabulary[i]))
+            self._ranks = np.empty(len(order), dtype=np.int64)
+            self._ranks[order] = np.arange(len(order))
+        return self._ranks
 
     def compute_differences(self, idx):
         """
         Number of unique values in this column for the requested
         row indexes.
 
-        @param idx list of row indexes
+        @param idx array of row indexes
         """
-        x = [self.values[i] for i in idx]
-        try:
-            self.diff = len(set(x))
-        except Exception:
-            print(type(x))
-            print(x[:10])
-            raise
+        self.diff = len(np.unique(self.codes[idx]))
 
     def __repr__(self):
-        return "Column(%s,%s,%s,%s)" % (self.title, self.values, self.prio, self.diff)
+        return "Column(%s,%s,%s,%s)" % (
+            self.title,
+            [self.vocabulary[c] for c in self.codes],
+            self.prio,
+            self.diff,
+        )
+
+
+def _group_rows(columns, n):
+    """Returns the index of the first row of each group of identical rows, and
+    the group of each row. Rows are hashed as a whole, by viewing them as bytes."""
+    if not columns:
+        return np.zeros(1 if n else 0, dtype=np.int64), np.zeros(n, dtype=np.int64)
+
+    rows = np.ascontiguousarray(np.column_stack(columns))
+    rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
 
 
 class Table(object):
@@ -585,7 +651,7 @@ class Table(object):
             self.depth = 0
             self.cols = []
             self.colidx = []
-            self.rowidx = []
+            self.rowidx = np.arange(0)
 
     def get_elem(self, c, r):
         return self.cols[self.colidx[c]].value(self.rowidx[r])
@@ -601,10 +667,10 @@ class Table(object):
         self.colidx.append(len(self.colidx))
 
         if len(col) > len(self.rowidx):
-            self.rowidx = [i for i in range(len(col))]
+            self.rowidx = np.arange(len(col))
 
-    def one_less(self, r, n):
-        return [self.get_elem(i, r) for i in range(len(self.colidx)) if i != n]
+    def codes(self, c):
+        return self.cols[self.colidx[c]].codes[self.rowidx]
 
     def factorise1(self):
         self.pop_singles()
@@ -614,71 +680,56 @@ class Table(object):
             self.factorise2(len(self.colidx) - i - 1)
 
     def factorise2(self, n):
-        remap = defaultdict(list)
-        gone = []
-
-        for i in range(len(self.rowidx)):
-            v = self.one_less(i, n)
-            s = remap[_as_tuple(v)]
-            if len(s) != 0:
-                gone.append(i)
-            elem = self.get_elem(n, i)
-            if elem not in s:
-                s.append(elem)
-
-        for g in reversed(gone):
-            del self.rowidx[g]
-
-        for i in range(len(self.rowidx)):
-            v = self.one_less(i, n)
-            s = remap[_as_tuple(v)]
-            self.set_elem(n, i, _as_tuple(s))
-
-    def sort_columns(self):
         """
-        Sort the columns on the number of unique values (this column.diff).
+        Merge the rows that only differ by their value in column `n`. The first
+        row of each group is kept, and its value becomes the tuple of the distinct
+        values of the group, in order of appearance.
         """
-        for idx in self.colidx:
-            self.cols[idx].compute_differences(self.rowidx)
-
-        self.colidx.sort(key=lambda a: self.cols[a])
+        if len(self.rowidx) == 0:
+            return
 
-    def compare_values(self, sa, sb):
-        if isinstance(sa, tuple) and isinstance(sb, tuple):
-            for a, b in zip(sa, sb):
-                n = self.compare_values(a, b)
-                if n != 0:
-                    return n
-            return 0
+        column = self.cols[self.colidx[n]]
+        elems = self.codes(n)
 
-        if type(sa) is type(sb):
-            if sa < sb:
-                return -1
+        first, group = _group_rows([self.codes(i) for i in range(len(self.colidx)) if i != n], len(self.rowidx))
 
-            if sa > sb:
-                return 1
+        # Distinct (group, value) pairs, in order of appearance within each group
+        _, pairs = np.unique(group * (int(elems.max()) + 1) + elems, return_index=True)
+        pairs = np.sort(pairs)
+        pairs = pairs[np.argsort(group[pairs], kind="stable")]
+        starts = np.flatnonzero(np.r_[True, group[pairs][1:] != group[pairs][:-1]])
+        ends = np.r_[starts[1:], len(pairs)]
 
-            return 0
+        vocabulary = column.vocabulary
+        values = elems[pairs]
+        merged = {}
+        codes = np.empty(len(first), dtype=np.int64)
+        for g, (s, e) in enumerate(zip(starts.tolist(), ends.tolist())):
+            key = tuple(values[s:e].tolist())
+            code = merged.get(key)
+            if code is None:
+                code = merged[key] = column.encode(_as_tuple([vocabulary[c] for c in key]))
+            codes[g] = code
 
-        return self.compare_values(str(type(sa)), str(type(sb)))
+        column.codes[self.rowidx[first]] = codes
+        self.rowidx = self.rowidx[np.sort(first)]
 
-    def compare_rows(self, a, b):
+    def sort_columns(self):
+        """
+        Sort the columns on the number of unique values (this column.diff).
+        """
         for idx in self.colidx:
-            sa = self.cols[idx].value(a)
-            sb = self.cols[idx].value(b)
-
-            if sa is None and sb is None:
-                continue
-
-            n = self.compare_values(sa, sb)
-
-            if n != 0:
-                return n
+            self.cols[idx].compute_differences(self.rowidx)
 
-        return 0
+        self.colidx.sort(key=lambda a: self.cols[a])
 
     def sort_rows(self):
-        self.rowidx.sort(key=cmp_to_key(self.compare_rows))
+        if len(self.rowidx) < 2 or not self.colidx:
+            return
+
+        # np.lexsort is stable, and uses the last key as the primary one
+        keys = [self.cols[c].ranks()[self.cols[c].codes[self.rowidx]] for c in reversed(self.colidx)]
+        self.rowidx = self.rowidx[np.lexsort(keys)]
 
     def pop_singles(self):
         """
@@ -702,21 +753,18 @@ class Table(object):
         self.sort_columns()
         self.sort_rows()
 
-        prev = self.get_elem(0, 0)
-        j = 0
-
-        for i in range(1, len(self.rowidx)):
-            e = self.get_elem(0, i)
-            if prev != e:
-                table = Table(self, j, i)
-                self.tree._add_child(table.process())
-                j = i
-                prev = e
+        codes = self.codes(0)
+        bounds = (np.flatnonzero(codes[1:] != codes[:-1]) + 1).tolist()
+        if not bounds:
+            return
 
-        if j > 0:
-            table = Table(self, j, len(self.rowidx))
+        j = 0
+        for i in bounds + [len(self.rowidx)]:
+            table = Table(self, j, i)
             self.tree._add_child(table.process())
-            self.rowidx = []
+            j = i
+
+        self.rowidx = self.rowidx[:0]
 
     def process(self):
         self.factorise1()
@@ -796,14 +844,18 @@ def _factorise(req, intervals=None):
                     splits.extend(interval.split(dates))
                 r[i] = splits
 
-    req = [_as_requests(r) for r in req]
-
     names = list({name for r in req for name in r.keys()})
 
     cols = defaultdict(list)
     if names:
-        for r in req:
-            _scan(r, cols, names[0], names[1:])
+        if all(not isinstance(v, (tuple, list)) for r in req for v in r.values()):
+            # Each request is a single row, e.g. the metadata of a field
+            for name in names:
+                cols[name] = [r.get(name, "-") for r in req]
+        else:
+            req = [_as_requests(r) for r in req]
+            for r in req:
+                _scan(r, cols, names[0], names[1:])
 
     table = Table()
     for n, c in cols.items():
@@ -6,11 +6,23 @@
 # granted to it by virtue of its status as an intergovernmental organisation
 # nor does it submit to any jurisdiction.
 
+import logging
 import os
+import re
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
 from climetlab.utils import download_and_cache
 
+LOG = logging.getLogger(__name__)
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
 
 class Part:
     def __init__(self, path, offset, length):
@@ -24,13 +36,19 @@ class Part:
 
     @classmethod
     def resolve(cls, parts, directory=None):
+        from climetlab.sources.url import download_parts_and_cache
+
         paths = defaultdict(list)
         for i, part in enumerate(parts):
             paths[part.path].append(part)
 
         for path, bits in paths.items():
             if path.startswith("http://") or path.startswith("https://") or path.startswith("ftp://"):
-                newpath = download_and_cache(path, parts=[(p.offset, p.length) for p in bits])
+                ranges = [(p.offset, p.length) for p in bits]
+                if path.startswith("ftp://"):
+                    newpath = download_and_cache(path, parts=ranges)
+                else:
+                    newpath = download_parts_and_cache(path, ranges)
                 newoffset = 0
                 for p in bits:
                     p.path = newpath
@@ -45,3 +63,225 @@ class Part:
 
     def __repr__(self):
         return f"Part[{self.path},{self.offset},{self.length}]"
+
+
+def plan_ranges(parts, gap=0, maximum_size=None):
+    """Plan the HTTP requests needed to download the byte ranges `parts`, a list
+    of (offset, length), into a file where they are concatenated in the given order.
+
+    Ranges that are at most `gap` bytes apart are coalesced into a single request,
+    and requests larger than `maximum_size` bytes are split evenly.
+
+    Returns a list of (offset, length, segments), sorted by offset, where `segments` is
+    the list of (offset, length, position) of the bytes of the request that must be
+    written at `position` in the file.
+    """
+    segments = []
+    position = 0
+    for offset, length in parts:
+        if length > 0:
+            segments.append((offset, length, position))
+        position += length
+    segments.sort()
+
+    spans = []
+    for segment in segments:
+        offset, length, _ = segment
+        if spans and offset - spans[-1][1] <= gap:
+            spans[-1][1] = max(spans[-1][1], offset + length)
+            spans[-1][2].append(segment)
+        else:
+            spans.append([offset, offset + length, [segment]])
+
+    result = []
+    for start, end, span in spans:
+        count = 1
+        if maximum_size:
+            count = -(-(end - start) // maximum_size)
+        step = -(-(end - start) // count)
+        for first in range(start, end, step):
+            last = min(first + step, end)
+            clipped = []
+            for offset, length, position in span:
+                a, b = max(offset, first), min(offset + length, last)
+                if a < b:
+                    clipped.append((a, b - a, position + a - offset))
+            if clipped:
+                result.append((first, last - first, clipped))
+
+    return result
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+def _session(threads):
+    # Sessions are kept between downloads, so connections to the same server are reused
+    with SESSIONS_LOCK:
+        if threads not in SESSIONS:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=threads)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            SESSIONS[threads] = session
+        return SESSIONS[threads]
+
+
+def _ignore(*args, **kwargs):
+    pass
+
+
+class RangeDownloader:
+    """Download the byte ranges `parts` of an HTTP(S) URL, as planned by `plan_ranges()`.
+    The requests are issued concurrently over a pool of connections, and their content
+    is written directly at its position in the target file."""
+
+    def __init__(
+        self,
+        url,
+        parts,
+        *,
+        gap=0,
+        maximum_size=None,
+        threads=5,
+        chunk_size=1024 * 1024,
+        timeout=None,
+        verify=True,
+        http_headers=None,
+        maximum_retries=3,
+        retry_after=1,
+        statistics_gatherer=_ignore,
+        progress_bar=None,
+    ):
+        self.url = url
+        self.parts = parts
+        self.gap = gap
+        self.maximum_size = maximum_size
+        self.threads = max(1, threads)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.verify = verify
+        self.http_headers = http_headers if http_headers else {}
+        self.maximum_retries = maximum_retries
+        self.retry_after = retry_after
+        self.statistics_gatherer = statistics_gatherer
+        self.progress_bar = progress_bar
+
+        self.requests = plan_ranges(parts, gap, maximum_size)
+        self.size = sum(length for _, length in parts)
+        self.headers = None
+
+    def download(self, target):
+        """Download the parts into `target`, and return the HTTP headers of the
+        first response, with lower case keys."""
+        with open(target, "wb") as f:
+            f.truncate(self.size)
+
+        session = _session(self.threads)
+        lock = threading.Lock()
+        pbar = None
+        if self.progress_bar is not None:
+            pbar = self.progress_bar(total=sum(r[1] for r in self.requests), desc=os.path.basename(self.url))
+
+        def update(n):
+            if pbar is not None:
+                with lock:
+                    pbar.update(n)
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(min(self.threads, max(1, len(self.requests)))) as executor:
+                futures = [executor.submit(self._download, session, target, r, update) for r in self.requests]
+                written = sum(f.result() for f in futures)
+        finally:
+            if pbar is not None:
+                pbar.close()
+        elapsed = time.time() - start
+
+        assert written == self.size, f"Size mismatch {written} bytes instead of {self.size}"
+
+        self.statistics_gatherer(
+            "transfer",
+            url=self.url,
+            total=written,
+            downloaded=sum(r[1] for r in self.requests),
+            requests=len(self.requests),
+            elapsed=elapsed,
+            method="ranges",
+        )
+        return self.headers
+
+    def _download(self, session, target, request, update):
+        offset, length, _ = request
+        headers = dict(self.http_headers)
+        headers["range"] = f"bytes={offset}-{offset + length - 1}"
+
+        for attempt in range(self.maximum_retries):
+            if attempt:
+                LOG.warning("Retrying bytes %s-%s of %s", offset, offset + length - 1, self.url)
+                time.sleep(self.retry_after)
+            try:
+                r = session.get(
+                    self.url,
+                    headers=headers,
+                    stream=True,
+                    timeout=self.timeout,
+                    verify=self.verify,
+                )
+                try:
+                    r.raise_for_status()
+                    self._check(r, offset)
+                    return self._write(r, target, request, update)
+                finally:
+                    r.close()
+            except RangesNotSupported:
+                raise
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500:
+                    raise
+                error = e
+            except (requests.RequestException, OSError) as e:
+                error = e
+            LOG.warning("Error downloading %s: %s", self.url, error)
+
+        raise error
+
+    def _check(self, r, offset):
+        if r.status_code != 206:
+            raise RangesNotSupported(f"{self.url}: status {r.status_code} returned for a byte range request")
+
+        m = re.match(r"bytes\s+(\d+)-", r.headers.get("content-range", ""))
+        if m is None or int(m.group(1)) != offset:
+            raise RangesNotSupported(f"{self.url}: unexpected content-range {r.headers.get('content-range')}")
+
+        if self.headers is None:
+            self.headers = {k.lower(): v for k, v in r.headers.items()}
+
+    def _write(self, r, target, request, update):
+        offset, length, segments = request
+        pos = offset
+        written = 0
+        first = 0
+        with open(target, "r+b") as f:
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                chunk = memoryview(chunk)
+                end = pos + len(chunk)
+                for i in range(first, len(segments)):
+                    start, size, position = segments[i]
+                    if start >= end:
+                        break
+                    a, b = max(start, pos), min(start + size, end)
+                    if a < b:
+                        f.seek(position + a - start)
+                        f.write(chunk[a - pos : b - pos])
+                        written += b - a
+                while first < len(segments) and sum(segments[first][:2]) <= end:
+                    first += 1
+                update(len(chunk))
+                pos = end
+
+        if pos != offset + length:
+            raise OSError(f"{self.url}: received {pos - offset} bytes instead of {length}")
+
+        return written
@@ -10,19 +10,33 @@
 #
 
 
+import datetime
+import errno
 import json
 import logging
 import os
+import shutil
+import sqlite3
+import time
 
 import pytest
 
 from climetlab import load_source
 from climetlab import settings
+from climetlab.core import caching
+from climetlab.core.caching import CACHE
 from climetlab.core.caching import cache_entries
 from climetlab.core.caching import cache_file
+from climetlab.core.caching import cache_metrics
 from climetlab.core.caching import cache_size
 from climetlab.core.caching import dump_cache_database
+from climetlab.core.caching import flush_cache
+from climetlab.core.caching import housekeeping
 from climetlab.core.caching import purge_cache
+from climetlab.core.caching import register_cache_file
+from climetlab.core.eviction import Usage
+from climetlab.core.eviction import eviction_policy
+from climetlab.core.eviction import simulate
 from climetlab.core.temporary import temp_directory
 from climetlab.testing import TEST_DATA_URL
 
@@ -61,6 +75,395 @@ def test_cache_1():
     assert cnt == 2
 
 
+def test_cache_accesses():
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write("x" * args["size"])
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+
+            for _ in range(10):
+                for n in range(3):
+                    cache_file("test_cache", touch, {"size": n + 1}, extension=".test")
+
+            # Sizes are known before the changes reach the database
+            assert cache_metrics()["total_size"] == 6
+
+            flush_cache()
+            assert cache_metrics()["pending_changes"] == 0
+
+            entries = [e for e in dump_cache_database() if e["owner"] == "test_cache"]
+            assert sorted(e["size"] for e in entries) == [1, 2, 3]
+            assert [e["accesses"] for e in entries] == [10, 10, 10]
+            assert cache_size() == 6
+
+
+def test_cache_entries_of_other_processes():
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write("x")
+        return {"etag": "abc"}
+
+    owner_data = []
+
+    def force(args, path, data):
+        owner_data.append(data)
+        return False
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+
+            path = cache_file("test_cache", touch, {"n": 1}, extension=".test")
+            flush_cache()
+
+            # As if the entry had been created by another process after the table was loaded
+            CACHE._forget(path)
+            assert cache_file("test_cache", touch, {"n": 1}, extension=".test", force=force) == path
+            assert owner_data == [{"etag": "abc"}]
+            assert cache_metrics()["total_size"] == 1
+
+
+def test_cache_size_of_other_processes():
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write("x" * args["size"])
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+            settings.set("maximum-cache-size", "100K")
+
+            cache_file("test_cache", touch, {"size": 10 * 1024})
+            flush_cache()
+
+            # Another process adds a large entry, this process stays below the limit
+            other = os.path.join(tmpdir, "other-process.test")
+            touch(other, {"size": 200 * 1024})
+            now = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            with sqlite3.connect(os.path.join(tmpdir, caching.CACHE_DB)) as db:
+                db.execute(
+                    "INSERT INTO cache(path, owner, args, creation_date, last_access, size) VALUES(?,?,?,?,?,?)",
+                    (other, "other", "{}", now, now, 200 * 1024),
+                )
+
+            CACHE.enqueue(CACHE._check_cache_size).result()
+            assert cache_size() <= 100 * 1024
+            assert not os.path.exists(other)
+
+
+def test_cache_flush_failure(monkeypatch):
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write("x")
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+
+            with monkeypatch.context() as m:
+                m.setattr(CACHE, "_write_changes", locked)
+                cache_file("test_cache", touch, {"n": 1}, extension=".test")
+                with pytest.raises(sqlite3.OperationalError):
+                    flush_cache()
+
+            # The changes are kept until they are written
+            assert cache_metrics()["pending_changes"] == 3
+            cache_file("test_cache", touch, {"n": 1}, extension=".test")
+            flush_cache()
+
+            entries = [e for e in dump_cache_database() if e["owner"] == "test_cache"]
+            assert [(e["size"], e["accesses"]) for e in entries] == [(1, 2)]
+
+
+def test_cache_eviction_policies():
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write("x" * args["size"])
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+            settings.set("maximum-cache-size", "100K")
+            settings.set("cache-eviction-policy", "gdsf")
+            settings.set("cache-owner-quotas", {"big": "60K"})
+
+            for n in range(20):
+                cache_file("small", touch, {"size": 100, "n": n})
+
+            # The quota of 'big' is exceeded by the second and third files
+            for n, size in enumerate((40, 40, 30)):
+                cache_file("big", touch, {"size": size * 1024, "n": n})
+
+            owners = [e["owner"] for e in dump_cache_database()]
+            assert owners.count("small") == 20
+            assert owners.count("big") == 1
+
+            # The maximum size is exceeded, the large entries are deleted first
+            cache_file("other", touch, {"size": 50 * 1024, "n": 0})
+            cache_file("other", touch, {"size": 30 * 1024, "n": 1})
+
+            entries = dump_cache_database()
+            owners = [e["owner"] for e in entries]
+            assert owners.count("small") == 20
+            assert owners.count("big") + owners.count("other") == 2
+            assert cache_size() <= 100 * 1024
+
+            assert all(json.loads(e["extra"])["creation_time"] >= 0 for e in entries)
+
+            # The clock of the policy is advanced by the deletions, and recorded with the accesses
+            with sqlite3.connect(os.path.join(tmpdir, caching.CACHE_DB)) as db:
+                ((clock,),) = db.execute("SELECT clock FROM eviction WHERE policy='gdsf'").fetchall()
+            assert clock > 0
+
+            path = cache_file("small", touch, {"size": 100, "n": 0})
+            (extra,) = [json.loads(e["extra"]) for e in dump_cache_database() if e["path"] == path]
+            assert extra["clock"] == clock
+            assert extra["creation_time"] >= 0
+
+
+def test_cache_eviction_clock():
+    policy = eviction_policy("gdsf")
+    hot = Usage("hot", "test", size=1, accesses=100, last_access=0, cost=1)
+
+    # Entries that are not accessed anymore end up with the lowest priorities
+    for i in range(200):
+        policy.evicted(Usage(f"cold-{i}", "test", 1, 1, i + 1, 1, clock=policy.clock))
+    assert policy.priority(Usage("new", "test", 1, 1, 201, 1, clock=policy.clock)) > policy.priority(hot)
+
+
+def test_cache_simulation():
+    def entry(path, size, accesses):
+        return dict(
+            path=path,
+            owner="test",
+            size=size,
+            accesses=accesses,
+            creation_date="2023-01-01 00:00:00",
+            last_access="2023-01-02 00:00:00",
+            extra=None,
+        )
+
+    entries = [entry(f"small-{i}", 10, 10) for i in range(10)]
+    entries += [entry(f"large-{i}", 100, 2) for i in range(2)]
+
+    lru = simulate(entries, 150, "lru")
+    gdsf = simulate(entries, 150, "gdsf")
+
+    assert lru["requests"] == gdsf["requests"] == 104
+    assert gdsf["hit_rate"] > lru["hit_rate"]
+    assert simulate(entries, 1000, "lru")["hits"] == 104 - 12
+    assert simulate(entries, 1000, "lru", quotas={"test": 100})["hits"] < 104 - 12
+
+
+def test_shared_cache_directories():
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write(args["name"])
+
+    def mkdir(target, args):
+        os.mkdir(target)
+        touch(os.path.join(target, "data"), args)
+
+    def fail(target, args):
+        raise AssertionError("The file should have been found in the shared directory")
+
+    with temp_directory() as shared:
+        with settings.temporary():
+            settings.set("cache-directory", shared)
+            file = cache_file("test_cache", touch, {"name": "file"})
+            tree = cache_file("test_cache", mkdir, {"name": "tree"})
+
+        with temp_directory() as tmpdir:
+            with settings.temporary():
+                settings.set("cache-directory", tmpdir)
+                settings.set("shared-cache-directories", [shared])
+                settings.set("shared-cache-promotion", 2)
+
+                # Files on the same filesystem are linked into the cache straight away
+                path = cache_file("test_cache", fail, {"name": "file"})
+                assert os.path.dirname(path) == tmpdir
+                assert os.path.samefile(path, file)
+
+                # Others are used in place until they are accessed often enough
+                assert cache_file("test_cache", fail, {"name": "tree"}) == tree
+                path = cache_file("test_cache", fail, {"name": "tree"})
+                assert os.path.dirname(path) == tmpdir
+                assert os.path.samefile(os.path.join(path, "data"), os.path.join(tree, "data"))
+
+                assert sorted(e["path"] for e in cache_entries()) == sorted(
+                    os.path.join(tmpdir, os.path.basename(p)) for p in (file, tree)
+                )
+
+                # The shared directories are ignored when the file must be created again
+                path = cache_file("test_cache", touch, {"name": "other"})
+                assert not os.path.exists(os.path.join(shared, os.path.basename(path)))
+
+
+def test_shared_cache_owner_data(monkeypatch):
+    def touch(target, args):
+        with open(target, "w") as f:
+            f.write(args["name"])
+        return {"etag": args["name"]}
+
+    def fail(target, args):
+        raise AssertionError("The file should have been found in the shared directory")
+
+    def cross_device(source, target):
+        raise OSError(errno.EXDEV, "Invalid cross-device link", target)
+
+    checked = []
+
+    def up_to_date(args, path, owner_data):
+        checked.append(owner_data)
+        return False
+
+    with temp_directory() as shared:
+        with settings.temporary():
+            settings.set("cache-directory", shared)
+            for name in ("a", "b", "c"):
+                cache_file("test_cache", touch, {"name": name})
+            flush_cache()
+
+        with temp_directory() as tmpdir:
+            with settings.temporary():
+                settings.set("cache-directory", tmpdir)
+                settings.set("shared-cache-directories", [shared])
+                settings.set("shared-cache-promotion", 2)
+
+                # The owner data of the shared entry is checked and carried over
+                path = cache_file("test_cache", fail, {"name": "a"}, force=up_to_date)
+                assert os.path.dirname(path) == tmpdir
+                assert checked == [{"etag": "a"}]
+                flush_cache()
+                assert [e["owner_data"] for e in dump_cache_database() if e["path"] == path] == [{"etag": "a"}]
+
+                # Out of date shared files are ignored
+                path = cache_file("test_cache", touch, {"name": "b"}, force=lambda *args: True)
+                assert os.path.dirname(path) == tmpdir
+
+                # Files that cannot be linked are only copied once accessed often enough
+                with monkeypatch.context() as m:
+                    m.setattr(caching, "_link", cross_device)
+                    path = cache_file("test_cache", fail, {"name": "c"})
+                    assert os.path.dirname(path) == shared
+                    path = cache_file("test_cache", fail, {"name": "c"})
+                    assert os.path.dirname(path) == tmpdir
+
+        # The shared directory may be mounted elsewhere than where its database was written
+        with temp_directory() as moved:
+            shutil.copytree(shared, moved, dirs_exist_ok=True)
+            paths = [os.path.join(moved, name) for name in os.listdir(moved) if name.startswith("test_cache-")]
+            results = [caching.shared_owner_data(path) for path in paths]
+            assert sorted(owner_data["etag"] for _, owner_data in results) == ["a", "b", "c"]
+            assert all(known for known, _ in results)
+
+            # Results are kept until the file changes
+            assert (paths[0], os.stat(paths[0]).st_mtime_ns) in caching._SHARED_OWNER_DATA
+            assert caching.shared_owner_data(os.path.join(moved, "test_cache-unknown")) == (False, None)
+
+
+def test_cache_housekeeping():
+    def mkdir(target, args):
+        os.mkdir(target)
+        os.mkdir(os.path.join(target, "sub"))
+        for name in ("a", "sub/b"):
+            with open(os.path.join(target, name), "w") as f:
+                f.write("x" * 10)
+
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+            settings.set("cache-housekeeping-interval", None)
+
+            path = cache_file("test_cache", mkdir, {})
+            assert [e["size"] for e in cache_entries()] == [20]
+
+            old = time.time() - 3600
+            for name in (os.path.basename(path) + ".extra", "orphan"):
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write("x" * 5)
+                os.utime(os.path.join(tmpdir, name), (old, old))
+
+            # Too recent to be an orphan
+            with open(os.path.join(tmpdir, "recent"), "w"):
+                pass
+
+            housekeeping()
+
+            entries = {os.path.basename(e["path"]): e for e in cache_entries()}
+            assert sorted(entries) == sorted([os.path.basename(path), os.path.basename(path) + ".extra", "orphan"])
+            assert entries[os.path.basename(path) + ".extra"]["parent"] == path
+            assert entries["orphan"]["parent"] is None
+            assert entries["orphan"]["owner"] == "orphans"
+            assert entries["orphan"]["size"] == 5
+
+            # In the background
+            os.utime(os.path.join(tmpdir, "recent"), (old, old))
+            runs = cache_metrics()["housekeeping_runs"]
+            settings.set("cache-housekeeping-interval", "1s")
+            for _ in range(50):
+                if cache_metrics()["housekeeping_runs"] > runs:
+                    break
+                time.sleep(0.1)
+
+            assert "recent" in [os.path.basename(e["path"]) for e in cache_entries()]
+
+
+def test_cache_housekeeping_interrupted():
+    with temp_directory() as tmpdir:
+        with settings.temporary():
+            settings.set("cache-directory", tmpdir)
+            settings.set("cache-housekeeping-interval", None)
+
+            paths = [os.path.join(tmpdir, name) for name in ("a", "b")]
+            for path in paths:
+                with open(path, "w") as f:
+                    f.write("x" * 10)
+                # Registered without a size
+                register_cache_file(path, "test_cache", {})
+            flush_cache()
+
+            def interrupted():
+                steps = CACHE._update_cache_steps()
+                next(steps)
+                # Deleted while the housekeeping is interrupted
+                CACHE._delete_entry(paths[0])
+                for _ in steps:
+                    pass
+
+            CACHE.enqueue(interrupted).result()
+
+            assert [os.path.basename(e["path"]) for e in cache_entries()] == ["b"]
+            assert cache_metrics()["total_size"] == 10
+            assert cache_size() == 10
+
+
+
+def test_cache_directory_size():
+    with temp_directory() as tmpdir:
+        path = os.path.join(tmpdir, "entry")
+        nested = os.path.join(path, "a", "b")
+        os.makedirs(nested)
+        with open(os.path.join(path, "x"), "wb") as f:
+            f.write(b"x" * 1000)
+
+        assert CACHE._entry_size(path) == ("directory", 1000)
+
+        # Only the mtime of the parent of the new file changes
+        with open(os.path.join(nested, "y"), "wb") as f:
+            f.write(b"y" * 5000)
+        assert CACHE._entry_size(path) == ("directory", 6000)
+
+        os.unlink(os.path.join(path, "x"))
+        assert CACHE._entry_size(path) == ("directory", 5000)
+
+
 # @pytest.mark.skipif(True, reason="Test fails in github, needs fixing")
 @pytest.mark.download
 def test_cache_2():
@@ -118,7 +521,7 @@ def test_cache_2():
 
             cnt = 0
             for n in os.listdir(tmpdir):
-                if n.startswith("cache-") and n.endswith(".db"):
+                if n.startswith("cache-") and n.endswith((".db", ".db-wal", ".db-shm")):
                     continue
                 cnt += 1
             if cnt != 5:
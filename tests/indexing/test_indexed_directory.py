@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# (C) Copyright 2024 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation
+# nor does it submit to any jurisdiction.
+#
+
+import os
+import shutil
+import sys
+
+import pytest
+
+from climetlab import load_source
+from climetlab.core.temporary import temp_directory
+from climetlab.readers.grib.parsing import GribIndexingDirectoryParserIterator
+from climetlab.sources.indexed_directory import IndexedDirectorySource
+from climetlab.testing import climetlab_file
+
+FILES = ["test.grib", "test4.grib"]
+
+
+def make_directory(directory):
+    for name in FILES:
+        shutil.copy(climetlab_file(os.path.join("docs", "examples", name)), directory)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Not supported on windows")
+@pytest.mark.parametrize("workers", [1, 2])
+def test_index_directory(workers):
+    with temp_directory() as directory:
+        make_directory(directory)
+
+        db_path = os.path.join(directory, IndexedDirectorySource.DEFAULT_DB_FILE)
+        parser = GribIndexingDirectoryParserIterator(
+            directory,
+            db_path=db_path,
+            relative_paths=True,
+            with_statistics=True,
+            workers=workers,
+        )
+        assert parser.load_database() == 6
+
+        ds = load_source("indexed-directory", directory)
+        assert len(ds) == 6
+        assert sorted(ds.unique_values("param")["param"]) == ["2t", "msl", "t", "z"]
+
+        # Files already in the index are skipped
+        assert parser.load_database() == 0
+        assert len(load_source("indexed-directory", directory)) == 6
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 10_000])
+def test_sql_database_load_batches(batch_size):
+    from climetlab.indexing.database.sql import SqlDatabase
+
+    entries = [dict(_path="a.grib", _offset=i, _length=1, param="t", levelist=i) for i in range(5)]
+    entries[3]["number"] = 7
+
+    with temp_directory() as directory:
+        db = SqlDatabase(os.path.join(directory, "test.db"))
+        assert db.load_iterator(entries, batch_size=batch_size, synchronous="OFF") == 5
+
+        assert db.count() == 5
+        assert list(db._execute_select(["i_levelist", "i_number"])) == [
+            (0, None),
+            (1, None),
+            (2, None),
+            (3, 7),
+            (4, None),
+        ]
+        assert db.already_loaded("a.grib", None)
+
+
+def test_sql_database_rebuilt():
+    from climetlab.indexing.database.sql import SqlDatabase
+    from climetlab.indexing.database.sql import SqlSelection
+
+    with temp_directory() as directory:
+        path = os.path.join(directory, "test.db")
+
+        db = SqlDatabase(path)
+        db.load_iterator([dict(_path="a.grib", _offset=i, _length=1, levelist=i + 0.5) for i in range(5)])
+        assert db.filter(SqlSelection(dict(levelist="1.50"))).count() == 1
+
+        # Same path and same filter, but the columns now have another type
+        os.unlink(path)
+        db = SqlDatabase(path)
+        db.load_iterator([dict(_path="a.grib", _offset=i, _length=1, levelist=f"{i}.50") for i in range(5)])
+        assert db.filter(SqlSelection(dict(levelist="1.50"))).count() == 1
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Not supported on windows")
+def test_index_directory_incremental():
+    with temp_directory() as directory:
+        make_directory(directory)
+
+        db_path = os.path.join(directory, IndexedDirectorySource.DEFAULT_DB_FILE)
+        parser = GribIndexingDirectoryParserIterator(
+            directory,
+            db_path=db_path,
+            relative_paths=True,
+            with_statistics=False,
+            workers=1,
+        )
+        assert parser.load_database() == 6
+
+        # Replace test.grib (2 fields) with a copy of test4.grib (4 fields),
+        # remove test4.grib and add a new file
+        shutil.copy(
+            os.path.join(directory, "test4.grib"),
+            os.path.join(directory, "test.grib"),
+        )
+        os.rename(
+            os.path.join(directory, "test4.grib"),
+            os.path.join(directory, "other.grib"),
+        )
+
+        diff = parser.diff(parser._new_db())
+        assert [os.path.basename(p) for p, _ in diff["added"]] == ["other.grib"]
+        assert [os.path.basename(p) for p, _ in diff["modified"]] == ["test.grib"]
+        assert diff["removed"] == ["test4.grib"]
+        assert diff["unchanged"] == []
+
+        assert parser.load_database() == 8
+        ds = load_source("indexed-directory", directory)
+        assert len(ds) == 8
+        assert len(ds.sel(param="msl")) == 0
+
+        assert parser.load_database() == 0
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Not supported on windows")
+def test_index_directory_recorded_paths():
+    with temp_directory() as directory:
+        make_directory(directory)
+        with open(os.path.join(directory, "empty.grib"), "wb") as f:
+            f.write(b"not a grib")
+
+        db_path = os.path.join(directory, IndexedDirectorySource.DEFAULT_DB_FILE)
+        parser = GribIndexingDirectoryParserIterator(
+            directory,
+            db_path=db_path,
+            relative_paths=True,
+            with_statistics=False,
+            workers=1,
+        )
+        assert parser.load_database() == 6
+
+        # Files without fields are not parsed again
+        diff = parser.diff(parser._new_db())
+        assert diff["added"] == []
+        assert len(diff["unchanged"]) == 3
+
+        # As recorded by older versions
+        db = parser._new_db()
+        with db.connection as connection:
+            connection.execute("UPDATE paths SET size=NULL, mtime=NULL, inode=NULL")
+        assert len(parser.diff(db)["unrecorded"]) == 3
+
+        assert parser.load_database() == 0
+        assert None not in parser._new_db().paths_stats().values()
+
+        shutil.copy(os.path.join(directory, "test4.grib"), os.path.join(directory, "test.grib"))
+        assert [os.path.basename(p) for p, _ in parser.diff(parser._new_db())["modified"]] == ["test.grib"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Not supported on windows")
+def test_index_directory_availability():
+    def rows(index):
+        return sorted(sorted(d.items()) for d in index.dicts())
+
+    with temp_directory() as directory:
+        make_directory(directory)
+
+        db_path = os.path.join(directory, IndexedDirectorySource.DEFAULT_DB_FILE)
+        parser = GribIndexingDirectoryParserIterator(
+            directory,
+            db_path=db_path,
+            relative_paths=True,
+            workers=1,
+        )
+        parser.load_database()
+
+        ds = load_source("indexed-directory", directory)
+        index = ds._load_availability_index()
+        assert index is not None and len(index) == 6
+        assert rows(index) == rows(ds._build_availability_index())
+        assert not ds.is_full_hypercube()
+        assert ds.sel(param=["t", "z"]).is_full_hypercube()
+
+        r = ds.available(dict(param=["t", "2t"], level=[500, 1000]))
+        assert r["available"].count() == 1
+        assert r["missing"].count() == 3
+
+        # The index follows the changes in the directory
+        os.remove(os.path.join(directory, "test.grib"))
+        parser.load_database()
+
+        ds = load_source("indexed-directory", directory)
+        index = ds._load_availability_index()
+        assert index is not None and len(index) == 4
+        assert rows(index) == rows(ds._build_availability_index())
+        assert ds.is_full_hypercube()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Not supported on windows")
+def test_indexed_directory_selections():
+    import threading
+
+    def params(ds):
+        return [(f.metadata("param"), f.metadata("level")) for f in ds]
+
+    with temp_directory() as directory:
+        make_directory(directory)
+        GribIndexingDirectoryParserIterator(
+            directory,
+            db_path=os.path.join(directory, IndexedDirectorySource.DEFAULT_DB_FILE),
+            relative_paths=True,
+            workers=1,
+        ).load_database()
+
+        ds = load_source("indexed-directory", directory)
+
+        assert params(ds.sel(param=["t", "z"], level=850)) == [("t", 850), ("z", 850)]
+        assert params(ds.sel(param=["t", "z"]).order_by(param="descending", level=[850, 500]).sel(level=500)) == [
+            ("z", 500),
+            ("t", 500),
+        ]
+        assert params(ds.order_by(param=["z", "msl"]).sel(param=["msl", "z"])) == [
+            ("z", 500),
+            ("z", 850),
+            ("msl", None),
+        ]
+
+        remapped = ds.sel(param=["t", "z"]).order_by(
+            "param_level",
+            remapping={"param_level": "{param}:{levelist}"},
+        )
+        assert params(remapped) == [("t", 500), ("t", 850), ("z", 500), ("z", 850)]
+
+        # Each thread has its own connection
+        results = []
+        thread = threading.Thread(target=lambda: results.append(params(ds.sel(param="t").order_by("level"))))
+        thread.start()
+        thread.join()
+        assert results == [[("t", 500), ("t", 850)]]
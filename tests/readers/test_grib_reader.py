@@ -103,6 +103,429 @@ def test_bbox():
     assert s.to_bounding_box().as_tuple() == (73, -27, 33, 45), s.to_bounding_box()
 
 
+def test_metadata_table():
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+
+    table = s.metadata_table("param", "levelist:int", "step:float")
+    assert table["param"].tolist() == ["t", "z", "t", "z"]
+    assert table["levelist:int"].dtype == "int64"
+    assert table["levelist:int"].tolist() == [500, 500, 850, 850]
+    assert table["step:float"].dtype == "float64"
+
+    df = s.metadata_table("param", "levelist", as_pandas=True)
+    assert list(df.columns) == ["param", "levelist"]
+    assert len(df) == 4
+
+    assert s.unique_values("param", "levelist") == {"param": ("t", "z"), "levelist": (500, 850)}
+    assert s.sel(param="z").metadata_table("levelist")["levelist"].tolist() == [500, 850]
+
+
+def test_metadata_table_as_metadata():
+    import eccodes
+
+    from climetlab.core.temporary import temp_file
+
+    with temp_file(".grib") as tmp:
+        with open(tmp, "wb") as f, open(climetlab_file("docs/examples/test4.grib"), "rb") as g:
+            f.write(g.read())
+            # A parameter without a short name, on level 0
+            handle = eccodes.codes_grib_new_from_samples("GRIB1")
+            eccodes.codes_set_long(handle, "table2Version", 128)
+            eccodes.codes_set_long(handle, "indicatorOfParameter", 255)
+            eccodes.codes_set_long(handle, "level", 0)
+            eccodes.codes_write(handle, f)
+            eccodes.codes_release(handle)
+
+        s = load_source("file", tmp)
+        assert s[4].handle.get_string("shortName") == "~"
+
+        keys = ("param:str", "shortName:str", "level:int", "levelist:int", "_param_id:int", "step:float")
+        table = s.metadata_table(*keys)
+        for key in keys:
+            name, kind = key.split(":")
+            cast = dict(int=int, float=float, str=str)[kind]
+            expected = [f.metadata(name) for f in s]
+            assert table[key].tolist() == [None if v is None else cast(v) for v in expected], key
+
+
+def test_grib_sel_order_by():
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+
+    def params_levels(ds):
+        return [(f.metadata("param"), f.metadata("levelist")) for f in ds]
+
+    assert params_levels(s.sel(param="z")) == [("z", 500), ("z", 850)]
+    assert params_levels(s.sel(levelist="850", param=["t", "z"])) == [("t", 850), ("z", 850)]
+    assert params_levels(s.sel(param=lambda x: x.startswith("t"))) == [("t", 500), ("t", 850)]
+
+    assert params_levels(s.order_by(levelist="descending", param=["z", "t"])) == [
+        ("z", 850),
+        ("t", 850),
+        ("z", 500),
+        ("t", 500),
+    ]
+    assert params_levels(s.sel(levelist=500).order_by(param="descending")) == [("z", 500), ("t", 500)]
+
+    # Remappings are evaluated element by element
+    ordered = s.order_by("param_level", remapping={"param_level": "{param}{levelist}"})
+    assert params_levels(ordered) == [("t", 500), ("t", 850), ("z", 500), ("z", 850)]
+
+    # The metadata columns are cached with the file
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    assert "param" in s._load_columns()
+
+
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_grib_to_numpy(nthreads):
+    import numpy as np
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    expected = np.array([f.to_numpy() for f in s])
+
+    values = s.to_numpy(nthreads=nthreads)
+    assert values.shape == (4, 181, 360)
+    assert np.array_equal(values, expected)
+
+    values = s.to_numpy(dtype=np.float32, reshape=False, nthreads=nthreads)
+    assert values.shape == (4, 181 * 360)
+    assert values.dtype == np.float32
+
+    out = np.empty((2, 2, 181, 360))
+    assert s.to_numpy(out=out, nthreads=nthreads) is out
+    assert np.array_equal(out.reshape(4, 181, 360), expected)
+
+    assert s.cube("param", "levelist").to_numpy().shape == (2, 2, 181, 360)
+
+
+@pytest.mark.parametrize("nthreads", [1, 3])
+def test_grib_read_cubelets(nthreads):
+    import numpy as np
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    cube = s.cube("param", "levelist")
+    expected = cube.to_numpy()
+
+    cubelets = list(cube.read_cubelets(reading_chunks=["param"], nthreads=nthreads, prefetch=1))
+    assert [c.coords for c, _ in cubelets] == [(0,), (1,)]
+    for c, values in cubelets:
+        assert values.shape == c.shape == (1, 2, 181, 360)
+        assert np.array_equal(values[0], expected[c.coords[0]])
+
+    cubelets = list(cube.read_cubelets(reading_chunks=["param", "levelist"], nthreads=nthreads))
+    assert len(cubelets) == 4
+    for c, values in cubelets:
+        assert np.array_equal(values, expected[c.coords])
+
+
+def test_grib_grid_points():
+    import numpy as np
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+
+    lat, lon = s[0].grid_points()
+    data = s[0].data
+    assert np.array_equal(lat, [d["lat"] for d in data])
+    assert np.array_equal(lon, [d["lon"] for d in data])
+
+    # Fields on the same grid share the coordinates
+    assert s[3].grid_points()[0] is lat
+
+    assert list(s[0].iterate_grid_points())[:2] == [(90.0, 0.0), (90.0, 1.0)]
+
+    df = s.to_pandas(latitude=50, longitude=10)
+    assert len(df) == 4
+    assert list(df["param"]) == ["t", "z", "t", "z"]
+    assert np.array_equal(df["value"], [f.to_numpy()[40, 10] for f in s])
+
+
+@pytest.mark.parametrize("persistence", [False, True])
+def test_grib_grid_geometry(monkeypatch, persistence):
+    import numpy as np
+    from lru import LRU
+
+    from climetlab.readers.grib import geometry
+
+    monkeypatch.setattr(geometry, "GEOMETRIES", LRU(2))
+    monkeypatch.setattr(geometry, "GRID_GEOMETRY_PERSISTENCE", persistence)
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    assert s[0].geometry is s[3].geometry
+    assert s[0].shape == (181, 360)
+    assert s[0].mars_area == [90.0, 0.0, -90.0, 359.0]
+    assert s[1].to_bounding_box().as_tuple() == (90.0, 0.0, -90.0, 359.0)
+
+    lat, lon = s[0].grid_points()
+    assert not lat.flags.writeable
+
+    # Start from an empty registry, coordinates are read back from the cache directory
+    monkeypatch.setattr(geometry, "GEOMETRIES", LRU(2))
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    assert isinstance(s[0].grid_points()[0], np.memmap) == persistence
+    assert np.array_equal(s[0].grid_points()[0], lat)
+    assert np.array_equal(s[0].grid_points()[1], lon)
+
+
+@pytest.mark.parametrize("persistence", [False, True])
+def test_grib_grid_geometry_shape_of_the_earth(monkeypatch, persistence):
+    import eccodes
+    import numpy as np
+    from lru import LRU
+
+    from climetlab.core.temporary import temp_file
+    from climetlab.readers.grib import geometry
+
+    monkeypatch.setattr(geometry, "GEOMETRIES", LRU(4))
+    monkeypatch.setattr(geometry, "GRID_GEOMETRY_PERSISTENCE", persistence)
+
+    with temp_file(".grib") as tmp:
+        with open(tmp, "wb") as f:
+            for shape in (6, 8):
+                handle = eccodes.codes_grib_new_from_samples("polar_stereographic_pl_grib2")
+                eccodes.codes_set_long(handle, "shapeOfTheEarth", shape)
+                eccodes.codes_write(handle, f)
+                eccodes.codes_release(handle)
+
+        s = load_source("file", tmp)
+        assert s[0].shape == s[1].shape
+        assert "geometry" not in s[0].__dict__
+
+        # Same md5GridSection, but not the same coordinates
+        assert s[0].handle.get("md5GridSection") == s[1].handle.get("md5GridSection")
+        assert s[0].geometry is not s[1].geometry
+        assert not np.array_equal(s[0].grid_points()[0], s[1].grid_points()[0])
+
+    # The shape of the Earth does not change the coordinates of lat/lon grids
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    assert s[0].geometry.earth is None
+
+
+def test_grib_to_pandas():
+    import numpy as np
+
+    from climetlab.readers.grib import points
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+
+    df = s.to_pandas()
+    assert len(df) == 4 * 181 * 360
+    assert list(df.columns)[:4] == ["lat", "lon", "value", "datetime"]
+    assert df["param"].dtype == "category"
+    assert list(df["param"].cat.categories) == ["t", "z"]
+    assert np.array_equal(df["value"], np.concatenate([f.values for f in s]))
+    assert np.array_equal(df["lat"][: 181 * 360], s[0].grid_points()[0])
+
+    chunks = list(s.iterate_pandas(fields_per_chunk=3))
+    assert [len(c) for c in chunks] == [3 * 181 * 360, 181 * 360]
+    assert list(chunks[1]["param"].unique()) == ["z"]
+
+    df = s.to_pandas(latitude=50, longitude=10)
+    assert list(df["levelist"]) == [500, 500, 850, 850]
+
+    # Only the most recently selected points are kept
+    for longitude in range(points.POINTS_WEIGHTS_CACHE_SIZE + 5):
+        assert len(s.to_pandas(latitude=50, longitude=longitude)) == 4
+    assert len(s[0].geometry._cache["weights"]) == points.POINTS_WEIGHTS_CACHE_SIZE
+
+    with pytest.raises(TypeError):
+        s.to_pandas(latitude=50, lon=10)
+
+    # Options for other formats are ignored
+    assert len(s.to_pandas(latitude=50, longitude=10, pandas_read_csv_kwargs={})) == 4
+
+
+def test_grib_extract_points():
+    import numpy as np
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    data = s.to_numpy()
+
+    values = s.extract_points([50.2, -89.9], [10.4, 359.6])
+    assert values.shape == (4, 2)
+    assert np.array_equal(values[:, 0], data[:, 40, 10])
+    assert np.array_equal(values[:, 1], data[:, 180, 0])
+
+    values = s.extract_points([50, 49.5, 0.5], [10, 10.5, 359.5], method="bilinear")
+    assert np.allclose(values[:, 0], data[:, 40, 10])
+    assert np.allclose(values[:, 1], data[:, 40:42, 10:12].mean(axis=(1, 2)))
+    assert np.allclose(values[:, 2], data[:, 89:91, [359, 0]].mean(axis=(1, 2)))
+
+    # Weights are cached on the grid geometry
+    assert len([k for k in s[0].geometry._cache["weights"].keys() if k[0] == "bilinear"]) == 1
+
+    with pytest.raises(ValueError):
+        s.extract_points(50, 10, method="cubic")
+
+
+def test_grib_extract_points_brute_force(monkeypatch):
+    import numpy as np
+
+    from climetlab.readers.grib import points
+
+    monkeypatch.setattr(points, "BRUTE_FORCE_CHUNK_SIZE", 3)
+    monkeypatch.setattr(points, "BRUTE_FORCE_GRID_CHUNK_SIZE", 1000)
+
+    rng = np.random.default_rng(0)
+    xyz = points.unit_sphere(rng.uniform(-90, 90, 5000), rng.uniform(0, 360, 5000))
+    locations = points.unit_sphere(rng.uniform(-90, 90, 10), rng.uniform(0, 360, 10))
+
+    _, index = points._BruteForceTree(xyz).query(locations)
+    assert np.array_equal(index, np.argmax(locations @ xyz.T, axis=1))
+
+
+def test_grib_extract_points_regional():
+    import numpy as np
+
+    from climetlab.readers.grib import points
+
+    s = load_source("file", climetlab_file("docs/examples/test.grib"))
+    data = s.to_numpy()
+
+    # The grid goes from 73N to 33N and from 27W to 45E, every 4 degrees
+    values = s.extract_points([73, 33, 35, 80, 20, 50, 50], [-27, 45, 43, 0, 0, -30, 50], method="bilinear")
+    assert np.allclose(values[:, 0], data[:, 0, 0])
+    assert np.allclose(values[:, 1], data[:, -1, -1])
+    assert np.allclose(values[:, 2], data[:, -2:, -2:].mean(axis=(1, 2)))
+    assert np.isnan(values[:, 3:]).all()
+
+    values = s.extract_points([72, 33.5, 80, 20, 50, 50], [-26, 44, 0, 0, -30, 50])
+    assert np.array_equal(values[:, 0], data[:, 0, 0])
+    assert np.array_equal(values[:, 1], data[:, -1, -1])
+    assert np.isnan(values[:, 2:]).all()
+
+    # Only the most recent weights are kept
+    for i in range(points.POINTS_WEIGHTS_CACHE_SIZE + 5):
+        s.extract_points(50, i)
+    assert len(s[0].geometry._cache["weights"]) == points.POINTS_WEIGHTS_CACHE_SIZE
+
+
+def test_grib_statistics():
+    import numpy as np
+
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    data = s.to_numpy()
+
+    stats = s.statistics()
+    assert stats["count"] == data.size
+    assert stats["average"] == pytest.approx(data.mean())
+    assert stats["stdev"] == pytest.approx(data.std())
+    assert stats["minimum"] == data.min()
+
+    stats = s.statistics(group_by="param")
+    assert list(stats) == ["t", "z"]
+    assert stats["z"]["maximum"] == data[1::2].max()
+
+    stats = s.statistics(per="point", group_by=["param", "levelist"])
+    assert np.allclose(stats[("t", 500)]["average"], data[0])
+
+    stats = s.statistics(per="field")
+    assert [x["average"] for x in stats] == pytest.approx(data.mean(axis=(1, 2)))
+
+    # Results are cached next to the file
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    assert s._load_statistics(["field", None]) == stats
+
+
+def test_grib_availability():
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+
+    assert s.is_full_hypercube()
+    assert s.availability_index.unique_values()["levelist"] == (500, 850)
+    assert s.availability.count() == 4
+
+    r = s.available(dict(param=["t", "u"], level=500))
+    assert r["available"].count() == 1
+    assert r["missing"].to_list() == [{"levelist": [500], "param": ["u"]}]
+
+    # The index is cached next to the file
+    s = load_source("file", climetlab_file("docs/examples/test4.grib"))
+    index = s._load_availability_index()
+    assert index is not None and len(index) == 4
+
+
+@pytest.mark.parametrize("padding", [0, 5])
+def test_messages_positions(padding):
+    from climetlab.core.temporary import temp_file
+    from climetlab.readers.grib.codes import get_messages_positions
+    from climetlab.readers.grib.codes import get_messages_positions_array
+    from climetlab.readers.grib.codes import get_messages_positions_with_read
+
+    with temp_file(".grib") as path:
+        with open(path, "wb") as f:
+            for name in ("docs/examples/test.grib", "docs/examples/test4.grib"):
+                with open(climetlab_file(name), "rb") as g:
+                    f.write(g.read())
+                f.write(b"G" * padding)
+
+        expected = list(get_messages_positions_with_read(path))
+        assert len(expected) == 6, expected
+        assert list(get_messages_positions(path)) == expected
+        assert get_messages_positions_array(path).tolist() == [list(x) for x in expected]
+
+        s = load_source("file", path)
+        assert len(s) == 6
+        assert [(p.offset, p.length) for p in (s.part(i) for i in range(len(s)))] == expected
+
+
+@pytest.mark.parametrize("mode", ["file", "mmap"])
+def test_grib_reader_mode(mode, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from climetlab.core.temporary import temp_file
+    from climetlab.readers.grib import codes
+
+    monkeypatch.setattr(codes, "GRIB_READER_MODE", mode)
+    monkeypatch.setattr(codes, "cache", codes.ReaderLRUCache(512))
+
+    path = climetlab_file("docs/examples/test4.grib")
+    s = load_source("file", path)
+    assert isinstance(codes.CodesReader.from_cache(path), codes.READERS[mode])
+
+    with ThreadPoolExecutor(4) as executor:
+        values = list(executor.map(lambda f: f.to_numpy(), s))
+
+    assert [v.shape for v in values] == [(181, 360)] * 4
+
+    with temp_file(".grib") as tmp:
+        s.save(tmp)
+        with open(tmp, "rb") as f, open(path, "rb") as g:
+            assert f.read() == g.read()
+
+
+def test_grib_mmap_reader_modified_file():
+    import shutil
+
+    from climetlab.core.temporary import temp_file
+    from climetlab.readers.grib import codes
+
+    path = climetlab_file("docs/examples/test4.grib")
+    size = os.path.getsize(path)
+
+    with temp_file(".grib") as tmp:
+        shutil.copyfile(path, tmp)
+        reader = codes.MMapCodesReader.create(tmp)
+        assert reader.at_offset(0).get("shortName") == "t"
+
+        # Appended messages are found
+        with open(tmp, "ab") as f, open(path, "rb") as g:
+            f.write(g.read())
+        assert reader.at_offset(size).get("shortName") == "t"
+        assert reader.read_bytes(size, 4) == b"GRIB"
+
+        # Reading past the end of a truncated file fails cleanly
+        with open(tmp, "r+b") as f:
+            f.truncate(size // 2)
+        with pytest.raises(AssertionError):
+            reader.at_offset(size)
+        assert reader.read_bytes(size, 4) == b""
+
+        # Empty files cannot be mapped
+        with open(tmp, "wb"):
+            pass
+        assert type(codes.MMapCodesReader.create(tmp)) is codes.CodesReader
+        with pytest.raises(AssertionError):
+            reader.at_offset(0)
+
+
 if __name__ == "__main__":
     from climetlab.testing import main
 
@@ -154,6 +154,49 @@ def test_datetime():
     ], s.to_datetime_list()
 
 
+def test_netcdf_to_numpy(monkeypatch):
+    import numpy as np
+    import xarray as xr
+
+    from climetlab.core.temporary import temp_file
+    from climetlab.readers.netcdf import fieldset
+
+    data = np.random.random((6, 3, 4, 5)).astype(np.float32)
+    ds = xr.Dataset(
+        dict(t=(("time", "level", "lat", "lon"), data), z=(("time", "level", "lat", "lon"), data * 2)),
+        coords=dict(
+            time=np.datetime64("2020-01-01") + np.arange(6) * np.timedelta64(6, "h"),
+            level=[1000, 850, 500],
+            lat=np.arange(4),
+            lon=np.arange(5),
+        ),
+    )
+    for name, standard_name in dict(time="time", level="air_pressure", lat="latitude", lon="longitude").items():
+        ds[name].attrs["standard_name"] = standard_name
+
+    with temp_file(".nc") as path:
+        ds.to_netcdf(path, encoding=dict(t=dict(chunksizes=(2, 3, 4, 5))))
+        s = load_source("file", path)._reader
+
+        def expected(fields):
+            return np.stack([f.to_numpy() for f in fields])
+
+        assert len(s) == 36
+        assert np.array_equal(s.to_numpy(), np.concatenate([data.reshape(18, 4, 5), data.reshape(18, 4, 5) * 2]))
+        assert s.to_numpy(reshape=False, dtype=np.float64).shape == (36, 20)
+
+        for indices in ([0, 3, 6, 9], [35, 2, 1, 20, 19], list(range(0, 36, 5))):
+            subset = s.from_tuple(indices)
+            assert np.array_equal(subset.to_numpy(), expected(subset))
+
+        # Large hyperslabs are split on chunk boundaries
+        monkeypatch.setattr(fieldset, "NETCDF_SLAB_SIZE", 4 * 5 * 4 * 6)
+        slabs = [(x.name, lo.tolist(), hi.tolist()) for x, _, _, lo, hi in s._slabs()]
+        assert slabs[:3] == [("t", [0, 0], [2, 3]), ("t", [2, 0], [4, 3]), ("t", [4, 0], [6, 3])]
+        assert len(slabs) == 7
+        assert np.array_equal(s.to_numpy(), expected(s))
+
+
 def test_bbox():
     s = load_source("file", climetlab_file("docs/examples/test.nc"))
     assert s.to_bounding_box().as_tuple() == (73, -27, 33, 45), s.to_bounding_box()
@@ -16,7 +16,12 @@ import time
 import pytest
 
 from climetlab import settings
+from climetlab.core.temporary import temp_directory
+from climetlab.sources.url import download_parts_and_cache
+from climetlab.testing import range_server
 from climetlab.utils import download_and_cache
+from climetlab.utils.parts import Part
+from climetlab.utils.parts import plan_ranges
 
 
 def path_to_url(path):
@@ -53,6 +58,62 @@ def test_download_4():
     assert r is None, r
 
 
+def test_plan_ranges():
+    parts = [(100, 10), (0, 10), (15, 5), (1000, 50)]
+
+    # Parts are written in the given order
+    assert plan_ranges(parts) == [
+        (0, 10, [(0, 10, 10)]),
+        (15, 5, [(15, 5, 20)]),
+        (100, 10, [(100, 10, 0)]),
+        (1000, 50, [(1000, 50, 25)]),
+    ]
+
+    assert plan_ranges(parts, gap=100) == [
+        (0, 110, [(0, 10, 10), (15, 5, 20), (100, 10, 0)]),
+        (1000, 50, [(1000, 50, 25)]),
+    ]
+
+    assert plan_ranges(parts, gap=100, maximum_size=40) == [
+        (0, 37, [(0, 10, 10), (15, 5, 20)]),
+        (74, 36, [(100, 10, 0)]),
+        (1000, 25, [(1000, 25, 25)]),
+        (1025, 25, [(1025, 25, 50)]),
+    ]
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_download_parts(ranges):
+    data = bytes(i % 251 for i in range(100000))
+    parts = [(50000, 1000), (10, 100), (200, 300), (50000, 10), (90000, 10000)]
+    expected = b"".join(data[offset : offset + length] for offset, length in parts)
+
+    with temp_directory() as tmpdir, settings.temporary():
+        settings.set("cache-directory", tmpdir)
+        settings.set("url-ranges-gap", 1000)
+        settings.set("url-ranges-maximum-request-size", 4000)
+
+        with range_server(data, ranges=ranges) as server:
+            path = download_parts_and_cache(server.url, parts)
+            with open(path, "rb") as f:
+                assert f.read() == expected
+
+            if ranges:
+                assert sorted(server.requests) == [
+                    "bytes=10-499",
+                    "bytes=50000-50999",
+                    "bytes=90000-93333",
+                    "bytes=93334-96667",
+                    "bytes=96668-99999",
+                ]
+
+            # Same cache entry as multiurl
+            assert download_and_cache(server.url, parts=parts) == path
+
+            resolved = Part.resolve([Part(server.url, offset, length) for offset, length in parts])
+            assert resolved[-1] == Part(path, len(expected) - 10000, 10000)
+
+
 if __name__ == "__main__":
     from climetlab.testing import main
 
@@ -164,6 +164,34 @@ def test_factorise_4():
     )
 
 
+def test_factorise_5():
+    fields = [
+        {"param": p, "level": lev, "step": s}
+        for p in ("T", "Z", "U", "V")
+        for lev in (500, 850, 1000)
+        for s in range(0, 240, 6)
+        if not (p == "U" and s >= 120)
+    ]
+
+    c = factorise(fields)
+    assert c.count() == len(fields)
+    assert _(c.to_list()) == _(
+        [
+            {"param": ["T", "V", "Z"], "level": [500, 850, 1000], "step": list(range(0, 240, 6))},
+            {"param": ["U"], "level": [500, 850, 1000], "step": list(range(0, 120, 6))},
+        ]
+    )
+
+    m = c.missing(param=["T", "U"], level=[500, 700], step=[0, 120, 126])
+    assert _(m.to_list()) == _(
+        [
+            {"level": [500], "param": ["U"], "step": [120, 126]},
+            {"level": [700], "param": ["T", "U"], "step": [0, 120, 126]},
+        ]
+    )
+    assert c.missing(param="T", level=500, step=6).count() == 0
+
+
 if __name__ == "__main__":
     from climetlab.testing import main
 
@@ -173,6 +173,104 @@ def test_tp():
         assert np.allclose(ds[0].to_numpy(), data, rtol=EPSILON, atol=EPSILON)
 
 
+@pytest.mark.skipif(
+    sys.version_info < (3, 10),
+    reason="ignore_cleanup_errors requires Python 3.10 or later",
+)
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_write_many(nthreads):
+    arrays = [np.random.random((181, 360)) for _ in range(12)]
+    metadatas = [dict(param=p, step=s) for s in (0, 6, 12, 18) for p in ("2t", "msl", "tp")]
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        path = os.path.join(tmp, "a.grib")
+        with cml.new_grib_output(path, date=20010101) as f:
+            assert f.write_many(arrays, metadatas, nthreads=nthreads) == [path] * 12
+
+        path2 = os.path.join(tmp, "b.grib")
+        with cml.new_grib_output(path2, date=20010101) as f:
+            for data, metadata in zip(arrays, metadatas):
+                f.write(data, metadata=metadata)
+
+        with open(path, "rb") as a, open(path2, "rb") as b:
+            assert a.read() == b.read()
+
+        ds = cml.load_source("file", path)
+        assert [(x.metadata("param"), x.metadata("step")) for x in ds] == [
+            (m["param"], m["step"]) for m in metadatas
+        ]
+        for x, data in zip(ds, arrays):
+            assert np.allclose(x.to_numpy(), data, rtol=EPSILON, atol=EPSILON)
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 10),
+    reason="ignore_cleanup_errors requires Python 3.10 or later",
+)
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_split_output(asynchronous):
+    data = np.random.random((181, 360))
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        pattern = os.path.join(tmp, "{shortName}.grib")
+
+        with cml.new_grib_output(
+            pattern,
+            split_output=True,
+            date=20010101,
+            asynchronous=asynchronous,
+            queue_size=2,
+            max_open_files=2,
+            atomic=True,
+            fsync=True,
+        ) as f:
+            for step in (0, 6, 12):
+                for param in ("2t", "msl", "sp"):
+                    f.write(data, param=param, step=step)
+                    # Reuse the buffer, the values must have been copied
+                    data += 1
+
+            f.flush()
+            assert sorted(os.listdir(tmp)) == ["2t.grib.tmp", "msl.grib.tmp", "sp.grib.tmp"]
+
+        assert sorted(os.listdir(tmp)) == ["2t.grib", "msl.grib", "sp.grib"]
+
+        for i, param in enumerate(("2t", "msl", "sp")):
+            ds = cml.load_source("file", os.path.join(tmp, f"{param}.grib"))
+            assert [x.metadata("step") for x in ds] == [0, 6, 12]
+            assert np.allclose(ds[1].to_numpy(), data - 9 + 3 + i, rtol=EPSILON, atol=EPSILON)
+
+        # Nothing is renamed if the output is not completed
+        with pytest.raises(ValueError):
+            with cml.new_grib_output(pattern, split_output=True, asynchronous=asynchronous, atomic=True) as f:
+                f.write(data, param="tp", date=20010101)
+                raise ValueError()
+
+        assert sorted(os.listdir(tmp)) == ["2t.grib", "msl.grib", "sp.grib"]
+
+
+def test_normalized_metadata_names():
+    from climetlab.readers.grib.output import GribCoder
+
+    coder = GribCoder()
+
+    a = np.zeros(2000)
+    b = a.copy()
+    b[1000] = 1
+    # The arrays only differ in the part left out of their repr()
+    assert repr(a) == repr(b)
+
+    for level, pv in ((500, a), (850, b)):
+        md = coder._normalize_kwargs_names_cached(dict(level=level, pv=pv, date=20010101))
+        assert md["levelist"] == level
+        assert md["pv"] is pv
+        assert "level" not in md
+
+    md = coder._normalize_kwargs_names_cached(dict(level=1000, date=20010102))
+    assert md["levelist"] == 1000
+    assert md["date"] == coder._normalize_kwargs_names(date=20010102)["date"]
+
+
 if __name__ == "__main__":
     test_mars_labeling()
     # from climetlab.testing import main
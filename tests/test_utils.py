@@ -16,6 +16,7 @@ import pytest
 
 from climetlab.utils import load_json_or_yaml
 from climetlab.utils import string_to_args
+from climetlab.utils.accumulators import StatisticsAccumulator
 from climetlab.utils.humanize import as_bytes
 from climetlab.utils.humanize import as_seconds
 from climetlab.utils.humanize import as_timedelta
@@ -202,6 +203,34 @@ def test_as_seconds():
     assert as_seconds("2h") == 2 * 60 * 60
 
 
+def test_statistics_accumulator():
+    import numpy as np
+
+    values = np.random.default_rng(0).normal(1e6, 3, size=(10, 100))
+    values[2, 5] = values[7, :] = np.nan
+
+    total = StatisticsAccumulator()
+    for v in values:
+        total.add(v)
+
+    # Partial results are merged
+    merged = StatisticsAccumulator.from_values(values[:3]).merge(StatisticsAccumulator.from_values(values[3:]))
+
+    for stats in (total, merged):
+        d = stats.as_dict()
+        assert d["count"] == 899
+        assert d["average"] == pytest.approx(np.nanmean(values))
+        assert d["stdev"] == pytest.approx(np.nanstd(values))
+        assert d["minimum"] == np.nanmin(values)
+        assert d["maximum"] == np.nanmax(values)
+
+    per_point = StatisticsAccumulator.from_values(values, axis=0).as_dict()
+    assert per_point["count"][5] == 8
+    assert np.allclose(per_point["stdev"], np.nanstd(values, axis=0))
+
+    assert np.isnan(StatisticsAccumulator().as_dict()["average"])
+
+
 if __name__ == "__main__":
     from climetlab.testing import main
 